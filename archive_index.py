@@ -0,0 +1,237 @@
+"""Perceptual-hash index of the saved meme archive for near-duplicate checks."""
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_bytes, file_lock
+from image_buffer import open_reader
+from meme_store import iter_meme_files
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8  # 8x8 gradient bits = 64-bit dHash
+
+
+def dhash(image_data) -> int:
+    """
+    Difference hash of an image: one bit per horizontally adjacent pixel pair of a
+    9x8 grayscale thumbnail, set when brightness increases left to right.
+
+    Args:
+        image_data: Encoded image (bytes-like or ImageBuffer)
+
+    Returns:
+        int: 64-bit hash
+    """
+    from PIL import Image  # Deferred: loading the index does not need Pillow
+
+    with Image.open(open_reader(image_data)) as image:
+        # JPEG draft decodes at 1/8 scale, so hashing a large file costs a fraction of a full decode
+        image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX).getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return (a ^ b).bit_count()
+
+
+def hash_file(path: str) -> tuple:
+    """Hash one archive file (process-pool worker). Returns (file name, hash or None)."""
+    from PIL import UnidentifiedImageError
+
+    try:
+        with open(path, 'rb') as f:
+            return Path(path).name, dhash(f.read())
+    except (OSError, UnidentifiedImageError) as e:
+        logger.warning(f"Could not hash {path}: {e}")
+        return Path(path).name, None
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with Hamming distance.
+
+    Each node is [hash, files, {distance: child}]. A radius query only descends
+    into children whose edge distance is within radius of the query's distance
+    to the node (triangle inequality), so most of the tree is never visited.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, name: str):
+        """Insert a hash with the file it came from."""
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [name], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(name)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [name], {}]
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> list:
+        """
+        Find stored hashes within radius of value.
+
+        Returns:
+            list: (distance, file name) pairs, closest first
+        """
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                matches.extend((distance, name) for name in node[1])
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        matches.sort()
+        return matches
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class ArchiveIndex:
+    """
+    dHash index of every meme saved to the archive directory.
+
+    Persisted as a JSON-lines file (one {"file", "dhash", "added"} record per
+    image) that new memes are appended to, so recording a meme never rewrites
+    the index. Lookups go through an in-memory BK-tree built on load.
+    """
+
+    def __init__(self, path: str = None, max_distance: int = None):
+        """
+        Load the index.
+
+        Args:
+            path: Index file (defaults to ARCHIVE_INDEX_PATH from config)
+            max_distance: Hamming distance (of 64 bits) at or below which images are
+                          near-duplicates (defaults to ARCHIVE_DUPLICATE_DISTANCE from config)
+        """
+        self.path = Path(path or Config.ARCHIVE_INDEX_PATH)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.max_distance = max_distance if max_distance is not None else Config.ARCHIVE_DUPLICATE_DISTANCE
+        self.files = set()
+        self.tree = BKTree()
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        started = time.perf_counter()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    value = int(record["dhash"], 16)
+                except (json.JSONDecodeError, KeyError, ValueError):
+                    logger.warning(f"Skipping corrupt archive index line: {line[:60]!r}")
+                    continue
+                self._insert(record["file"], value)
+        logger.debug(f"Loaded {len(self.tree)} archive hashes in {time.perf_counter() - started:.3f}s")
+
+    def _insert(self, name: str, value: int):
+        self.files.add(name)
+        self.tree.add(value, name)
+
+    @staticmethod
+    def _record(name: str, value: int) -> str:
+        return json.dumps({"file": name, "dhash": f"{value:016x}", "added": datetime.now().isoformat()}) + "\n"
+
+    def __len__(self) -> int:
+        return len(self.tree)
+
+    def find_duplicates(self, value: int) -> list:
+        """
+        Find archived memes that look like the image with hash value.
+
+        Args:
+            value: dHash of the new image
+
+        Returns:
+            list: (distance, file name) pairs within max_distance, closest first
+        """
+        return self.tree.search(value, self.max_distance)
+
+    def add(self, name: str, value: int):
+        """
+        Record an archived meme and append it to the index file.
+
+        Args:
+            name: File name within the archive directory
+            value: dHash of the image
+        """
+        self._insert(name, value)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.lock_path):
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(self._record(name, value))
+
+    def build(self, archive_dir: Path, workers: int = None, rebuild: bool = False) -> int:
+        """
+        Hash archive images on a process pool and write the index in one go.
+
+        Args:
+            archive_dir: Directory of saved memes
+            workers: Worker processes (defaults to the CPU count)
+            rebuild: Rehash every file instead of only files missing from the index
+
+        Returns:
+            int: Number of files hashed
+        """
+        from concurrent.futures import ProcessPoolExecutor  # multiprocessing is only needed here
+
+        archive_dir = Path(archive_dir)
+        paths = sorted(iter_meme_files(archive_dir))
+        if rebuild:
+            self.files = set()
+            self.tree = BKTree()
+        todo = [str(path) for path in paths if path.name not in self.files]
+        logger.info(f"Hashing {len(todo)} of {len(paths)} archive images...")
+
+        started = time.perf_counter()
+        hashed = []
+        if todo:
+            workers = workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # Large chunks keep per-task IPC small next to the ~1 ms hash
+                chunksize = max(1, len(todo) // (workers * 8))
+                for name, value in executor.map(hash_file, todo, chunksize=chunksize):
+                    if value is not None:
+                        hashed.append((name, value))
+        for name, value in hashed:
+            self._insert(name, value)
+
+        # Written atomically so an interrupted build never leaves a partial index
+        with file_lock(self.lock_path):
+            existing = [] if rebuild or not self.path.exists() else self.path.read_text(encoding='utf-8').splitlines(keepends=True)
+            lines = existing + [self._record(name, value) for name, value in hashed]
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(self.path, "".join(lines).encode('utf-8'))
+        logger.info(f"Indexed {len(hashed)} images in {time.perf_counter() - started:.1f}s ({len(self.tree)} total)")
+        return len(hashed)
@@ -0,0 +1,171 @@
+"""Bulk re-encoding of the meme archive on a process pool, skipping files that are already up to date."""
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from file_utils import atomic_write_bytes, atomic_write_json
+from image_buffer import as_view
+from meme_store import iter_meme_files
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_SAVE_EVERY = 200  # Results between manifest checkpoints, so an interrupted run keeps its progress
+TASKS_PER_WORKER = 4  # Files queued per worker; the directory is streamed, not listed up front
+
+
+def settings_key(renditions: list) -> str:
+    """Hash of everything that affects the output, so changed settings reprocess every file."""
+    from image_processor import ImageProcessor
+
+    settings = {
+        "renditions": [(r.name, r.max_dimension, r.format, r.max_bytes, r.quality) for r in renditions],
+        "encoder": (ImageProcessor.MAX_QUALITY, ImageProcessor.MIN_QUALITY, ImageProcessor.MAX_ENCODES,
+                    ImageProcessor.PROGRESSIVE_MIN_PIXELS, ImageProcessor.DRAFT_GAP),
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _quiet_worker():
+    """Pool initializer: per-image INFO logs from thousands of files would drown the progress lines."""
+    logging.getLogger("image_processor").setLevel(logging.WARNING)
+
+
+def reprocess_file(path: str, output_dir: str, renditions: list, key: str, known: dict = None) -> tuple:
+    """
+    Re-encode one archive file into every rendition (process-pool worker).
+
+    Args:
+        path: Archived meme
+        output_dir: Directory for <stem>_<rendition>.<ext> outputs
+        renditions: Rendition objects to produce
+        key: settings_key(renditions)
+        known: The file's manifest entry from the last run, if any
+
+    Returns:
+        tuple: (file name, "done" | "skipped" | "failed", manifest entry or error message)
+    """
+    from image_processor import ImageProcessor
+
+    path = Path(path)
+    output_dir = Path(output_dir)
+    try:
+        # Archived memes are a few MB at most: read once for both the hash and the decode
+        data = path.read_bytes()
+        source = hashlib.sha256(data).hexdigest()
+        if (known and known.get("source") == source and known.get("settings") == key
+                and all((output_dir / name).exists() for name in known.get("outputs", []))):
+            return path.name, "skipped", known
+        outputs = []
+        for name, (encoded, stats) in ImageProcessor.render(data, renditions).items():
+            output = f"{path.stem}_{name}.{stats['extension']}"
+            atomic_write_bytes(output_dir / output, as_view(encoded))
+            outputs.append(output)
+        return path.name, "done", {"source": source, "settings": key, "outputs": sorted(outputs)}
+    except Exception as e:
+        return path.name, "failed", f"{type(e).__name__}: {e}"
+
+
+class ArchiveReprocessor:
+    """
+    Re-encodes every archived meme into the configured renditions on a process pool.
+
+    Outputs go to output_dir (the archive itself is never modified) and a manifest
+    there records each file's source hash and settings, so reruns only touch files
+    that are new or changed, or whose settings changed.
+    """
+
+    def __init__(self, archive_dir: Path, output_dir: Path = None, renditions: list = None):
+        """
+        Args:
+            archive_dir: Directory of saved memes
+            output_dir: Where outputs and the manifest go (defaults to archive_dir/renditions)
+            renditions: Variants to produce (defaults to ImageProcessor.configured_renditions())
+        """
+        from image_processor import ImageProcessor
+
+        self.archive_dir = Path(archive_dir)
+        self.output_dir = Path(output_dir) if output_dir else self.archive_dir / "renditions"
+        self.renditions = renditions or ImageProcessor.configured_renditions()
+        self.manifest_path = self.output_dir / MANIFEST_NAME
+
+    def _load_manifest(self) -> dict:
+        if not self.manifest_path.exists():
+            return {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring corrupt reprocessing manifest: {self.manifest_path}")
+            return {}
+
+    def _sources(self):
+        """Archive files in directory order, without listing the whole archive first."""
+        for path in iter_meme_files(self.archive_dir):
+            yield str(path)
+
+    def run(self, workers: int = None) -> dict:
+        """
+        Reprocess the archive.
+
+        Args:
+            workers: Worker processes (defaults to the CPU count)
+
+        Returns:
+            dict: {"done", "skipped", "failed", "seconds", "files_per_sec"}
+        """
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait  # multiprocessing is only needed here
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        manifest = self._load_manifest()
+        workers = workers or os.cpu_count() or 1
+        key = settings_key(self.renditions)
+        counts = {"done": 0, "skipped": 0, "failed": 0}
+        logger.info(f"Reprocessing {self.archive_dir}/ into {self.output_dir}/ with {workers} workers "
+                    f"({', '.join(r.name for r in self.renditions)})")
+
+        started = time.perf_counter()
+        unsaved = 0
+
+        def collect(future):
+            nonlocal unsaved
+            name, status, result = future.result()
+            counts[status] += 1
+            if status == "failed":
+                logger.warning(f"Could not reprocess {name}: {result}")
+            elif status == "done":
+                manifest[name] = result
+                unsaved += 1
+            if unsaved >= MANIFEST_SAVE_EVERY:
+                atomic_write_json(self.manifest_path, manifest)
+                unsaved = 0
+            finished = sum(counts.values())
+            if finished % 100 == 0:
+                elapsed = time.perf_counter() - started
+                logger.info(f"{finished} files ({counts['done']} reprocessed, {counts['skipped']} up to date) "
+                            f"at {finished / elapsed:.1f} files/s")
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_quiet_worker) as executor:
+                pending = set()
+                for path in self._sources():
+                    if len(pending) >= workers * TASKS_PER_WORKER:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect(future)
+                    known = manifest.get(Path(path).name)
+                    pending.add(executor.submit(reprocess_file, path, str(self.output_dir), self.renditions, key, known))
+                for future in wait(pending).done:
+                    collect(future)
+        finally:
+            # Also on Ctrl+C, so the next run skips what this one finished
+            atomic_write_json(self.manifest_path, manifest)
+
+        elapsed = time.perf_counter() - started
+        total = sum(counts.values())
+        summary = {**counts, "seconds": round(elapsed, 2), "files_per_sec": round(total / elapsed, 2) if elapsed else 0.0}
+        logger.info(f"Reprocessed {counts['done']} files, {counts['skipped']} up to date, {counts['failed']} failed "
+                    f"in {elapsed:.1f}s ({summary['files_per_sec']} files/s)")
+        return summary
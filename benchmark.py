@@ -0,0 +1,522 @@
+"""Offline benchmarks for the coffee meme pipeline (no API keys or network needed).
+
+Usage:
+    python benchmark.py allocations [--size 1024] [--runs 3]
+    python benchmark.py send-memory [--size-mb 4] [--runs 3] [--max-copies 1.0]
+    python benchmark.py composite-distance [--backgrounds 10]
+    python benchmark.py e2e [--count 10] [--concurrency 4] [--latency-ms 300] [--save-baseline]
+    python benchmark.py startup [--runs 5]
+"""
+import argparse
+import base64
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def make_test_image(size: int = 1024) -> bytes:
+    """Create a deterministic, photo-like PNG similar in size to a provider image."""
+    image = Image.effect_noise((size, size), 40).convert('RGB').filter(ImageFilter.GaussianBlur(1))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, size, max(1, size // 16)):
+        draw.ellipse([i, i // 2, i + size // 5, i // 2 + size // 6], fill=(i % 256, 90, 255 - i % 256))
+    draw.rectangle([0, size - size // 6, size, size], fill=(255, 255, 255))
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+def _email_service():
+    """Build an EmailService without reading SMTP settings from .env."""
+    from email_service import EmailService
+    service = EmailService.__new__(EmailService)
+    service.email_address = "bench@example.com"
+    return service
+
+
+def _pipeline(b64_payload: str, out_dir: Path):
+    """Current pipeline: ImageBuffer from decode to disk and SMTP stream."""
+    import binascii
+    from image_buffer import ImageBuffer, as_view
+    from image_processor import ImageProcessor
+
+    image = ImageBuffer(binascii.a2b_base64(b64_payload))
+    processed = ImageProcessor.process_for_sms(image)
+    with open(out_dir / "current.jpg", 'wb') as f:
+        f.write(as_view(processed))
+    email_service = _email_service()
+    head, tail = email_service._build_message_skeleton("to@example.com")
+    for _ in email_service._stream_message(head, processed, tail):
+        pass
+
+
+def _legacy_pipeline(b64_payload: str, out_dir: Path):
+    """Copy pattern of the pipeline before ImageBuffer, kept as the comparison baseline."""
+    from email import encoders
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+
+    image_bytes = base64.b64decode(b64_payload)
+    image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    output = io.BytesIO()
+    quality = 95
+    while True:
+        output.seek(0)
+        output.truncate(0)
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        if len(output.getvalue()) <= 5 * 1024 * 1024 or quality <= 50:
+            break
+        quality -= 5
+    processed = output.getvalue()
+    with open(out_dir / "legacy.jpg", 'wb') as f:
+        f.write(processed)
+    msg = MIMEMultipart()
+    part = MIMEBase('image', 'jpeg')
+    part.set_payload(processed)
+    encoders.encode_base64(part)
+    msg.attach(part)
+    msg.as_string()
+
+
+def _measure(fn, *args) -> int:
+    """Return peak traced Python allocation (bytes) while running fn."""
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_allocations(size: int, runs: int) -> int:
+    """Compare peak Python allocations per meme for the legacy and current pipelines."""
+    raw = make_test_image(size)
+    b64_payload = base64.b64encode(raw).decode('ascii')
+    print(f"Test image: {size}x{size} PNG, {len(raw)} bytes ({len(b64_payload)} bytes base64)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = Path(tmp)
+        results = {}
+        for name, fn in (("legacy", _legacy_pipeline), ("current", _pipeline)):
+            fn(b64_payload, out_dir)  # Warm up imports and caches outside the measurement
+            peaks = [_measure(fn, b64_payload, out_dir) for _ in range(runs)]
+            results[name] = min(peaks)
+
+    print(f"{'pipeline':<10} {'peak bytes':>12} {'image copies':>13}")
+    for name, peak in results.items():
+        print(f"{name:<10} {peak:>12} {peak / len(raw):>13.2f}")
+    print("(image copies = peak traced Python allocation / raw image size)")
+    return 0
+
+
+def bench_send_memory(size_mb: float, runs: int, max_copies: float) -> int:
+    """
+    Check that EmailService.send_image streams its attachment: the peak traced Python
+    allocation of one send to the local SMTP sink must stay under max_copies raw images.
+    """
+    from benchmark_fakes import SMTPSink
+
+    sink = SMTPSink().start()
+    try:
+        # Set before config is imported, so the caller's .env cannot point the send elsewhere
+        os.environ.update({
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(sink.port),
+            "SMTP_USE_TLS": "false",
+            "EMAIL_ADDRESS": "bench@example.com",
+            "EMAIL_PASSWORD": "bench",
+        })
+        from email_service import EmailService
+        from image_buffer import ImageBuffer
+
+        image = ImageBuffer(os.urandom(int(size_mb * 1024 * 1024)))  # Incompressible, like a JPEG
+        email_service = EmailService(pool_size=1)
+
+        def send():
+            return email_service.send_image(image, recipients=["to@example.com"])
+
+        send()  # Imports and SMTP login outside the measurement; later sends reuse the session
+        peak = min(_measure(send) for _ in range(runs))
+        email_service.close()
+    finally:
+        sink.stop()
+
+    copies = peak / len(image)
+    print(f"Attachment: {len(image)} bytes, {sink.messages} messages ({sink.bytes} bytes) delivered")
+    print(f"Peak traced allocation per send: {peak} bytes ({copies:.2f} image copies, limit {max_copies:.2f})")
+    if copies > max_copies:
+        print("FAIL: send_image holds more of the message in memory than the limit allows")
+        return 1
+    return 0
+
+
+def make_test_background(seed: int, size: int = 1024) -> bytes:
+    """Create a deterministic, soft-focus PNG scene like a generated caption-free background."""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (size, size), (rng.randrange(256),) * 3)
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y, r = rng.randrange(size), rng.randrange(size), rng.randint(size // 16, size // 3)
+        draw.ellipse([x - r, y - r, x + r, y + r], fill=tuple(rng.randrange(256) for _ in range(3)))
+    output = io.BytesIO()
+    image.filter(ImageFilter.GaussianBlur(size // 50)).save(output, format='PNG')
+    return output.getvalue()
+
+
+def bench_composite_distance(backgrounds: int) -> int:
+    """
+    Check that composite memes sharing a background are not near-duplicates: caption
+    every BackgroundLibrary variant of each test background, process it for email
+    like a daily run, and require every pair to differ in more than
+    ARCHIVE_DUPLICATE_DISTANCE dHash bits.
+    """
+    import itertools
+    from archive_index import dhash, hamming
+    from compositor import BackgroundLibrary, composite_meme
+    from config import Config
+    from image_processor import ImageProcessor
+
+    captions = ["Monday coffee hits different", "When the espresso machine breaks",
+                "Decaf? In this economy?", "Third cup before nine", "Oat milk is a lifestyle",
+                "Me pretending the fourth cup is for someone else"]
+    uses = len(BackgroundLibrary.VARIANTS)
+    closest = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for seed in range(backgrounds):
+            library = BackgroundLibrary(Path(tmp) / str(seed), size=1, max_uses=uses)
+            hashes = []
+            for use in range(uses):
+                meme = composite_meme(captions[use % len(captions)], lambda: make_test_background(seed),
+                                      library=library)
+                processed, _ = ImageProcessor.render(meme)["email"]
+                hashes.append(dhash(processed))
+            closest.append(min(hamming(a, b) for a, b in itertools.combinations(hashes, 2)))
+
+    threshold = Config.ARCHIVE_DUPLICATE_DISTANCE
+    print(f"{backgrounds} backgrounds x {uses} uses; closest pair per background (dHash bits): {closest}")
+    print(f"Closest overall: {min(closest)} bits (near-duplicate at or below {threshold})")
+    if min(closest) <= threshold:
+        print("FAIL: composites sharing a background would trip the archive near-duplicate check")
+        return 1
+    return 0
+
+E2E_SCENARIOS = ("single", "batch", "concurrent")
+E2E_PROVIDERS = ("openai", "grok")
+E2E_STAGES = ("caption", "image", "download", "process", "save", "smtp_send", "email")
+E2E_BASELINE = Path(__file__).with_name("benchmark_baseline.json")
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB (None where resource is unavailable, e.g. Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KB on Linux
+
+
+def _percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+
+def e2e_worker(scenario: str, count: int, concurrency: int) -> int:
+    """
+    Run one scenario in this process against the endpoints configured in the environment.
+
+    single: count daily runs (meme_generator.main) back to back
+    batch: one run_batch of count memes with one provider call in flight
+    concurrent: one run_batch of count memes with concurrency calls in flight
+
+    Prints one JSON result line prefixed with BENCH_RESULT.
+    """
+    import logging
+    import meme_generator
+    from config import Config
+
+    logging.getLogger().setLevel(logging.WARNING)
+    started = time.monotonic()
+    if scenario == "single":
+        # Each run queues its meme in the outbox; deliver it like the CLI does before exiting
+        failures = sum(max(meme_generator.main(), meme_generator.deliver_outbox()) != 0 for _ in range(count))
+    else:
+        workers = 1 if scenario == "batch" else concurrency
+        failures = int(meme_generator.run_batch(count, workers, send=True) != 0)
+    elapsed = time.monotonic() - started
+
+    spans = {}
+    with open(Config.RUN_LOG_PATH, 'r', encoding='utf-8') as f:
+        for line in f:
+            for span in json.loads(line)["spans"]:
+                spans.setdefault(span["stage"], []).append(span["seconds"])
+    result = {
+        "memes_per_sec": count / elapsed,
+        "seconds": elapsed,
+        "failures": failures,
+        "peak_rss_mb": _peak_rss_mb(),
+        "stages": {stage: {"p50": _percentile(values, 50), "p95": _percentile(values, 95),
+                           "p99": _percentile(values, 99), "n": len(values)}
+                   for stage, values in spans.items()},
+    }
+    print("BENCH_RESULT " + json.dumps(result))
+    return 0 if failures == 0 else 1
+
+
+def _e2e_env(tmp: Path, provider: str, openai_server, xai_server, sink) -> dict:
+    """Environment for a worker: fake endpoints, no caches/dedupe/rate limits, all state in tmp."""
+    env = dict(os.environ)
+    env.update({
+        "AI_PROVIDER": provider,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": openai_server.base_url,  # Read by the openai SDK itself
+        "XAI_API_KEY": "bench",
+        "XAI_API_HOST": xai_server.api_host,
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(sink.port),
+        "SMTP_USE_TLS": "false",
+        "EMAIL_ADDRESS": "bench@example.com",
+        "EMAIL_PASSWORD": "bench",
+        "RECIPIENT_EMAIL": "group@example.com",
+        "MAX_IMAGE_SIZE_MB": "5.0",
+        "CACHE_ENABLED": "false",
+        "CAPTION_BATCH_SIZE": "0",
+        "CAPTION_SIMILARITY_THRESHOLD": "0",
+        "ARCHIVE_INDEX_ENABLED": "false",
+        "HEDGE_ENABLED": "false",
+        "METRICS_ENABLED": "true",
+        "METRICS_TEXTFILE_PATH": "",
+        "RUN_LOG_PATH": str(tmp / "run_log.jsonl"),
+        "LATENCY_HISTORY_PATH": str(tmp / "provider_latency.json"),
+        "RATE_LIMITS_ENABLED": "false",  # Measure the pipeline, not the configured provider quotas
+        "DAILY_BUDGET_USD": "0",
+        "SPEND_LEDGER_PATH": str(tmp / "spend_ledger.json"),
+        "PYTHONPATH": str(Path(__file__).resolve().parent),
+    })
+    return env
+
+
+def _run_e2e_worker(scenario: str, provider: str, count: int, concurrency: int, servers) -> dict:
+    """Run a scenario in a fresh interpreter (so peak RSS is per scenario) and parse its result."""
+    with tempfile.TemporaryDirectory() as tmp:
+        command = [sys.executable, str(Path(__file__).resolve()), "e2e-worker",
+                   "--scenario", scenario, "--count", str(count), "--concurrency", str(concurrency)]
+        completed = subprocess.run(command, cwd=tmp, env=_e2e_env(Path(tmp), provider, *servers),
+                                   capture_output=True, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith("BENCH_RESULT "):
+            return json.loads(line[len("BENCH_RESULT "):])
+    raise RuntimeError(f"{scenario}/{provider} worker failed:\n{completed.stdout[-2000:]}{completed.stderr[-2000:]}")
+
+
+def _delta(current, baseline) -> str:
+    if current is None or not baseline:
+        return ""
+    return f" ({(current - baseline) / baseline:+.0%})"
+
+
+def bench_e2e(count: int, concurrency: int, latency_ms: float, jitter: float, image_size: int,
+              smtp_latency_ms: float, baseline_path: Path, save_baseline: bool, tolerance: float) -> int:
+    """
+    Drive the full pipeline (provider -> process -> save -> SMTP) against local stand-ins
+    for OpenAI, xAI and an SMTP server, and compare with the stored baseline.
+    """
+    from benchmark_fakes import FakeOpenAIServer, FakeXAIServer, Latency, SMTPSink
+
+    image = make_test_image(image_size)
+    print(f"Fake providers: {latency_ms:.0f} ms +/-{jitter:.0%} latency, {image_size}x{image_size} PNG "
+          f"({len(image)} bytes); SMTP sink: {smtp_latency_ms:.0f} ms per message")
+    openai_server = FakeOpenAIServer(image, Latency(latency_ms / 1000, jitter)).start()
+    xai_server = FakeXAIServer(openai_server.image_url, image, Latency(latency_ms / 1000, jitter, seed=2)).start()
+    sink = SMTPSink(Latency(smtp_latency_ms / 1000)).start()
+    servers = (openai_server, xai_server, sink)
+
+    results = {}
+    try:
+        for provider in E2E_PROVIDERS:
+            for scenario in E2E_SCENARIOS:
+                key = f"{scenario}/{provider}"
+                results[key] = _run_e2e_worker(scenario, provider, count, concurrency, servers)
+                print(f"  finished {key}: {results[key]['memes_per_sec']:.2f} memes/s")
+    finally:
+        openai_server.stop()
+        xai_server.stop()
+        sink.stop()
+
+    baseline = {}
+    if baseline_path.exists():
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f).get("results", {})
+
+    print(f"\n{'scenario':<20} {'memes/s':>16} {'peak RSS MB':>18} {'failures':>9}")
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key, {})
+        rss = result["peak_rss_mb"]
+        rss_text = "n/a" if rss is None else f"{rss:.1f}{_delta(rss, base.get('peak_rss_mb'))}"
+        print(f"{key:<20} {result['memes_per_sec']:>7.2f}{_delta(result['memes_per_sec'], base.get('memes_per_sec')):>9} "
+              f"{rss_text:>18} {result['failures']:>9}")
+        if base.get("memes_per_sec") and result["memes_per_sec"] < base["memes_per_sec"] * (1 - tolerance):
+            regressions.append(f"{key} throughput")
+        if rss and base.get("peak_rss_mb") and rss > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{key} peak RSS")
+
+    print(f"\n{'scenario':<20} {'stage':<10} {'p50 ms':>14} {'p95 ms':>9} {'p99 ms':>9} {'n':>5}")
+    for key, result in results.items():
+        for stage in E2E_STAGES:
+            row = result["stages"].get(stage)
+            if row is None:
+                continue
+            base_p50 = baseline.get(key, {}).get("stages", {}).get(stage, {}).get("p50")
+            print(f"{key:<20} {stage:<10} {row['p50'] * 1000:>6.1f}{_delta(row['p50'], base_p50):>8} "
+                  f"{row['p95'] * 1000:>9.1f} {row['p99'] * 1000:>9.1f} {row['n']:>5}")
+
+    if save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump({"settings": {"count": count, "concurrency": concurrency, "latency_ms": latency_ms,
+                                    "image_size": image_size, "smtp_latency_ms": smtp_latency_ms},
+                       "results": results}, f, indent=2)
+        print(f"\nBaseline saved to {baseline_path}")
+    elif not baseline:
+        print(f"\nNo baseline at {baseline_path} (run with --save-baseline to store one)")
+    if any(result["failures"] for result in results.values()):
+        print("FAILED: some memes were not generated or sent")
+        return 1
+    if regressions and not save_baseline:
+        print(f"REGRESSION (beyond {tolerance:.0%}): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+# Import statements for the startup benchmark: (name, code run with -X importtime)
+STARTUP_CASES = (
+    ("cli only", "import meme_generator"),
+    ("daily openai", "import meme_generator, providers, image_processor, email_service; "
+                     "providers.service_class('openai')"),
+    ("daily grok", "import meme_generator, providers, image_processor, email_service; "
+                   "providers.service_class('grok')"),
+    # What every run imported before providers were loaded lazily
+    ("eager (before)", "import meme_generator, openai_service, grok_service, image_processor, "
+                       "email_service, image_hosting"),
+)
+
+
+def _import_times(code: str) -> tuple:
+    """
+    Run code in a fresh interpreter with -X importtime.
+
+    Returns:
+        tuple: (total import ms excluding interpreter startup, wall ms,
+                {module imported directly by the code's imports: cumulative ms})
+    """
+    with tempfile.TemporaryDirectory() as tmp:  # meme_generator creates its log file in the cwd
+        env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent))
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                   cwd=tmp, env=env, capture_output=True, text=True)
+        wall_ms = (time.perf_counter() - started) * 1000
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr[-2000:])
+    total = 0.0
+    modules = {}
+    after_site = False
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if after_site and depth == 0:
+            total += int(cumulative) / 1000
+        elif after_site and depth == 1:
+            modules[name] = modules.get(name, 0) + int(cumulative) / 1000
+        after_site = after_site or (depth == 0 and name == "site")
+    return total, wall_ms, modules
+
+
+def bench_startup(runs: int) -> int:
+    """Compare cold-start import cost of the lazy provider registry with eager imports."""
+    print(f"Cold-start imports, median of {runs} fresh interpreters (-X importtime):")
+    print(f"{'case':<16} {'imports ms':>11} {'process ms':>11}")
+    slowest = {}
+    for name, code in STARTUP_CASES:
+        samples = [_import_times(code) for _ in range(runs)]
+        imports = sorted(sample[0] for sample in samples)[runs // 2]
+        wall = sorted(sample[1] for sample in samples)[runs // 2]
+        print(f"{name:<16} {imports:>11.1f} {wall:>11.1f}")
+        if name == "cli only":
+            slowest = samples[runs // 2][2]
+    print("\nSlowest imports for 'cli only' (modules imported by meme_generator's own imports):")
+    for module, ms in sorted(slowest.items(), key=lambda item: -item[1])[:8]:
+        print(f"  {module:<24} {ms:>8.1f} ms")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the coffee meme pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    allocations = subparsers.add_parser("allocations", help="Peak Python allocations per meme")
+    allocations.add_argument("--size", type=int, default=1024, help="Test image width/height in pixels")
+    allocations.add_argument("--runs", type=int, default=3, help="Measured runs (best is reported)")
+
+    send_memory = subparsers.add_parser("send-memory", help="Peak Python allocations of one email send (fails over a limit)")
+    send_memory.add_argument("--size-mb", type=float, default=4, help="Attachment size in MB")
+    send_memory.add_argument("--runs", type=int, default=3, help="Measured sends (best is reported)")
+    send_memory.add_argument("--max-copies", type=float, default=1.0,
+                             help="Allowed peak allocation, in multiples of the attachment size")
+
+    composite = subparsers.add_parser("composite-distance",
+                                      help="dHash distance between composites sharing a background (fails if near-duplicate)")
+    composite.add_argument("--backgrounds", type=int, default=10, help="Test backgrounds to caption")
+
+    e2e = subparsers.add_parser("e2e", help="End-to-end throughput/latency against local fake providers and SMTP")
+    e2e.add_argument("--count", type=int, default=10, help="Memes per scenario")
+    e2e.add_argument("--concurrency", type=int, default=4, help="Provider calls in flight for the concurrent scenario")
+    e2e.add_argument("--latency-ms", type=float, default=300, help="Fake provider latency per request")
+    e2e.add_argument("--jitter", type=float, default=0.2, help="Uniform latency jitter as a fraction (0.2 = +/-20%%)")
+    e2e.add_argument("--image-size", type=int, default=1024, help="Width/height of the fake provider image")
+    e2e.add_argument("--smtp-latency-ms", type=float, default=20, help="SMTP sink delay per message")
+    e2e.add_argument("--baseline", type=Path, default=E2E_BASELINE, help="Baseline file to compare with")
+    e2e.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    e2e.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression before failing (0.2 = 20%%)")
+
+    startup = subparsers.add_parser("startup", help="Cold-start import time (lazy vs eager provider imports)")
+    startup.add_argument("--runs", type=int, default=5, help="Fresh interpreters per case (median is reported)")
+
+    worker = subparsers.add_parser("e2e-worker", help=argparse.SUPPRESS)
+    worker.add_argument("--scenario", choices=E2E_SCENARIOS, required=True)
+    worker.add_argument("--count", type=int, required=True)
+    worker.add_argument("--concurrency", type=int, required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == "allocations":
+        return bench_allocations(args.size, args.runs)
+    if args.command == "send-memory":
+        return bench_send_memory(args.size_mb, args.runs, args.max_copies)
+    if args.command == "composite-distance":
+        return bench_composite_distance(args.backgrounds)
+    if args.command == "e2e":
+        return bench_e2e(args.count, args.concurrency, args.latency_ms, args.jitter, args.image_size,
+                         args.smtp_latency_ms, args.baseline, args.save_baseline, args.tolerance)
+    if args.command == "startup":
+        return bench_startup(args.runs)
+    if args.command == "e2e-worker":
+        return e2e_worker(args.scenario, args.count, args.concurrency)
+    return 1
+
+
+if __name__ == "__main__":
+    # Keep the benchmark independent of the caller's .env limits
+    os.environ.setdefault("MAX_IMAGE_SIZE_MB", "5.0")
+    sys.exit(main())
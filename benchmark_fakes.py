@@ -0,0 +1,235 @@
+"""Local stand-ins for the OpenAI API, the xAI image API and an SMTP server, used by benchmark.py.
+
+All three listen on 127.0.0.1 with an OS-assigned port, run on daemon threads and
+sleep for a configurable latency before answering, so the pipeline can be
+measured offline with realistic provider timing and payload sizes.
+"""
+import base64
+import json
+import random
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Latency:
+    """Seconds to wait per request: a base latency with uniform +/- jitter."""
+
+    def __init__(self, seconds: float = 0.0, jitter: float = 0.0, seed: int = 1):
+        self.seconds = seconds
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.seconds <= 0:
+            return
+        with self._lock:
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+        time.sleep(self.seconds * factor)
+
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOpenAI/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj: dict):
+        self._send(200, json.dumps(obj).encode("utf-8"))
+
+    def do_POST(self):
+        fake = self.server.fake
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        fake.latency.wait()
+        if self.path.endswith("/chat/completions"):
+            choices = []
+            for index in range(request.get("n") or 1):
+                choices.append({
+                    "index": index,
+                    "message": {"role": "assistant", "content": f"Benchmark caption #{fake.next_id()}"},
+                    "finish_reason": "stop",
+                })
+            self._send_json({
+                "id": f"chatcmpl-{fake.next_id()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": choices,
+                "usage": {"prompt_tokens": 50, "completion_tokens": 20, "total_tokens": 70},
+            })
+        elif self.path.endswith("/images/generations"):
+            if request.get("response_format") == "url" or not str(request.get("model", "")).startswith("gpt-image"):
+                items = [{"url": fake.image_url} for _ in range(request.get("n") or 1)]
+            else:
+                items = [{"b64_json": fake.image_b64} for _ in range(request.get("n") or 1)]
+            self._send_json({"created": int(time.time()), "data": items})
+        else:
+            self._send(404, b'{"error": {"message": "not found"}}')
+
+    def do_GET(self):
+        fake = self.server.fake
+        if self.path.startswith("/images/"):
+            self._send(200, fake.image, "image/png")
+        elif self.path.endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": "gpt-image-1", "object": "model", "owned_by": "fake"}]})
+        else:
+            self._send(404, b"not found", "text/plain")
+
+
+class FakeOpenAIServer:
+    """
+    OpenAI-compatible chat completions and image generations endpoints.
+
+    gpt-image models get inline b64_json; DALL-E models get a URL served by the
+    same server (GET /images/<id>), which also backs the fake xAI image URLs.
+    """
+
+    def __init__(self, image: bytes, latency: Latency = None):
+        self.image = image
+        self.image_b64 = base64.b64encode(image).decode("ascii")
+        self.latency = latency or Latency()
+        self._ids = 0
+        self._ids_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _OpenAIHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self.base_url = f"http://127.0.0.1:{self.port}/v1"
+        self.image_url = f"http://127.0.0.1:{self.port}/images/meme.png"
+
+    def next_id(self) -> int:
+        with self._ids_lock:
+            self._ids += 1
+            return self._ids
+
+    def start(self) -> "FakeOpenAIServer":
+        threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeXAIServer:
+    """xAI gRPC Image service returning image URLs (the SDK's default format) or inline base64, plus model listing."""
+
+    def __init__(self, image_url: str, image: bytes, latency: Latency = None, inline: bool = False):
+        import grpc
+        from xai_sdk.proto import image_pb2, image_pb2_grpc, models_pb2, models_pb2_grpc
+
+        fake = self
+        self.image_url = image_url
+        self.image_b64 = "data:image/png;base64," + base64.b64encode(image).decode("ascii")
+        self.latency = latency or Latency()
+        self.inline = inline
+
+        class ImageServicer(image_pb2_grpc.ImageServicer):
+            def GenerateImage(self, request, context):
+                fake.latency.wait()
+                if fake.inline:
+                    image = image_pb2.GeneratedImage(base64=fake.image_b64, respect_moderation=True)
+                else:
+                    image = image_pb2.GeneratedImage(url=fake.image_url, respect_moderation=True)
+                return image_pb2.ImageResponse(model=request.model, images=[image] * max(1, request.n))
+
+        class ModelsServicer(models_pb2_grpc.ModelsServicer):
+            def ListImageGenerationModels(self, request, context):
+                model = models_pb2.ImageGenerationModel(name="grok-imagine-image")
+                return models_pb2.ListImageGenerationModelsResponse(models=[model])
+
+        self._server = grpc.server(ThreadPoolExecutor(max_workers=16))
+        image_pb2_grpc.add_ImageServicer_to_server(ImageServicer(), self._server)
+        models_pb2_grpc.add_ModelsServicer_to_server(ModelsServicer(), self._server)
+        # The SDK uses local (unencrypted loopback) channel credentials for "localhost:" hosts
+        credentials = grpc.local_server_credentials(grpc.LocalConnectionType.LOCAL_TCP)
+        self.port = self._server.add_secure_port("localhost:0", credentials)
+        self.api_host = f"localhost:{self.port}"
+
+    def start(self) -> "FakeXAIServer":
+        self._server.start()
+        return self
+
+    def stop(self):
+        self._server.stop(grace=None)
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Minimal ESMTP dialogue: accepts AUTH, any sender/recipient and discards the data."""
+
+    def _reply(self, line: str):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        self._reply("220 sink ESMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb == b"EHLO":
+                self.wfile.write(b"250-sink\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 104857600\r\n")
+            elif verb == b"HELO":
+                self._reply("250 sink")
+            elif verb == b"AUTH":
+                self._reply("235 2.7.0 Authentication successful")
+            elif verb in (b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self._reply("250 OK")
+            elif verb == b"DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                sink.latency.wait()
+                sink.record(size)
+                self._reply("250 OK queued")
+            elif verb == b"QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """Local SMTP server that accepts every message and counts messages and bytes."""
+
+    def __init__(self, latency: Latency = None):
+        self.latency = latency or Latency()
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingTCPServer(("127.0.0.1", 0), _SMTPSinkHandler)
+        self._server.sink = self
+        self.port = self._server.server_address[1]
+
+    def record(self, size: int):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def start(self) -> "SMTPSink":
+        threading.Thread(target=self._server.serve_forever, name="smtp-sink", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,146 @@
+"""Near-duplicate detection for meme captions (MinHash + LSH over send history)."""
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from pathlib import Path
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+# MinHash/LSH parameters: 20 bands of 3 rows make Jaccard-0.6 pairs candidates ~99% of the time
+LSH_BANDS = 20
+LSH_ROWS_PER_BAND = 3
+# Each MinHash function XORs a 64-bit shingle hash with a fixed random mask (one builtin
+# op per shingle, so a signature costs well under a millisecond in pure Python).
+# Fixed seed: stored band hashes must stay comparable across runs.
+_rng = random.Random(20240901)
+_MINHASH_MASKS = [_rng.getrandbits(64) for _ in range(LSH_BANDS * LSH_ROWS_PER_BAND)]
+
+
+def caption_shingles(text: str) -> set:
+    """Character trigrams of a caption, normalized for case and punctuation."""
+    normalized = " " + _NON_ALNUM.sub(" ", text.lower()).strip() + " "
+    if len(normalized) <= 3:
+        return {normalized}
+    return {normalized[i:i + 3] for i in range(len(normalized) - 2)}
+
+
+def jaccard(a: set, b: set) -> float:
+    """Jaccard similarity of two shingle sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class CaptionIndex:
+    """
+    Index of previously used captions for fast near-duplicate checks.
+
+    Each caption gets a MinHash signature over its character trigrams, split into
+    LSH bands. A lookup only compares against captions sharing at least one band
+    bucket, then confirms with exact trigram Jaccard, so query time stays flat as
+    history grows. History is an append-only JSON-lines file storing each
+    caption with its band hashes, so loading does not recompute signatures.
+    """
+
+    NUM_BANDS = LSH_BANDS
+    ROWS_PER_BAND = LSH_ROWS_PER_BAND
+    MAX_VERIFIED_CANDIDATES = 8  # Exact Jaccard checks per lookup
+
+    def __init__(self, path: str = None, threshold: float = None):
+        """
+        Load the caption history.
+
+        Args:
+            path: History file (defaults to CAPTION_HISTORY_PATH from config)
+            threshold: Jaccard similarity at or above which a caption is a repeat
+                       (defaults to CAPTION_SIMILARITY_THRESHOLD from config)
+        """
+        self.path = Path(path or Config.CAPTION_HISTORY_PATH)
+        self.threshold = threshold if threshold is not None else Config.CAPTION_SIMILARITY_THRESHOLD
+        self._texts = []
+        self._buckets = defaultdict(list)  # band hash -> caption ids
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        started = time.perf_counter()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping corrupt caption history line: {line[:60]!r}")
+                    continue
+                bands = record.get("bands") or self.band_hashes(record["text"])
+                self._insert(record["text"], bands)
+        logger.debug(f"Loaded {len(self._texts)} captions in {time.perf_counter() - started:.3f}s")
+
+    @classmethod
+    def band_hashes(cls, text: str) -> list:
+        """MinHash signature of a caption, folded into one hash per LSH band."""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+            for shingle in caption_shingles(text)
+        ]
+        signature = [min(map(mask.__xor__, hashes)) for mask in _MINHASH_MASKS]
+        rows = cls.ROWS_PER_BAND
+        return [hash((band,) + tuple(signature[band * rows:(band + 1) * rows])) for band in range(cls.NUM_BANDS)]
+
+    def _insert(self, text: str, bands: list):
+        caption_id = len(self._texts)
+        self._texts.append(text)
+        for band_hash in bands:
+            self._buckets[band_hash].append(caption_id)
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def most_similar(self, text: str) -> tuple:
+        """
+        Find the most similar past caption.
+
+        Returns:
+            tuple: (similarity, past caption), or (0.0, None) if nothing shares a bucket
+        """
+        shared = Counter()
+        for band_hash in self.band_hashes(text):
+            shared.update(self._buckets.get(band_hash, ()))
+        if not shared:
+            return 0.0, None
+        # Shared band count tracks similarity, so only the top candidates need exact checks
+        shingles = caption_shingles(text)
+        best = (0.0, None)
+        for caption_id, _ in shared.most_common(self.MAX_VERIFIED_CANDIDATES):
+            similarity = jaccard(shingles, caption_shingles(self._texts[caption_id]))
+            if similarity > best[0]:
+                best = (similarity, self._texts[caption_id])
+        return best
+
+    def is_repeat(self, text: str) -> bool:
+        """True if text is at or above the similarity threshold to a past caption."""
+        similarity, match = self.most_similar(text)
+        if similarity >= self.threshold:
+            logger.info(f"Caption {text!r} is {similarity:.0%} similar to past caption {match!r}")
+            return True
+        return False
+
+    def add(self, text: str):
+        """Record a caption in the index and append it to the history file."""
+        bands = self.band_hashes(text)
+        self._insert(text, bands)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        record = {"text": text, "used": datetime.now().isoformat(), "bands": bands}
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,94 @@
+"""Persistent FIFO queue of pre-generated meme captions."""
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_json, file_lock
+
+logger = logging.getLogger(__name__)
+
+
+class CaptionQueue:
+    """
+    Captions generated in bulk and consumed one per meme, oldest first.
+
+    Stored as a JSON file replaced atomically under a lock file. Each entry
+    records the style it was written for, and only captions matching the
+    requested style are handed out.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Initialize the queue.
+
+        Args:
+            path: Queue file (defaults to CAPTION_QUEUE_PATH from config)
+        """
+        self.path = Path(path or Config.CAPTION_QUEUE_PATH)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+
+    def _read(self) -> list:
+        if not self.path.exists():
+            return []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f).get("captions", [])
+
+    def _write(self, entries: list):
+        atomic_write_json(self.path, {"captions": entries})
+
+    def push(self, captions: list, style: str = None) -> int:
+        """
+        Append captions to the back of the queue, skipping ones already queued.
+
+        Args:
+            captions: Caption strings
+            style: Meme style they were written for (defaults to MEME_STYLE)
+
+        Returns:
+            int: Number of captions added
+        """
+        style = style or Config.MEME_STYLE
+        with file_lock(self.lock_path):
+            entries = self._read()
+            queued = {entry["text"] for entry in entries}
+            added = 0
+            now = datetime.now().isoformat()
+            for text in captions:
+                if text and text not in queued:
+                    entries.append({"text": text, "style": style, "created": now})
+                    queued.add(text)
+                    added += 1
+            self._write(entries)
+        logger.info(f"Queued {added} captions ({len(entries)} in queue)")
+        return added
+
+    def pop(self, count: int = 1, style: str = None) -> list:
+        """
+        Remove and return up to count of the oldest captions for a style.
+
+        Args:
+            count: Maximum number of captions to take
+            style: Meme style to match (defaults to MEME_STYLE)
+
+        Returns:
+            list: Caption strings (empty if none are queued for the style)
+        """
+        style = style or Config.MEME_STYLE
+        with file_lock(self.lock_path):
+            entries = self._read()
+            taken, kept = [], []
+            for entry in entries:
+                if len(taken) < count and entry.get("style") == style:
+                    taken.append(entry["text"])
+                else:
+                    kept.append(entry)
+            if taken:
+                self._write(kept)
+        if taken:
+            logger.info(f"Took {len(taken)} caption(s) from queue ({len(kept)} left)")
+        return taken
+
+    def __len__(self) -> int:
+        with file_lock(self.lock_path):
+            return len(self._read())
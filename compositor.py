@@ -0,0 +1,265 @@
+"""Local caption compositing: meme captions drawn with Pillow over a reusable library of generated backgrounds."""
+import functools
+import io
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_bytes, atomic_write_json, file_lock
+from image_buffer import ImageBuffer, as_view
+import run_metrics
+
+logger = logging.getLogger(__name__)
+
+# Bold fonts tried in order when CAPTION_FONT_PATH is not set (Pillow searches the system font folders)
+FALLBACK_FONTS = ("impact.ttf", "Impact.ttf", "arialbd.ttf", "Arial Bold.ttf", "DejaVuSans-Bold.ttf",
+                  "LiberationSans-Bold.ttf", "FreeSansBold.ttf")
+
+
+@functools.lru_cache(maxsize=1)
+def _font_path(configured: str):
+    """The first usable caption font (None = Pillow's built-in font)."""
+    from PIL import ImageFont
+
+    for candidate in ((configured,) if configured else ()) + FALLBACK_FONTS:
+        try:
+            ImageFont.truetype(candidate, 12)
+            return candidate
+        except OSError:
+            continue
+    logger.warning("No caption font found, using Pillow's built-in font (set CAPTION_FONT_PATH)")
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def _font(path: str, size: int):
+    """A loaded font; fitting a caption tries several sizes, so parsed fonts are kept."""
+    from PIL import ImageFont
+
+    if path is None:
+        return ImageFont.load_default(size=size)
+    return ImageFont.truetype(path, size)
+
+
+class CaptionRenderer:
+    """
+    Draws a classic meme caption: white capitals with a black outline, wrapped and
+    sized to fit a band along the bottom of the image.
+    """
+
+    MARGIN = 0.04  # Of the image width, on every side
+    BAND_HEIGHT = 0.32  # Tallest caption block, as a fraction of the image height
+    MAX_FONT = 0.11  # Largest font size, as a fraction of the image height
+    MIN_FONT = 0.035
+    SHRINK = 0.9  # Font size step while fitting
+    LINE_SPACING = 1.1
+    STROKE = 0.08  # Outline width, as a fraction of the font size
+
+    def __init__(self, font_path: str = None):
+        """
+        Args:
+            font_path: TrueType/OpenType font (defaults to CAPTION_FONT_PATH, then common bold fonts)
+        """
+        self.font_path = _font_path(font_path or Config.CAPTION_FONT_PATH)
+
+    @staticmethod
+    def _wrap(words: list, font, max_width: float) -> list:
+        """Greedy word wrap; a word wider than max_width gets a line of its own."""
+        lines = []
+        line = ""
+        for word in words:
+            candidate = f"{line} {word}" if line else word
+            if line and font.getlength(candidate) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        if line:
+            lines.append(line)
+        return lines
+
+    def fit(self, text: str, width: int, height: int) -> tuple:
+        """
+        Largest font size whose wrapped caption fits the caption band.
+
+        Returns:
+            tuple: (font, lines, line height in pixels)
+        """
+        words = text.upper().split()
+        max_width = width * (1 - 2 * self.MARGIN)
+        max_height = height * self.BAND_HEIGHT
+        size = max(1, int(height * self.MAX_FONT))
+        min_size = max(1, int(height * self.MIN_FONT))
+        while True:
+            font = _font(self.font_path, size)
+            lines = self._wrap(words, font, max_width)
+            ascent, descent = font.getmetrics()
+            line_height = int((ascent + descent) * self.LINE_SPACING)
+            fits = line_height * len(lines) <= max_height and all(font.getlength(line) <= max_width for line in lines)
+            if fits or size <= min_size:
+                return font, lines, line_height
+            size = max(min_size, int(size * self.SHRINK))
+
+    def draw(self, image, text: str):
+        """Draw text onto an RGB image in place."""
+        from PIL import ImageDraw
+
+        width, height = image.size
+        font, lines, line_height = self.fit(text, width, height)
+        stroke = max(2, round(font.size * self.STROKE)) if hasattr(font, "size") else 2
+        y = height - int(width * self.MARGIN) - line_height * len(lines)
+        draw = ImageDraw.Draw(image)
+        for line in lines:
+            draw.text((width / 2, y), line, font=font, fill="white", anchor="ma",
+                      stroke_width=stroke, stroke_fill="black")
+            y += line_height
+
+
+class BackgroundLibrary:
+    """
+    Caption-free meme backgrounds kept on disk and reused across memes.
+
+    Each use picks the least-used background and shows it as a different variant
+    (plain, mirrored, or zoomed into one of two corners), so memes sharing a
+    background stay outside the archive's near-duplicate distance. A background
+    is retired after BACKGROUND_MAX_USES uses (at most one per variant), and the
+    library asks for a new one while it holds fewer than BACKGROUND_LIBRARY_SIZE,
+    so generation runs about once every BACKGROUND_MAX_USES memes.
+    """
+
+    MANIFEST_NAME = "manifest.json"
+    LOCK_NAME = "backgrounds.lock"
+    # (mirrored, zoom, crop anchor x, crop anchor y) per use; a zoomed variant crops zoom of
+    # each side at the anchor and scales it back up. Every pair differs in well over
+    # ARCHIVE_DUPLICATE_DISTANCE dHash bits once captioned (benchmark.py composite-distance)
+    VARIANTS = ((False, 1.0, 0.0, 0.0), (True, 1.0, 0.0, 0.0),
+                (False, 0.7, 1.0, 0.0), (True, 0.7, 1.0, 0.0),
+                (False, 0.7, 0.0, 1.0), (True, 0.7, 0.0, 1.0))
+
+    def __init__(self, directory: str = None, size: int = None, max_uses: int = None):
+        """
+        Args:
+            directory: Library directory (defaults to BACKGROUND_DIR from config)
+            size: Backgrounds to keep (defaults to BACKGROUND_LIBRARY_SIZE from config)
+            max_uses: Uses before a background is retired (defaults to BACKGROUND_MAX_USES,
+                      capped at one use per variant)
+        """
+        self.directory = Path(directory or Config.BACKGROUND_DIR)
+        self.size = size if size is not None else Config.BACKGROUND_LIBRARY_SIZE
+        self.max_uses = min(max_uses if max_uses is not None else Config.BACKGROUND_MAX_USES, len(self.VARIANTS))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.directory / self.MANIFEST_NAME
+        self.lock_path = self.directory / self.LOCK_NAME
+        self._lock = threading.Lock()
+
+    def _read_manifest(self) -> list:
+        """Manifest entries whose image file still exists."""
+        if not self.manifest_path.exists():
+            return []
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f).get("backgrounds", [])
+        return [entry for entry in entries if (self.directory / entry["file"]).exists()]
+
+    def __len__(self) -> int:
+        with self._lock, file_lock(self.lock_path):
+            return len(self._read_manifest())
+
+    def needs_refresh(self) -> bool:
+        """True while the library holds fewer backgrounds than it should."""
+        return len(self) < self.size
+
+    def add(self, image_bytes) -> str:
+        """Add a generated background; returns its file name."""
+        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.png"
+        atomic_write_bytes(self.directory / filename, as_view(image_bytes))
+        with self._lock, file_lock(self.lock_path):
+            entries = self._read_manifest()
+            entries.append({"file": filename, "created": datetime.now().isoformat(), "uses": 0})
+            atomic_write_json(self.manifest_path, {"backgrounds": entries})
+        logger.info(f"Added background {filename} ({len(entries)} in library)")
+        return filename
+
+    def take(self, prefer: str = None):
+        """
+        Use a background: the preferred one if given (e.g. just generated), else the least used.
+
+        Returns:
+            tuple: (PIL RGB image, variant index), or None if the library is empty
+        """
+        from PIL import Image
+
+        with self._lock, file_lock(self.lock_path):
+            entries = self._read_manifest()
+            if not entries:
+                return None
+            entry = next((e for e in entries if e["file"] == prefer), None) or min(entries, key=lambda e: e["uses"])
+            path = self.directory / entry["file"]
+            with Image.open(path) as source:
+                image = source.convert("RGB")
+            variant = entry["uses"] % len(self.VARIANTS)
+            entry["uses"] += 1
+            if entry["uses"] >= self.max_uses:
+                entries.remove(entry)
+                retired = path
+            else:
+                retired = None
+            atomic_write_json(self.manifest_path, {"backgrounds": entries})
+        if retired is not None:
+            retired.unlink()
+            logger.info(f"Retired background {entry['file']} after {entry['uses']} uses")
+        return self.apply_variant(image, variant), variant
+
+    @classmethod
+    def apply_variant(cls, image, variant: int):
+        """Return the given VARIANTS view of a background, at the background's size."""
+        from PIL import Image, ImageOps
+
+        mirrored, zoom, anchor_x, anchor_y = cls.VARIANTS[variant]
+        if zoom < 1:
+            width, height = image.size
+            crop_width, crop_height = int(width * zoom), int(height * zoom)
+            left, top = int((width - crop_width) * anchor_x), int((height - crop_height) * anchor_y)
+            image = image.resize((width, height), Image.Resampling.LANCZOS,
+                                 box=(left, top, left + crop_width, top + crop_height))
+        return ImageOps.mirror(image) if mirrored else image
+
+
+def composite_meme(caption: str, generate_background, library: BackgroundLibrary = None,
+                   renderer: CaptionRenderer = None) -> ImageBuffer:
+    """
+    Draw a caption over a library background, generating a background first when
+    the library is empty or below its size.
+
+    Args:
+        caption: Meme caption
+        generate_background: Callable returning a new caption-free background image
+        library: Background library (defaults to the configured one)
+        renderer: Caption renderer (defaults to the configured font)
+
+    Returns:
+        ImageBuffer: The composited meme as a fast-compressed PNG (re-encoded by ImageProcessor)
+    """
+    if library is None:  # Not `or`: an empty library is falsy (__len__)
+        library = BackgroundLibrary()
+    fresh = None
+    if library.needs_refresh():
+        logger.info("Generating a new meme background for the library...")
+        with run_metrics.span("background"):
+            fresh = library.add(generate_background())
+        run_metrics.count("backgrounds_generated")
+    with run_metrics.span("composite") as span:
+        taken = library.take(prefer=fresh)
+        if taken is None:
+            raise RuntimeError(f"Background library {library.directory}/ is empty (BACKGROUND_LIBRARY_SIZE=0?)")
+        background, variant = taken
+        (renderer or CaptionRenderer()).draw(background, caption)
+        output = io.BytesIO()
+        # Decoded again right away by ImageProcessor, so spend no time compressing
+        background.save(output, format='PNG', compress_level=1)
+        span.update(bytes=output.tell(), variant=variant, reused=fresh is None)
+    logger.info(f"Composited caption over {'a new' if fresh else 'a library'} background")
+    return ImageBuffer(output)
+
@@ -1,9 +1,15 @@
 """Configuration management for Coffee Meme Generator."""
+import importlib.util
 import os
-from dotenv import load_dotenv
+from dotenv import dotenv_values, find_dotenv, load_dotenv
+
+# Variables set by the process environment itself take precedence over .env, also on reload
+_PROCESS_ENV = frozenset(os.environ)
 
 # Load environment variables from .env file
-load_dotenv()
+ENV_FILE = find_dotenv()  # "" if there is no .env file
+load_dotenv(ENV_FILE or None)
+_dotenv_keys = set(dotenv_values(ENV_FILE)) - _PROCESS_ENV if ENV_FILE else set()
 
 
 class Config:
@@ -19,6 +25,7 @@ class Config:
     
     # Grok / xAI Configuration (used when AI_PROVIDER=grok)
     XAI_API_KEY = os.getenv("XAI_API_KEY")
+    XAI_API_HOST = os.getenv("XAI_API_HOST", "api.x.ai")  # gRPC API host (localhost:<port> for a local stand-in)
     GROK_TEXT_MODEL = os.getenv("GROK_TEXT_MODEL", "grok-2-latest")  # e.g. grok-2-latest, grok-3-mini
     GROK_IMAGE_MODEL = os.getenv("GROK_IMAGE_MODEL", "grok-imagine-image")
     GROK_ASPECT_RATIO = os.getenv("GROK_ASPECT_RATIO", "1:1")  # 1:1, 16:9, 9:16, 4:3, 3:4, etc.
@@ -31,6 +38,27 @@ class Config:
     EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")  # Your email address
     EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")  # Your email password or app password
     RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL")  # Recipient email address(es), comma-separated for multiple
+    SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))  # Seconds for connect and each SMTP command
+    SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "1"))  # Concurrent SMTP sessions used for chunked sends
+    SMTP_KEEPALIVE_SECONDS = float(os.getenv("SMTP_KEEPALIVE_SECONDS", "60"))  # Reuse idle sessions up to this age
+    SMTP_RECIPIENTS_PER_MESSAGE = int(os.getenv("SMTP_RECIPIENTS_PER_MESSAGE", "50"))  # Larger lists are sent as BCC batches
+    
+    # Outbox: daily memes are queued on disk and delivered with retries, so a failing relay never loses a meme
+    OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").strip().lower() == "true"
+    OUTBOX_DIR = os.getenv("OUTBOX_DIR", "outbox")
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))  # Attempts before a meme is moved to outbox/dead
+    OUTBOX_RETRY_SECONDS = float(os.getenv("OUTBOX_RETRY_SECONDS", "30"))  # First retry delay, doubled per attempt
+    OUTBOX_MAX_RETRY_SECONDS = float(os.getenv("OUTBOX_MAX_RETRY_SECONDS", "3600"))  # Longest retry delay
+    OUTBOX_DRAIN_SECONDS = float(os.getenv("OUTBOX_DRAIN_SECONDS", "120"))  # A one-off run waits this long for delivery
+    OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))  # How often the daemon's worker checks for memes
+    
+    # HTTP transport shared by provider downloads and image hosting
+    HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))  # Seconds to establish a connection
+    HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))  # Seconds to wait between bytes (image generation is slow)
+    HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))  # Retries for connection errors and 429/5xx responses
+    HTTP_BACKOFF_SECONDS = float(os.getenv("HTTP_BACKOFF_SECONDS", "0.5"))  # Exponential backoff base between retries
+    HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))  # Keep-alive connections per host
+    HTTP_MAX_DOWNLOAD_MB = float(os.getenv("HTTP_MAX_DOWNLOAD_MB", "50"))  # Downloads larger than this are aborted
     
     # Image Generation Parameters
     # Pricing for various models: https://developers.openai.com/api/docs/pricing/
@@ -39,15 +67,114 @@ class Config:
     IMAGE_SIZE = os.getenv("IMAGE_SIZE", "1024x1024")  # Default: 1024x1024
     IMAGE_QUALITY = os.getenv("IMAGE_QUALITY", "low")  # standard or hd
     MAX_IMAGE_SIZE_MB = float(os.getenv("MAX_IMAGE_SIZE_MB", "5.0"))  # Email attachment size limit (typically 25MB, but 5MB is safer)
+    MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "50000000"))  # Larger decoded images are refused (decompression bomb guard)
+    IMAGE_RENDITIONS = os.getenv("IMAGE_RENDITIONS", "")  # Extra variants saved with each meme, e.g. mms:640:jpeg:300,thumb:256:jpeg,web:1200:webp
     
     # Meme Generation Parameters
     MEME_STYLE = os.getenv("MEME_STYLE", "funny")  # funny, motivational, relatable, etc.
+    CAPTION_BATCH_SIZE = int(os.getenv("CAPTION_BATCH_SIZE", "30"))  # Captions per bulk request (0 = one request per caption)
+    CAPTION_QUEUE_PATH = os.getenv("CAPTION_QUEUE_PATH", "caption_queue.json")  # Queue of pre-generated captions
+    CAPTION_HISTORY_PATH = os.getenv("CAPTION_HISTORY_PATH", "caption_history.jsonl")  # Every caption used so far
+    CAPTION_SIMILARITY_THRESHOLD = float(os.getenv("CAPTION_SIMILARITY_THRESHOLD", "0.6"))  # Repeat if this similar to a used caption (0 = off)
+    CAPTION_MAX_ATTEMPTS = int(os.getenv("CAPTION_MAX_ATTEMPTS", "3"))  # Tries to get a fresh caption before accepting a repeat
+    CAPTION_MODE = os.getenv("CAPTION_MODE", "model").strip().lower()  # model (image model draws the text) or composite (drawn locally)
+    CAPTION_FONT_PATH = os.getenv("CAPTION_FONT_PATH", "")  # Font for composite captions (default: Impact, Arial Bold, DejaVu Sans Bold...)
+    BACKGROUND_DIR = os.getenv("BACKGROUND_DIR", "meme backgrounds")  # Caption-free backgrounds reused in composite mode
+    BACKGROUND_LIBRARY_SIZE = int(os.getenv("BACKGROUND_LIBRARY_SIZE", "12"))  # Backgrounds kept; a new one is generated below this
+    BACKGROUND_MAX_USES = int(os.getenv("BACKGROUND_MAX_USES", "4"))  # Memes per background before it is retired (at most 6, one per variant)
+    
+    # Provider response cache: lets a rerun after a downstream failure (e.g. SMTP) skip generation
+    CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").strip().lower() == "true"
+    CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+    CACHE_TTL_HOURS = float(os.getenv("CACHE_TTL_HOURS", "6"))  # Entries older than this are regenerated
+    CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", "256"))  # Least recently used entries are evicted past this
+    
+    # Meme Reservoir: pre-generated memes kept on disk so the daily send is instant
+    RESERVOIR_DIR = os.getenv("RESERVOIR_DIR", "meme reservoir")
+    RESERVOIR_SIZE = int(os.getenv("RESERVOIR_SIZE", "7"))  # Number of memes to keep ready
+    
+    # Archive duplicate check: perceptual hashes of every meme saved to "coffee memes"
+    ARCHIVE_INDEX_ENABLED = os.getenv("ARCHIVE_INDEX_ENABLED", "true").strip().lower() == "true"
+    ARCHIVE_INDEX_PATH = os.getenv("ARCHIVE_INDEX_PATH", "archive_index.jsonl")
+    MEME_INDEX_PATH = os.getenv("MEME_INDEX_PATH", "meme_index.sqlite3")  # SQLite metadata of every saved meme
+    ARCHIVE_DUPLICATE_DISTANCE = int(os.getenv("ARCHIVE_DUPLICATE_DISTANCE", "6"))  # Differing bits (of 64) that still count as a duplicate
+    DUPLICATE_MAX_ATTEMPTS = int(os.getenv("DUPLICATE_MAX_ATTEMPTS", "2"))  # Memes tried before sending a near-duplicate anyway
+    
+    # Hedged requests: start the other provider if the configured one is slow (needs both API keys)
+    HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").strip().lower() == "true"
+    HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # Hedge once the primary is slower than this percentile
+    HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", "45"))  # Used until enough latencies are recorded
+    HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "5"))  # Never hedge sooner than this
+    LATENCY_HISTORY_PATH = os.getenv("LATENCY_HISTORY_PATH", "provider_latency.json")
+    LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "50"))  # Recent latencies kept per provider
+    
+    # Run metrics: per-stage timings appended to a JSON-lines run log and a Prometheus textfile
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").strip().lower() == "true"
+    RUN_LOG_PATH = os.getenv("RUN_LOG_PATH", "run_log.jsonl")
+    METRICS_TEXTFILE_PATH = os.getenv("METRICS_TEXTFILE_PATH", "")  # e.g. node_exporter textfile dir/coffee_meme.prom (empty = off)
+    
+    # Audience groups (--groups): recipients with their own style, provider and schedule
+    GROUPS_PATH = os.getenv("GROUPS_PATH", "groups.json")
+    
+    # Daemon mode (--daemon): one long-running process sends on a schedule with warm clients
+    DAEMON_SCHEDULE = os.getenv("DAEMON_SCHEDULE", "0 8 * * *")  # Cron: minute hour day month weekday (local time)
+    DAEMON_WARM_SECONDS = float(os.getenv("DAEMON_WARM_SECONDS", "30"))  # Reconnect to the provider and SMTP this long before a send
+    DAEMON_POLL_SECONDS = float(os.getenv("DAEMON_POLL_SECONDS", "5"))  # How often .env is checked for changes
+    DAEMON_STATUS_HOST = os.getenv("DAEMON_STATUS_HOST", "127.0.0.1")
+    DAEMON_STATUS_PORT = int(os.getenv("DAEMON_STATUS_PORT", "8765"))  # Health/status endpoint (0 = off)
+    
+    # Provider rate limits (per minute, 0 = unlimited), queued client-side to avoid 429s
+    RATE_LIMITS_ENABLED = os.getenv("RATE_LIMITS_ENABLED", "true").strip().lower() == "true"
+    OPENAI_TEXT_RPM = float(os.getenv("OPENAI_TEXT_RPM", "500"))  # Chat requests per minute
+    OPENAI_TEXT_TPM = float(os.getenv("OPENAI_TEXT_TPM", "200000"))  # Chat tokens per minute (prompt + max_tokens)
+    OPENAI_IMAGE_RPM = float(os.getenv("OPENAI_IMAGE_RPM", "50"))  # Image requests per minute
+    OPENAI_IMAGE_IPM = float(os.getenv("OPENAI_IMAGE_IPM", "5"))  # Images per minute (gpt-image-1 usage tier 1)
+    GROK_IMAGE_RPM = float(os.getenv("GROK_IMAGE_RPM", "60"))  # Grok image requests per minute
+    GROK_IMAGE_IPM = float(os.getenv("GROK_IMAGE_IPM", "0"))  # Grok images per minute
+    
+    # Spending budget: calls that would pass it fail before they are made
+    DAILY_BUDGET_USD = float(os.getenv("DAILY_BUDGET_USD", "0"))  # 0 = no budget (spending is still recorded)
+    SPEND_LEDGER_PATH = os.getenv("SPEND_LEDGER_PATH", "spend_ledger.json")
     
     # Image Hosting (no longer needed for email, but kept for potential future use)
     # ImgBB is the default (works without API key, no registration issues)
     IMGBB_API_KEY = os.getenv("IMGBB_API_KEY", "")  # Optional: not needed for email
     # Imgur is a fallback option (requires Client ID, registration currently broken)
     IMGUR_CLIENT_ID = os.getenv("IMGUR_CLIENT_ID", "")  # Optional: not needed for email
+    IMAGE_HOST_RACE = os.getenv("IMAGE_HOST_RACE", "false").strip().lower() == "true"  # Upload to both hosts at once, first URL wins
+    UPLOAD_CACHE_PATH = os.getenv("UPLOAD_CACHE_PATH", "upload_cache.json")  # Uploaded URLs by content hash (empty = off)
+    
+    @classmethod
+    def reload(cls) -> list:
+        """
+        Re-read the .env file and re-evaluate every setting in place.
+        
+        Modules hold a reference to this class, so new values are copied onto it
+        rather than replacing it. Variables removed from .env fall back to their
+        defaults; variables from the process environment keep precedence.
+        
+        Returns:
+            list: Names of the settings whose value changed
+        """
+        file_values = dotenv_values(ENV_FILE) if ENV_FILE else {}
+        for key in _dotenv_keys - set(file_values):
+            os.environ.pop(key, None)
+        _dotenv_keys.clear()
+        for key, value in file_values.items():
+            if key not in _PROCESS_ENV and value is not None:
+                os.environ[key] = value
+                _dotenv_keys.add(key)
+        
+        # Evaluate a fresh copy of this module's class body against the new environment
+        spec = importlib.util.spec_from_file_location("_config_reload", __file__)
+        fresh = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(fresh)
+        changed = []
+        for name, value in vars(fresh.Config).items():
+            if name.isupper() and getattr(cls, name, None) != value:
+                setattr(cls, name, value)
+                changed.append(name)
+        return changed
     
     @classmethod
     def validate(cls):
@@ -74,4 +201,7 @@ class Config:
                 f"Please set these in your .env file. See .env.example for reference."
             )
         
+        if cls.CAPTION_MODE not in ("model", "composite"):
+            raise ValueError(f"CAPTION_MODE must be 'model' or 'composite', got '{cls.CAPTION_MODE}'")
+        
         return True
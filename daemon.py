@@ -0,0 +1,392 @@
+"""Long-running daemon: sends memes on a cron schedule, keeping provider and SMTP clients warm."""
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import datetime, time as dtime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import config
+from config import Config
+import http_client
+from rate_limit import get_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class CronSchedule:
+    """
+    Five-field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept *, numbers, ranges (1-5), lists (1,3,5) and steps (*/15, 8-18/2).
+    Day of week runs 0-7 with both 0 and 7 meaning Sunday. As in cron, when both
+    day fields are restricted a day matching either one fires.
+    """
+
+    FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != len(self.FIELDS):
+            raise ValueError(f"Cron schedule needs 5 fields (minute hour day month weekday): {expression!r}")
+        self.expression = expression
+        minutes, hours, days, months, weekdays = (
+            self._parse(part, name, low, high) for part, (name, low, high) in zip(parts, self.FIELDS)
+        )
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, name: str, low: int, high: int) -> set:
+        values = set()
+        for item in field.split(","):
+            spec, _, step = item.partition("/")
+            try:
+                step = int(step) if step else 1
+                if spec == "*":
+                    start, end = low, high
+                elif "-" in spec:
+                    start, end = (int(value) for value in spec.split("-", 1))
+                else:
+                    start = int(spec)
+                    end = high if "/" in item else start  # "5/10": every 10th from 5
+            except ValueError:
+                raise ValueError(f"Invalid cron {name} field: {field!r}")
+            if step < 1 or not low <= start <= end <= high:
+                raise ValueError(f"Cron {name} field out of range {low}-{high}: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, day) -> bool:
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays  # cron counts from Sunday
+        if self._any_day or self._any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, after: datetime) -> datetime:
+        """First time strictly after `after` (to the minute) that the schedule fires."""
+        start = (after + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        day = start.date()
+        for _ in range(366 * 8):  # Feb 29 on a given weekday can be years away
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime.combine(day, dtime(hour, minute))
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f"Cron schedule never fires: {self.expression!r}")
+
+
+class ConfigWatcher:
+    """Reloads Config when the .env file (or another watched file) changes, detected by polling mtime and size."""
+
+    def __init__(self, extra_paths: list = None):
+        """
+        Args:
+            extra_paths: Files to watch besides the .env file Config was loaded from
+        """
+        paths = ([config.ENV_FILE] if config.ENV_FILE else []) + list(extra_paths or [])
+        self.paths = [Path(path) for path in paths]
+        self._stamps = self._read_stamps()
+
+    def _read_stamps(self) -> dict:
+        stamps = {}
+        for path in self.paths:
+            try:
+                stat = path.stat()
+            except OSError:
+                stamps[path] = None
+                continue
+            stamps[path] = (stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def poll(self):
+        """
+        Reload Config if a watched file changed since the last poll.
+
+        Returns:
+            list: Names of changed settings, or None if no file changed
+        """
+        stamps = self._read_stamps()
+        if stamps == self._stamps:
+            return None
+        changed_files = [str(path) for path in self.paths if stamps[path] != self._stamps[path]]
+        self._stamps = stamps
+        logger.info(f"Changed: {', '.join(changed_files)}")
+        return Config.reload()
+
+
+class _StatusHandler(BaseHTTPRequestHandler):
+    server_version = "MemeDaemon/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("Status request: " + format % args)
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body, indent=2).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        meme_daemon = self.server.meme_daemon
+        if self.path == "/health":
+            healthy = meme_daemon.is_healthy()
+            self._send_json(200 if healthy else 503, {"status": "ok" if healthy else "stalled"})
+        elif self.path in ("/", "/status"):
+            self._send_json(200, meme_daemon.status())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+
+class MemeDaemon:
+    """
+    Runs scheduled sends inside one long-lived process.
+
+    Each job (the daily send, or one audience group) has its own cron schedule;
+    jobs due at the same minute are sent together. The provider services (with
+    their pooled clients), the EmailService SMTP pool and the shared HTTP session
+    are created once and reused between sends. Shortly before each send
+    (DAEMON_WARM_SECONDS) the daemon reconnects them, so the send itself starts
+    with open TLS connections and a logged-in SMTP session. Changes to .env (and
+    other watched files) are picked up between sends; services are rebuilt with
+    the new settings. GET /health and /status on DAEMON_STATUS_PORT report
+    liveness, the next send and the last result.
+    """
+
+    def __init__(self, send, create_ai_service, schedules, job_providers,
+                 email_pool_size: int = None, watch: list = None):
+        """
+        Args:
+            send: Called as send(due_jobs, ai_services, email_service) with the names of the
+                  due jobs and the open services by provider; returns a process exit code
+            create_ai_service: Callable taking a provider name and returning its service
+            schedules: Callable returning {job name: cron expression}; called again on reload
+            job_providers: Callable returning the provider names the jobs use
+            email_pool_size: SMTP sessions for the EmailService (defaults to SMTP_POOL_SIZE)
+            watch: Files besides .env whose changes trigger a reload
+        """
+        self.send = send
+        self.create_ai_service = create_ai_service
+        self.schedules_source = schedules
+        self.job_providers = job_providers
+        self.email_pool_size = email_pool_size
+        self.schedules = self._load_schedules()
+        self.watcher = ConfigWatcher(watch)
+        self.ai_services = {}
+        self.email_service = None
+        self.started_at = datetime.now()
+        self.config_loaded_at = self.started_at
+        self.next_run = None
+        self.due_jobs = []
+        self.last_run = None
+        self.runs = 0
+        self.failures = 0
+        self._sending = False
+        self._warmed_for = None
+        self._heartbeat = time.monotonic()
+        self._stop = threading.Event()
+        self._status_server = None
+
+    def _load_schedules(self) -> dict:
+        """Parse the job schedules (raises ValueError on a bad expression)."""
+        schedules = {name: CronSchedule(expression) for name, expression in self.schedules_source().items()}
+        if not schedules:
+            raise ValueError("No jobs to schedule")
+        return schedules
+
+    def _plan(self, after: datetime):
+        """Set next_run to the earliest job time after `after`, and due_jobs to the jobs due then."""
+        next_times = {name: schedule.next_after(after) for name, schedule in self.schedules.items()}
+        self.next_run = min(next_times.values())
+        self.due_jobs = [name for name, when in next_times.items() if when == self.next_run]
+
+    def stop(self, *_):
+        """Ask the loop to exit after the current send (also the signal handler)."""
+        self._stop.set()
+
+    def is_healthy(self) -> bool:
+        """True while the scheduler loop is ticking (or busy sending)."""
+        return self._sending or time.monotonic() - self._heartbeat < 3 * Config.DAEMON_POLL_SECONDS + 5
+
+    def status(self) -> dict:
+        """Daemon state for the /status endpoint."""
+        return {
+            "status": "sending" if self._sending else "idle",
+            "pid": os.getpid(),
+            "started": self.started_at.isoformat(timespec="seconds"),
+            "schedules": {name: schedule.expression for name, schedule in self.schedules.items()},
+            "next_run": self.next_run.isoformat(timespec="seconds") if self.next_run else None,
+            "next_jobs": self.due_jobs,
+            "config_loaded": self.config_loaded_at.isoformat(timespec="seconds"),
+            "services_warm": sorted(self.ai_services) + (["smtp"] if self.email_service is not None else []),
+            "spent_today_usd": round(get_limiter().ledger.spent_today(), 4),
+            "daily_budget_usd": Config.DAILY_BUDGET_USD or None,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_run": self.last_run,
+        }
+
+    def _ensure_services(self):
+        """Create the provider and email services that are not already open."""
+        Config.validate()
+        for provider in self.job_providers():
+            if provider not in self.ai_services:
+                try:
+                    self.ai_services[provider] = self.create_ai_service(provider)
+                except ValueError as e:
+                    logger.warning(f"Could not create {provider} service: {e}")
+        if self.email_service is None:
+            from email_service import EmailService
+            self.email_service = EmailService(pool_size=self.email_pool_size)
+
+    def _close_services(self):
+        """Close warm clients (they are recreated before the next send)."""
+        for service in list(self.ai_services.values()) + [self.email_service]:
+            if service is None:
+                continue
+            try:
+                service.close()
+            except Exception as e:
+                logger.warning(f"Error closing {type(service).__name__}: {e}")
+        self.ai_services = {}
+        self.email_service = None
+        http_client.close()
+
+    def warm_up(self):
+        """Open provider and SMTP connections ahead of a send; failures are logged, not raised."""
+        started = time.monotonic()
+        try:
+            self._ensure_services()
+        except Exception as e:
+            logger.warning(f"Could not create services for warm-up: {e}")
+            return
+        for provider, service in self.ai_services.items():
+            try:
+                service.warm_up()
+            except Exception as e:
+                logger.warning(f"{provider} warm-up failed: {e}")
+        try:
+            with self.email_service.pool.connection():
+                pass  # Logs in and leaves the session in the pool for the send
+        except Exception as e:
+            logger.warning(f"SMTP warm-up failed: {e}")
+        logger.info(f"Warmed up connections in {time.monotonic() - started:.2f}s")
+
+    def run_once(self, jobs: list) -> int:
+        """Send the given jobs with the warm services and record the result."""
+        try:
+            self._ensure_services()
+        except Exception as e:
+            # The send reports the configuration error itself
+            logger.warning(f"Could not create services: {e}")
+        self._sending = True
+        started = datetime.now()
+        try:
+            exit_code = self.send(jobs, self.ai_services, self.email_service)
+        except Exception as e:
+            logger.error(f"Scheduled send crashed: {e}", exc_info=True)
+            exit_code = 1
+        finally:
+            self._sending = False
+        self.runs += 1
+        if exit_code != 0:
+            self.failures += 1
+        self.last_run = {
+            "jobs": jobs,
+            "started": started.isoformat(timespec="seconds"),
+            "seconds": round((datetime.now() - started).total_seconds(), 3),
+            "exit_code": exit_code,
+        }
+        return exit_code
+
+    def _reload_config(self, changed: list):
+        """Apply changed files: rebuild services on new settings and re-read the schedules."""
+        self.config_loaded_at = datetime.now()
+        if changed:
+            logger.info(f"Reloaded configuration, changed: {', '.join(changed)}")
+            self._close_services()
+        try:
+            self.schedules = self._load_schedules()
+        except (OSError, ValueError) as e:
+            logger.error(f"Keeping previous schedules: {e}")
+            return
+        self._plan(datetime.now())
+        self._warmed_for = None
+        logger.info(f"Next send at {self.next_run}: {', '.join(self.due_jobs)}")
+
+    def _start_status_server(self):
+        if Config.DAEMON_STATUS_PORT <= 0:
+            return
+        try:
+            server = ThreadingHTTPServer((Config.DAEMON_STATUS_HOST, Config.DAEMON_STATUS_PORT), _StatusHandler)
+        except OSError as e:
+            logger.error(f"Status endpoint disabled, could not listen on port {Config.DAEMON_STATUS_PORT}: {e}")
+            return
+        server.daemon_threads = True
+        server.meme_daemon = self
+        threading.Thread(target=server.serve_forever, name="daemon-status", daemon=True).start()
+        self._status_server = server
+        host, port = server.server_address[:2]
+        logger.info(f"Status endpoint at http://{host}:{port}/status")
+
+    def run(self) -> int:
+        """
+        Run the scheduler loop until SIGINT/SIGTERM.
+
+        Returns:
+            int: Process exit code
+        """
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        self._start_status_server()
+        self._plan(datetime.now())
+        logger.info(f"Daemon started (pid {os.getpid()}), next send at {self.next_run}: {', '.join(self.due_jobs)}")
+        try:
+            while not self._stop.is_set():
+                self._heartbeat = time.monotonic()
+                try:
+                    changed = self.watcher.poll()
+                except Exception as e:
+                    logger.error(f"Could not reload configuration: {e}")
+                    changed = None
+                if changed is not None:
+                    self._reload_config(changed)
+
+                now = datetime.now()
+                warm_at = self.next_run - timedelta(seconds=Config.DAEMON_WARM_SECONDS)
+                if now >= self.next_run:
+                    # Late by any amount (e.g. the machine slept): send once, then reschedule
+                    logger.info(f"Scheduled send due at {self.next_run}: {', '.join(self.due_jobs)}")
+                    self.run_once(self.due_jobs)
+                    self._plan(datetime.now())
+                    logger.info(f"Next send at {self.next_run}: {', '.join(self.due_jobs)}")
+                    continue
+                if now >= warm_at and self._warmed_for != self.next_run:
+                    self.warm_up()
+                    self._warmed_for = self.next_run
+                    continue
+
+                next_event = self.next_run if self._warmed_for == self.next_run else warm_at
+                wait = (next_event - now).total_seconds()
+                self._stop.wait(min(Config.DAEMON_POLL_SECONDS, max(0.01, wait)))
+        finally:
+            logger.info("Daemon stopping")
+            if self._status_server is not None:
+                self._status_server.shutdown()
+                self._status_server.server_close()
+            self._close_services()
+        return 0
@@ -1,23 +1,157 @@
 """Email service for sending meme images via SMTP."""
+import base64
 import logging
 import smtplib
+import socket
+import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
 from email.mime.base import MIMEBase
-from email import encoders
-import io
+from email import policy
 from datetime import datetime
 from config import Config
+from image_buffer import as_view
+import run_metrics
 
 logger = logging.getLogger(__name__)
 
+# Raw bytes encoded per streamed chunk: a multiple of 57 so every base64 line is a full 76 chars
+STREAM_CHUNK_BYTES = 57 * 1024
+
+
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of logged-in SMTP sessions that are reused between sends.
+    
+    Idle sessions are health-checked with NOOP before reuse and dropped once they
+    have been idle longer than max_idle_seconds (most relays disconnect idle
+    clients after a minute or two). At most `size` sessions are open at once.
+    """
+    
+    def __init__(self, host: str, port: int, username: str, password: str, use_tls: bool = True,
+                 size: int = 1, max_idle_seconds: float = 60, timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.size = max(1, size)
+        self.max_idle_seconds = max_idle_seconds
+        self.timeout = timeout
+        self._idle = []  # (server, last_used) pairs, most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+    
+    def _connect(self) -> smtplib.SMTP:
+        """Open, secure and authenticate a new SMTP session."""
+        logger.info(f"Connecting to SMTP server {self.host}:{self.port}")
+        with run_metrics.span("smtp_connect"):
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        # The message is streamed in many writes; don't let Nagle hold them for ACKs
+        server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            if self.use_tls:
+                logger.debug("Starting TLS...")
+                with run_metrics.span("smtp_tls"):
+                    server.starttls()
+            logger.info("Logging in to email server...")
+            with run_metrics.span("smtp_login"):
+                server.login(self.username, self.password)
+        except Exception:
+            self._discard(server)
+            raise
+        return server
+    
+    @staticmethod
+    def _discard(server: smtplib.SMTP):
+        """Close a session, ignoring errors from already-dead connections."""
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+    
+    def _is_healthy(self, server: smtplib.SMTP, last_used: float) -> bool:
+        """Check that an idle session is fresh enough and still answers NOOP."""
+        if time.monotonic() - last_used > self.max_idle_seconds:
+            return False
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+    
+    def _checkout(self) -> smtplib.SMTP:
+        """Return a healthy idle session, or a new one if none is available."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, last_used = self._idle.pop()
+            if self._is_healthy(server, last_used):
+                logger.debug("Reusing pooled SMTP session")
+                return server
+            logger.debug("Dropping stale pooled SMTP session")
+            self._discard(server)
+        return self._connect()
+    
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a session for the duration of the block.
+        
+        The session goes back to the pool if the block succeeds or fails with an
+        SMTP-level error (the connection is still usable); it is discarded if the
+        connection itself broke.
+        """
+        self._slots.acquire()
+        try:
+            server = self._checkout()
+            try:
+                yield server
+            # SMTPException subclasses OSError, so the SMTP-level errors are caught before plain OSError
+            except smtplib.SMTPServerDisconnected:
+                self._discard(server)
+                raise
+            except smtplib.SMTPException:
+                try:
+                    server.rset()
+                except (smtplib.SMTPException, OSError):
+                    self._discard(server)
+                else:
+                    self._release(server)
+                raise
+            except OSError:
+                self._discard(server)
+                raise
+            self._release(server)
+        finally:
+            self._slots.release()
+    
+    def _release(self, server: smtplib.SMTP):
+        with self._lock:
+            self._idle.append((server, time.monotonic()))
+    
+    def close(self):
+        """Close every idle session."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._discard(server)
+
 
 class EmailService:
     """Service for sending images via email."""
     
-    def __init__(self):
-        """Initialize email service with SMTP configuration."""
+    def __init__(self, pool_size: int = None):
+        """
+        Initialize email service with SMTP configuration.
+        
+        Args:
+            pool_size: Concurrent SMTP sessions (defaults to SMTP_POOL_SIZE from config)
+        """
         if not all([Config.SMTP_SERVER, Config.SMTP_PORT, Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD]):
             raise ValueError("Email configuration is incomplete")
         
@@ -26,17 +160,51 @@ class EmailService:
         self.email_address = Config.EMAIL_ADDRESS
         self.email_password = Config.EMAIL_PASSWORD
         self.use_tls = Config.SMTP_USE_TLS.lower() == 'true' if Config.SMTP_USE_TLS else True
+        self.recipients_per_message = max(1, Config.SMTP_RECIPIENTS_PER_MESSAGE)
+        self.pool = SMTPConnectionPool(
+            self.smtp_server, self.smtp_port, self.email_address, self.email_password,
+            use_tls=self.use_tls,
+            size=pool_size or Config.SMTP_POOL_SIZE,
+            max_idle_seconds=Config.SMTP_KEEPALIVE_SECONDS,
+            timeout=Config.SMTP_TIMEOUT,
+        )
+    
+    def close(self):
+        """Close pooled SMTP sessions."""
+        self.pool.close()
     
-    def send_image(self, image_bytes: bytes, recipients: list = None) -> bool:
+    def send_image(self, image_bytes, recipients: list = None, message_id: str = None) -> bool:
         """
         Send an image via email as an attachment.
         
         Args:
-            image_bytes: Image data as bytes
+            image_bytes: Image data (ImageBuffer or bytes)
             recipients: List of email addresses to send to (defaults to RECIPIENT_EMAIL from config)
-            
+            message_id: Message-ID header, e.g. a stable one so a resent message can be deduplicated
+        
+        Returns:
+            bool: True if email was sent successfully to every chunk, False if only some chunks failed
+        """
+        report = self.send_image_with_report(image_bytes, recipients, message_id)
+        return all(chunk["error"] is None for chunk in report)
+    
+    def send_image_with_report(self, image_bytes, recipients: list = None, message_id: str = None) -> list:
+        """
+        Send an image like send_image and report on every recipient chunk.
+        
+        Recipient lists longer than SMTP_RECIPIENTS_PER_MESSAGE are split into BCC
+        batches, each sent as its own message over pooled (reused) SMTP sessions.
+        
+        Args:
+            image_bytes: Image data (ImageBuffer or bytes)
+            recipients: List of email addresses to send to (defaults to RECIPIENT_EMAIL from config)
+            message_id: Message-ID header (the relay assigns one if None)
+        
         Returns:
-            bool: True if email was sent successfully, False otherwise
+            list: One dict per chunk with recipients, seconds, refused and error
+        
+        Raises:
+            smtplib.SMTPException: If every chunk failed
         """
         try:
             if recipients is None:
@@ -58,49 +226,171 @@ class EmailService:
             logger.info(f"Sending image to {', '.join(recipients)}")
             logger.info(f"Image size: {len(image_bytes)} bytes")
             
-            # Create message
-            msg = MIMEMultipart()
-            msg['From'] = self.email_address
-            msg['To'] = ', '.join(recipients)
-            msg['Subject'] = f"The Daily Mud - {datetime.now().strftime('%B %d, %Y')}"
-            
-            # Add body text
-            body = (
-                "Here's your daily mud meme ☕\n\n"
-                "You have been blessed by the MudBot"
-            )
-            msg.attach(MIMEText(body, 'plain'))
+            chunks = [
+                recipients[i:i + self.recipients_per_message]
+                for i in range(0, len(recipients), self.recipients_per_message)
+            ]
+            # A single chunk keeps the visible To list; batches go out as BCC
+            to_header = ', '.join(recipients) if len(chunks) == 1 else self.email_address
+            head, tail = self._build_message_skeleton(to_header, message_id)
             
-            # Attach image
-            image_part = MIMEBase('image', 'jpeg')
-            image_part.set_payload(image_bytes)
-            encoders.encode_base64(image_part)
-            image_part.add_header(
-                'Content-Disposition',
-                f'attachment; filename=coffee_meme_{datetime.now().strftime("%Y%m%d_%H%M%S")}.jpg'
-            )
-            msg.attach(image_part)
-            
-            # Send email
-            logger.info(f"Connecting to SMTP server {self.smtp_server}:{self.smtp_port}")
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                if self.use_tls:
-                    logger.debug("Starting TLS...")
-                    server.starttls()
-                
-                logger.info("Logging in to email server...")
-                server.login(self.email_address, self.email_password)
-                
-                logger.info("Sending email...")
-                text = msg.as_string()
-                server.sendmail(self.email_address, recipients, text)
-            
-            logger.info(f"Email sent successfully to {', '.join(recipients)}")
-            return True
+            if len(chunks) > 1:
+                logger.info(f"Sending {len(chunks)} BCC batches of up to {self.recipients_per_message} recipients")
+            workers = min(self.pool.size, len(chunks))
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    report = list(executor.map(lambda chunk: self._send_chunk(head, image_bytes, tail, chunk), chunks))
+            else:
+                report = [self._send_chunk(head, image_bytes, tail, chunk) for chunk in chunks]
             
+            failed = [chunk for chunk in report if chunk["error"] is not None]
+            if len(failed) == len(report):
+                raise smtplib.SMTPException(f"All {len(report)} recipient chunks failed: {failed[-1]['error']}")
+            if failed:
+                logger.error(f"{len(failed)} of {len(report)} recipient chunks failed")
+            else:
+                logger.info(f"Email sent successfully to {', '.join(recipients)}")
+            return report
+        
         except smtplib.SMTPException as e:
             logger.error(f"SMTP error sending email: {e}")
             raise
         except Exception as e:
             logger.error(f"Error sending email: {e}")
             raise
+    
+    def _build_message_skeleton(self, to_header: str, message_id: str = None) -> tuple:
+        """
+        Build the meme email around a placeholder attachment body.
+        
+        Only headers, the text part and MIME boundaries are serialized here; the
+        base64 attachment body is streamed separately by _stream_message, so the
+        encoded image never exists as one large string.
+        
+        Returns:
+            tuple: (bytes before the attachment body, bytes after it), CRLF line endings
+        """
+        msg = MIMEMultipart()
+        msg['From'] = self.email_address
+        msg['To'] = to_header
+        msg['Subject'] = f"The Daily Mud - {datetime.now().strftime('%B %d, %Y')}"
+        if message_id:
+            msg['Message-ID'] = message_id
+        
+        # Add body text
+        body = (
+            "Here's your daily mud meme ☕\n\n"
+            "You have been blessed by the MudBot"
+        )
+        msg.attach(MIMEText(body, 'plain'))
+        
+        # Attach image (body filled in while streaming)
+        placeholder = f"image-body-{uuid.uuid4().hex}"
+        image_part = MIMEBase('image', 'jpeg')
+        image_part['Content-Transfer-Encoding'] = 'base64'
+        image_part.set_payload(placeholder)
+        image_part.add_header(
+            'Content-Disposition',
+            f'attachment; filename=coffee_meme_{datetime.now().strftime("%Y%m%d_%H%M%S")}.jpg'
+        )
+        msg.attach(image_part)
+        
+        head, tail = msg.as_bytes(policy=policy.SMTP).split(placeholder.encode(), 1)
+        return self._dot_stuff(head), self._dot_stuff(tail)
+    
+    @staticmethod
+    def _dot_stuff(data: bytes) -> bytes:
+        """Escape lines starting with '.' for the SMTP DATA phase (RFC 5321 4.5.2)."""
+        if data.startswith(b"."):
+            data = b"." + data
+        return data.replace(b"\r\n.", b"\r\n..")
+    
+    @staticmethod
+    def _stream_message(head: bytes, image_bytes, tail: bytes):
+        """
+        Yield the full message in pieces, base64-encoding the image chunk by chunk.
+        
+        Base64 output never starts a line with '.', so only head/tail need dot-stuffing.
+        """
+        yield head
+        view = as_view(image_bytes)
+        for offset in range(0, len(view), STREAM_CHUNK_BYTES):
+            yield base64.encodebytes(view[offset:offset + STREAM_CHUNK_BYTES]).replace(b"\n", b"\r\n")
+        if not tail.startswith(b"\r\n"):
+            tail = b"\r\n" + tail
+        if not tail.endswith(b"\r\n"):
+            tail += b"\r\n"
+        yield tail
+    
+    def _sendmail_streaming(self, server: smtplib.SMTP, recipients: list, pieces) -> dict:
+        """
+        Run MAIL/RCPT/DATA by hand, writing message pieces straight to the socket.
+        
+        Mirrors smtplib.SMTP.sendmail, which needs the whole message in memory.
+        
+        Returns:
+            dict: Refused recipients, as returned by sendmail
+        """
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(self.email_address)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, self.email_address)
+        refused = {}
+        for recipient in recipients:
+            code, resp = server.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = server.docmd("data")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        # Hold back the last piece so the terminator goes out in the same write; a
+        # separate tiny write stalls on Nagle + delayed ACK (~40 ms per message)
+        previous = b""
+        for piece in pieces:
+            if previous:
+                server.send(previous)
+            previous = piece
+        server.send(previous + b".\r\n")
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+    
+    def _send_chunk(self, head: bytes, image_bytes, tail: bytes, chunk: list) -> dict:
+        """
+        Stream the message to one recipient chunk over a pooled session.
+        
+        A session that drops mid-send is replaced and the chunk retried once.
+        
+        Returns:
+            dict: recipients, seconds, refused (per-address errors) and error (None on success)
+        """
+        started = time.monotonic()
+        result = {"recipients": chunk, "seconds": 0.0, "refused": {}, "error": None}
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as server:
+                    logger.info(f"Sending email to {len(chunk)} recipient(s)...")
+                    with run_metrics.span("smtp_send", bytes=len(image_bytes), recipients=len(chunk)):
+                        refused = self._sendmail_streaming(
+                            server, chunk, self._stream_message(head, image_bytes, tail)
+                        )
+                result["refused"] = {address: str(reason) for address, reason in refused.items()}
+                result["error"] = None
+                break
+            except smtplib.SMTPServerDisconnected as e:
+                result["error"] = str(e)
+                logger.warning(f"SMTP session dropped (attempt {attempt + 1}), reconnecting: {e}")
+                run_metrics.count("smtp_retries")
+            except (smtplib.SMTPException, OSError) as e:
+                result["error"] = str(e)
+                logger.error(f"SMTP error sending to {', '.join(chunk)}: {e}")
+                break
+        result["seconds"] = time.monotonic() - started
+        if result["refused"]:
+            logger.warning(f"Recipients refused: {result['refused']}")
+        logger.info(f"Chunk of {len(chunk)} recipient(s) finished in {result['seconds']:.2f}s"
+                    + ("" if result["error"] is None else f" with error: {result['error']}"))
+        return result
@@ -0,0 +1,63 @@
+"""Small file helpers shared by the on-disk stores (locks and atomic writes)."""
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def file_lock(lock_path: Path, timeout: float = 30, stale_after: float = 300):
+    """
+    Hold an exclusive lock file for the duration of the block (works on Windows too).
+
+    Args:
+        lock_path: Path of the lock file to create
+        timeout: Seconds to wait for the lock before raising TimeoutError
+        stale_after: A lock older than this was left by a crashed process and is removed
+    """
+    lock_path = Path(lock_path)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - lock_path.stat().st_mtime > stale_after:
+                    logger.warning(f"Removing stale lock: {lock_path}")
+                    lock_path.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for lock: {lock_path}")
+            time.sleep(0.05)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def atomic_write_bytes(path: Path, data):
+    """Write bytes-like data to path via a fsynced temp file and rename."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_write_json(path: Path, obj):
+    """Write obj as JSON to path via a fsynced temp file and rename."""
+    atomic_write_bytes(path, json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8'))
@@ -4,9 +4,12 @@ Uses only the Grok image model (grok-imagine-image) to create the meme in one st
 No separate text model. See: https://docs.x.ai/developers/model-capabilities/images/generation
 """
 import logging
-import requests
 import xai_sdk
+import http_client
 from config import Config
+from image_buffer import ImageBuffer
+from rate_limit import get_limiter
+from response_cache import RunCache
 
 logger = logging.getLogger(__name__)
 
@@ -14,44 +17,126 @@ logger = logging.getLogger(__name__)
 class GrokService:
     """Service for generating coffee memes using only the Grok image model."""
 
+    PROVIDER = "grok"
+
+    # xAI image generation returns at most 10 images per request
+    MAX_IMAGES_PER_REQUEST = 10
+
     def __init__(self):
         """Initialize xAI client for image generation."""
         if not Config.XAI_API_KEY:
             raise ValueError("XAI_API_KEY is not set in configuration (required when AI_PROVIDER=grok)")
-        self.client = xai_sdk.Client(api_key=Config.XAI_API_KEY)
+        self.client = xai_sdk.Client(
+            api_key=Config.XAI_API_KEY,
+            api_host=Config.XAI_API_HOST,
+            timeout=Config.HTTP_READ_TIMEOUT,
+        )
+        self.cache = RunCache(self.PROVIDER)
 
-    def generate_meme_image(self) -> bytes:
+    @staticmethod
+    def _build_prompt(style: str = None) -> str:
+        """Build the single prompt used for Grok meme images (style defaults to MEME_STYLE)."""
+        return (
+            f"Create a funny, relatable coffee meme. "
+            f"Style: {style or Config.MEME_STYLE}, like something you would see on Facebook or Twitter. "
+            "The image should be a complete meme with visible text/caption."
+        )
+
+    @staticmethod
+    def _response_bytes(response) -> ImageBuffer:
+        """Return the image from a Grok image response (URL or inline base64) without copying."""
+        # Check the URL first: the SDK's .image property downloads URL images itself
+        # (uncapped, on every access), bypassing the shared HTTP session
+        try:
+            url = response.url
+        except ValueError:
+            url = None
+        if url:
+            logger.info(f"Image generated at: {url}")
+            image_bytes = http_client.download(url)
+            logger.info(f"Downloaded image, size: {len(image_bytes)} bytes")
+            return image_bytes
+        image = response.image  # Inline base64, decoded once
+        if not image:
+            raise ValueError("Grok image response had no image or url")
+        logger.info(f"Image generated (Grok), size: {len(image)} bytes")
+        return ImageBuffer(image)
+
+    def generate_meme_image(self, style: str = None) -> ImageBuffer:
         """
         Generate a coffee meme image using the Grok image model (grok-imagine-image).
         One prompt only; no separate text model.
+
+        Args:
+            style: Meme style (defaults to MEME_STYLE)
         """
         try:
             logger.info("Generating coffee meme image (Grok)...")
 
-            prompt = (
-                f"Create a funny, relatable coffee meme. "
-                f"Style: {Config.MEME_STYLE}, like something you would see on Facebook or Twitter. "
-                "The image should be a complete meme with visible text/caption."
-            )
-
-            response = self.client.image.sample(
-                prompt=prompt,
+            prompt = self._build_prompt(style)
+            cache_key = self.cache.key(
+                kind="image",
                 model=Config.GROK_IMAGE_MODEL,
+                prompt=prompt,
                 aspect_ratio=Config.GROK_ASPECT_RATIO,
                 resolution=Config.GROK_RESOLUTION,
             )
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Image served from cache (Grok), size: {len(cached)} bytes")
+                return ImageBuffer(cached)
 
-            if getattr(response, "image", None):
-                logger.info(f"Image generated (Grok), size: {len(response.image)} bytes")
-                return response.image
-            if getattr(response, "url", None):
-                logger.info(f"Image generated at: {response.url}")
-                image_response = requests.get(response.url)
-                image_response.raise_for_status()
-                image_bytes = image_response.content
-                logger.info(f"Downloaded image, size: {len(image_bytes)} bytes")
-                return image_bytes
-            raise ValueError("Grok image response had no image or url")
+            with get_limiter().image_call(self.PROVIDER, Config.GROK_IMAGE_MODEL, 1):
+                response = self.client.image.sample(
+                    prompt=prompt,
+                    model=Config.GROK_IMAGE_MODEL,
+                    aspect_ratio=Config.GROK_ASPECT_RATIO,
+                    resolution=Config.GROK_RESOLUTION,
+                )
+            image_bytes = self._response_bytes(response)
+            self.cache.put(cache_key, image_bytes)
+            return image_bytes
         except Exception as e:
             logger.error(f"Error generating meme image (Grok): {e}")
             raise
+
+    def generate_meme_images(self, count: int, style: str = None) -> list:
+        """
+        Generate several coffee meme images in one request using the n parameter.
+
+        Args:
+            count: Number of images (at most MAX_IMAGES_PER_REQUEST)
+            style: Meme style (defaults to MEME_STYLE)
+
+        Returns:
+            list: ImageBuffer per generated image
+        """
+        try:
+            logger.info(f"Generating {count} coffee meme images (Grok)...")
+            with get_limiter().image_call(self.PROVIDER, Config.GROK_IMAGE_MODEL, count):
+                responses = self.client.image.sample_batch(
+                    prompt=self._build_prompt(style),
+                    model=Config.GROK_IMAGE_MODEL,
+                    n=count,
+                    aspect_ratio=Config.GROK_ASPECT_RATIO,
+                    resolution=Config.GROK_RESOLUTION,
+                )
+            return [self._response_bytes(response) for response in responses]
+        except Exception as e:
+            logger.error(f"Error generating meme images (Grok): {e}")
+            raise
+
+    def warm_up(self):
+        """Open the gRPC channel ahead of a run with a free models request."""
+        self.client.models.list_image_generation_models()
+
+    def close(self):
+        """Close the gRPC channel."""
+        self.client.close()
+
+    def release_cached(self):
+        """
+        Drop this run's cached image once the meme has been delivered, so the next
+        run generates a fresh meme instead of resending the cached one.
+        """
+        self.cache.release()
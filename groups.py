@@ -0,0 +1,94 @@
+"""Audience groups: recipient lists that each get their own meme style, provider and schedule."""
+import json
+import logging
+from pathlib import Path
+from config import Config
+import providers
+
+logger = logging.getLogger(__name__)
+
+
+class Group:
+    """One audience: its recipients and the meme settings used for them."""
+
+    def __init__(self, name: str, recipients, style: str = None, provider: str = None, schedule: str = None):
+        """
+        Args:
+            name: Unique group name
+            recipients: Email addresses (list or comma-separated string)
+            style: Meme style (defaults to MEME_STYLE from config)
+            provider: "openai" or "grok" (defaults to AI_PROVIDER from config)
+            schedule: Cron schedule for --daemon (defaults to DAEMON_SCHEDULE from config)
+        """
+        if isinstance(recipients, str):
+            recipients = recipients.split(",")
+        self.name = name
+        self.recipients = [address.strip() for address in recipients or [] if address and address.strip()]
+        self.style = style or Config.MEME_STYLE
+        self.provider = (provider or Config.AI_PROVIDER).strip().lower()
+        self.schedule = schedule or Config.DAEMON_SCHEDULE
+        if not self.recipients:
+            raise ValueError(f"Group {name!r} has no recipients")
+        if self.provider not in providers.PROVIDERS:
+            raise ValueError(f"Group {name!r} has unknown provider {self.provider!r}")
+
+    @property
+    def meme_key(self) -> tuple:
+        """Groups with equal keys are sent the same meme (one caption, one image)."""
+        return (self.provider, self.style)
+
+    def __repr__(self) -> str:
+        return f"Group({self.name!r}, {len(self.recipients)} recipients, {self.provider}/{self.style})"
+
+
+def load_groups(path: str = None, names: list = None) -> list:
+    """
+    Load audience groups from a JSON file.
+
+    The file holds {"groups": [{"name", "recipients", "style", "provider", "schedule"}, ...]};
+    only name and recipients are required.
+
+    Args:
+        path: Groups file (defaults to GROUPS_PATH from config)
+        names: Only return these groups (all if empty)
+
+    Returns:
+        list: Group objects in file order
+
+    Raises:
+        FileNotFoundError: If the file does not exist
+        ValueError: If the file is invalid or a requested name is unknown
+    """
+    path = Path(path or Config.GROUPS_PATH)
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            entries = json.load(f).get("groups", [])
+        except (json.JSONDecodeError, AttributeError) as e:
+            raise ValueError(f"Invalid groups file {path}: {e}")
+
+    groups = []
+    for index, entry in enumerate(entries):
+        try:
+            groups.append(Group(
+                entry["name"],
+                entry["recipients"],
+                style=entry.get("style"),
+                provider=entry.get("provider"),
+                schedule=entry.get("schedule"),
+            ))
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Group #{index + 1} in {path} is missing {e}")
+    seen = set()
+    for group in groups:
+        if group.name in seen:
+            raise ValueError(f"Duplicate group name in {path}: {group.name!r}")
+        seen.add(group.name)
+    if not groups:
+        raise ValueError(f"No groups defined in {path}")
+
+    if names:
+        unknown = set(names) - seen
+        if unknown:
+            raise ValueError(f"Unknown group(s): {', '.join(sorted(unknown))}")
+        groups = [group for group in groups if group.name in names]
+    return groups
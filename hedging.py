@@ -0,0 +1,202 @@
+"""Hedged meme generation across OpenAI and Grok, with per-provider latency tracking."""
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_json, file_lock
+from response_cache import track_writes
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """
+    Rolling window of successful generation latencies per provider.
+
+    Stored as {"<provider>": [{"seconds": ..., "at": ...}, ...]} in a JSON file
+    (replaced atomically under a lock file), so the hedge delay adapts across
+    separate runs of the daily job.
+    """
+
+    MIN_SAMPLES = 5  # Below this the default hedge delay is used
+
+    def __init__(self, path: str = None, window: int = None):
+        """
+        Initialize the tracker.
+
+        Args:
+            path: History file (defaults to LATENCY_HISTORY_PATH from config)
+            window: Samples kept per provider (defaults to LATENCY_WINDOW from config)
+        """
+        self.path = Path(path or Config.LATENCY_HISTORY_PATH)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.window = window or Config.LATENCY_WINDOW
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring corrupt latency history: {self.path}")
+            return {}
+
+    def record(self, provider: str, seconds: float):
+        """Add a successful generation latency; write failures are logged, not raised."""
+        try:
+            with self._lock, file_lock(self.lock_path):
+                history = self._read()
+                samples = history.get(provider, [])
+                samples.append({"seconds": round(seconds, 3), "at": datetime.now().isoformat()})
+                history[provider] = samples[-self.window:]
+                atomic_write_json(self.path, history)
+        except (OSError, TimeoutError) as e:
+            logger.warning(f"Could not record {provider} latency: {e}")
+
+    def percentile(self, provider: str, pct: float):
+        """
+        Latency percentile (nearest rank) over the provider's window.
+
+        Returns:
+            float: Seconds, or None with fewer than MIN_SAMPLES samples
+        """
+        samples = sorted(sample["seconds"] for sample in self._read().get(provider, []))
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        rank = max(1, math.ceil(pct / 100 * len(samples)))
+        return samples[rank - 1]
+
+    def hedge_delay(self, provider: str) -> float:
+        """Seconds to wait on provider before starting the backup (its p-HEDGE_PERCENTILE latency)."""
+        latency = self.percentile(provider, Config.HEDGE_PERCENTILE)
+        if latency is None:
+            return Config.HEDGE_DEFAULT_DELAY_SECONDS
+        return max(Config.HEDGE_MIN_DELAY_SECONDS, latency)
+
+
+class HedgedService:
+    """
+    A primary provider service backed by a second one.
+
+    run() starts the primary; if it has not produced a result within its hedge
+    delay (or fails), the backup is started as well and the first success wins.
+    Workers are daemon threads, so a slow loser is simply ignored and never
+    holds up the process; its latency is still recorded if it finishes, and any
+    responses it cached are dropped.
+    """
+
+    def __init__(self, primary, backup, tracker: LatencyTracker = None):
+        """
+        Args:
+            primary: Service for the configured AI_PROVIDER
+            backup: Service for the other provider
+            tracker: Latency history (defaults to a LatencyTracker)
+        """
+        self.primary = primary
+        self.backup = backup
+        self.tracker = tracker or LatencyTracker()
+        self.winner = None
+
+    @property
+    def PROVIDER(self) -> str:
+        """The primary's provider name, so callers can treat this like a single provider service."""
+        return self.primary.PROVIDER
+
+    @staticmethod
+    def _discard_writes(service, written: list):
+        """Drop what a losing request cached, so no later run serves it as its own."""
+        for run_cache, key in written:
+            run_cache.discard(key)
+        if written:
+            logger.info(f"Dropped {len(written)} cached response(s) of the losing {service.PROVIDER} request")
+
+    def _start(self, service, fn, results: queue.Queue, decided: dict):
+        def work():
+            started = time.monotonic()
+            with track_writes() as written:
+                try:
+                    result, error = fn(service), None
+                except Exception as e:
+                    result, error = None, e
+            if error is None:
+                self.tracker.record(service.PROVIDER, time.monotonic() - started)
+            with decided["lock"]:
+                if not decided["done"]:
+                    results.put((service, result, error, written))
+                    return
+            self._discard_writes(service, written)
+
+        threading.Thread(target=work, name=f"hedge-{service.PROVIDER}", daemon=True).start()
+
+    def run(self, fn):
+        """
+        Run fn(service) hedged across the two providers.
+
+        Args:
+            fn: Callable taking a provider service and returning its result
+
+        Returns:
+            The first successful result (the service that produced it is in self.winner)
+
+        Raises:
+            Exception: The primary's error if both providers fail
+        """
+        results = queue.Queue()
+        decided = {"lock": threading.Lock(), "done": False}  # Once done, finishing workers discard themselves
+        delay = self.tracker.hedge_delay(self.primary.PROVIDER)
+        self._start(self.primary, fn, results, decided)
+        running = 1
+        hedged = False
+        errors = {}
+        while True:
+            try:
+                service, result, error, _ = results.get(timeout=None if hedged else delay)
+            except queue.Empty:
+                service, result, error = None, None, None
+            if service is not None:
+                running -= 1
+            if error is None and service is not None:
+                if hedged:
+                    logger.info(f"Hedged request won by {service.PROVIDER}")
+                self.winner = service
+                with decided["lock"]:
+                    decided["done"] = True
+                    leftovers = []
+                    while not results.empty():
+                        leftovers.append(results.get_nowait())
+                for loser, _, _, written in leftovers:
+                    self._discard_writes(loser, written)
+                return result
+            if error is not None:
+                errors[service.PROVIDER] = error
+                logger.warning(f"{service.PROVIDER} failed: {error}")
+            if not hedged:
+                reason = "failed" if error is not None else f"no result after {delay:.1f}s"
+                logger.info(f"{self.primary.PROVIDER} {reason}, starting {self.backup.PROVIDER} as backup")
+                self._start(self.backup, fn, results, decided)
+                running += 1
+                hedged = True
+            elif running == 0:
+                raise errors.get(self.primary.PROVIDER) or next(iter(errors.values()))
+
+    def release_cached(self):
+        """Release cached responses of both providers."""
+        self.primary.release_cached()
+        self.backup.release_cached()
+
+    def warm_up(self):
+        """Open connections to both providers."""
+        self.primary.warm_up()
+        self.backup.warm_up()
+
+    def close(self):
+        """Close both providers' clients."""
+        self.primary.close()
+        self.backup.close()
@@ -0,0 +1,218 @@
+"""Shared HTTP transport: one pooled session with retries, timeouts and capped streaming downloads."""
+import logging
+import os
+import threading
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import Config
+from image_buffer import ImageBuffer, as_view
+import run_metrics
+
+logger = logging.getLogger(__name__)
+
+# Chunk size for streaming downloads
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+# Transient statuses worth retrying (rate limit and gateway/server hiccups)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class ResponseTooLarge(requests.exceptions.RequestException):
+    """A download exceeded the byte cap and was aborted."""
+
+
+def timeout() -> tuple:
+    """(connect, read) timeout in seconds for every request."""
+    return (Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT)
+
+
+def _build_session() -> requests.Session:
+    retry = Retry(
+        total=Config.HTTP_RETRIES,
+        connect=Config.HTTP_RETRIES,
+        read=Config.HTTP_RETRIES,
+        status=Config.HTTP_RETRIES,
+        backoff_factor=Config.HTTP_BACKOFF_SECONDS,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD", "POST"}),  # Uploads here are safe to repeat
+        respect_retry_after_header=True,
+        raise_on_status=False,  # Hand the final response to raise_for_status for a clear error
+    )
+    adapter = HTTPAdapter(
+        pool_connections=Config.HTTP_POOL_SIZE,
+        pool_maxsize=Config.HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "coffee-meme-generator"
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the process-wide session, creating it on first use (thread-safe)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def close():
+    """Close pooled connections (a later request opens a new session)."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _count_retries(response: requests.Response):
+    """Add the retries urllib3 made for a response to the run metrics."""
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None:
+        run_metrics.count("http_retries", len(retries.history))
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """POST through the shared session with the default timeout and retries."""
+    kwargs.setdefault("timeout", timeout())
+    with run_metrics.span("upload"):
+        response = get_session().post(url, **kwargs)
+    _count_retries(response)
+    return response
+
+
+class MultipartBody:
+    """
+    A multipart/form-data body that streams a file straight from its buffer.
+
+    Only the part headers are built in memory; the file itself is read in slices of
+    a memoryview, so an upload is neither base64-encoded nor copied into one body.
+    tell()/seek() let urllib3 rewind the body when it retries the request.
+    """
+
+    def __init__(self, fields: dict, name: str, filename: str, data, content_type: str):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = "".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+            for key, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        )
+        self._parts = [
+            memoryview(head.encode('utf-8')),
+            as_view(data).cast("B"),
+            memoryview(f"\r\n--{boundary}--\r\n".encode('utf-8')),
+        ]
+        self._length = sum(len(part) for part in self._parts)
+        self._position = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: self._length}[whence]
+        self._position = max(0, min(self._length, base + offset))
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._length - self._position
+        chunks = []
+        offset = 0
+        for part in self._parts:
+            start = self._position - offset
+            offset += len(part)
+            if size <= 0 or start >= len(part):
+                continue
+            chunk = part[max(0, start):max(0, start) + size]
+            chunks.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+
+def post_file(url: str, data, filename: str, content_type: str, name: str = "image",
+              fields: dict = None, **kwargs) -> requests.Response:
+    """
+    POST a file as streamed binary multipart through the shared session.
+
+    Args:
+        url: Upload URL
+        data: File contents (bytes-like or ImageBuffer)
+        filename: Filename sent with the file part
+        content_type: MIME type of the file part
+        name: Form field name of the file part
+        fields: Extra form fields sent before the file
+        **kwargs: Passed on to requests (e.g. headers, timeout)
+    """
+    body = MultipartBody(fields or {}, name, filename, data, content_type)
+    headers = {**kwargs.pop("headers", {}), "Content-Type": body.content_type}
+    kwargs.setdefault("timeout", timeout())
+    with run_metrics.span("upload", bytes=len(body)):
+        response = get_session().post(url, data=body, headers=headers, **kwargs)
+    _count_retries(response)
+    return response
+
+
+def _capped_chunks(response: requests.Response, max_bytes: int):
+    """Yield body chunks, aborting as soon as the total passes max_bytes."""
+    received = 0
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+        received += len(chunk)
+        if received > max_bytes:
+            raise ResponseTooLarge(f"Download exceeded {max_bytes} bytes, aborted")
+        yield chunk
+
+
+def download(url: str, max_bytes: int = None) -> ImageBuffer:
+    """
+    Stream a URL into an ImageBuffer without holding the body in a single bytes object.
+
+    Connection errors and retryable statuses are retried by the session; a body that
+    breaks off mid-stream is downloaded again. Responses whose Content-Length is over
+    the cap are rejected before any body is read.
+
+    Args:
+        url: URL to fetch
+        max_bytes: Byte cap (defaults to HTTP_MAX_DOWNLOAD_MB from config)
+
+    Returns:
+        ImageBuffer: The response body
+
+    Raises:
+        ResponseTooLarge: If the body is larger than max_bytes
+        requests.exceptions.RequestException: On HTTP or network errors
+    """
+    max_bytes = max_bytes if max_bytes is not None else int(Config.HTTP_MAX_DOWNLOAD_MB * 1024 * 1024)
+    attempts = Config.HTTP_RETRIES + 1
+    for attempt in range(1, attempts + 1):
+        try:
+            with run_metrics.span("download") as span:
+                with get_session().get(url, stream=True, timeout=timeout()) as response:
+                    _count_retries(response)
+                    response.raise_for_status()
+                    length = int(response.headers.get("Content-Length") or 0)
+                    if length > max_bytes:
+                        raise ResponseTooLarge(f"Content-Length {length} exceeds {max_bytes} bytes")
+                    image = ImageBuffer.from_chunks(_capped_chunks(response, max_bytes), size_hint=length)
+                    span["bytes"] = len(image)
+                    return image
+        except requests.exceptions.ChunkedEncodingError as e:
+            if attempt == attempts:
+                raise
+            run_metrics.count("http_retries")
+            logger.warning(f"Download interrupted ({e}), retrying ({attempt}/{attempts - 1})...")
@@ -0,0 +1,160 @@
+"""Zero-copy image buffer passed between pipeline stages."""
+import io
+import logging
+import mmap
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class _MemoryViewReader(io.RawIOBase):
+    """Seekable read-only file object over a memoryview (io.BytesIO would copy it)."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self._view[self._pos:self._pos + len(buffer)]
+        size = len(chunk)
+        buffer[:size] = chunk
+        self._pos += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+class ImageBuffer:
+    """
+    Image bytes that move through the pipeline without being copied.
+
+    Wraps whatever the producer already holds (bytes from an SDK, a bytearray
+    filled from a download, the BytesIO Pillow encoded into) and hands out
+    memoryviews and file objects over it. Downloads larger than SPOOL_THRESHOLD
+    are spooled to an anonymous temp file and memory-mapped instead of being held
+    on the heap.
+
+    Stages accept either an ImageBuffer or plain bytes; use as_view() and
+    open_reader() instead of bytes(...) or io.BytesIO(...) to keep it copy-free.
+    """
+
+    SPOOL_THRESHOLD = 8 * 1024 * 1024  # Bytes before a streamed download spills to disk
+
+    def __init__(self, data):
+        """
+        Wrap existing image data without copying it.
+
+        Args:
+            data: bytes, bytearray, memoryview, mmap or io.BytesIO holding the image
+        """
+        if isinstance(data, io.BytesIO):
+            self._owner = data
+            self._view = data.getbuffer()
+        else:
+            self._owner = data
+            self._view = memoryview(data)
+        self._file = None
+
+    @classmethod
+    def from_chunks(cls, chunks, size_hint: int = None) -> "ImageBuffer":
+        """
+        Build a buffer from an iterable of byte chunks (e.g. a streamed HTTP body).
+
+        Small bodies are collected in a single bytearray; bodies that grow past
+        SPOOL_THRESHOLD are moved to a temp file and memory-mapped.
+
+        Args:
+            chunks: Iterable of bytes-like chunks
+            size_hint: Expected total size (e.g. Content-Length), used to spool up front
+        """
+        spool = None
+        data = bytearray()
+        if size_hint and size_hint > cls.SPOOL_THRESHOLD:
+            spool = tempfile.TemporaryFile()
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if spool is None and len(data) + len(chunk) > cls.SPOOL_THRESHOLD:
+                spool = tempfile.TemporaryFile()
+                spool.write(data)
+                data = None
+            if spool is not None:
+                spool.write(chunk)
+            else:
+                data += chunk
+
+        if spool is None:
+            return cls(data)
+        spool.flush()
+        size = spool.tell()
+        if size == 0:
+            spool.close()
+            return cls(b"")
+        logger.debug(f"Spooled {size} byte image to a memory-mapped temp file")
+        buffer = cls(mmap.mmap(spool.fileno(), size, access=mmap.ACCESS_READ))
+        buffer._file = spool
+        return buffer
+
+    def __len__(self) -> int:
+        return self._view.nbytes
+
+    def view(self) -> memoryview:
+        """Return a read-only memoryview of the image bytes (no copy)."""
+        return self._view.toreadonly()
+
+    def open(self) -> io.BufferedReader:
+        """Return a seekable file object reading the image bytes (no copy)."""
+        return io.BufferedReader(_MemoryViewReader(self._view))
+
+    def write_to(self, fileobj):
+        """Write the image bytes to an open binary file (no copy)."""
+        fileobj.write(self._view)
+
+    def tobytes(self) -> bytes:
+        """Return the image as a bytes object (copies unless already backed by bytes)."""
+        if isinstance(self._owner, bytes):
+            return self._owner
+        return self._view.tobytes()
+
+    def release(self):
+        """Release the view and any spooled temp file."""
+        self._view.release()
+        if isinstance(self._owner, mmap.mmap):
+            self._owner.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def as_view(data) -> memoryview:
+    """Return a memoryview over an ImageBuffer or bytes-like object (no copy)."""
+    if isinstance(data, ImageBuffer):
+        return data.view()
+    return memoryview(data)
+
+
+def open_reader(data):
+    """Return a seekable file object over an ImageBuffer or bytes-like object (no copy)."""
+    if isinstance(data, ImageBuffer):
+        return data.open()
+    if isinstance(data, bytes):
+        # BytesIO shares an immutable bytes object instead of copying it
+        return io.BytesIO(data)
+    return ImageBuffer(data).open()
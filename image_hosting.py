@@ -1,17 +1,89 @@
 """Image hosting service for making images publicly accessible for Twilio MMS."""
+import hashlib
+import json
 import logging
-import base64
+import queue
+import threading
+from datetime import datetime
+from pathlib import Path
 import requests
+import http_client
 from config import Config
+from file_utils import atomic_write_json, file_lock
+from image_buffer import as_view
 
 logger = logging.getLogger(__name__)
 
+IMGBB_UPLOAD_URL = 'https://api.imgbb.com/1/upload'
+IMGUR_UPLOAD_URL = 'https://api.imgur.com/3/image'
+
+UPLOAD_CACHE_MAX_ENTRIES = 5000  # Oldest uploads are forgotten past this
+
+
+def _image_type(image_bytes) -> tuple:
+    """(filename, MIME type) for the upload, from the image's magic bytes."""
+    head = bytes(as_view(image_bytes)[:8])
+    if head.startswith(b'\x89PNG'):
+        return 'meme.png', 'image/png'
+    if head.startswith(b'GIF8'):
+        return 'meme.gif', 'image/gif'
+    return 'meme.jpg', 'image/jpeg'
+
+
+class UploadCache:
+    """
+    Public URLs of uploaded images keyed by a SHA-256 of their content, so the
+    same image is never uploaded twice. Shared by every process through a JSON file.
+    """
+    
+    def __init__(self, path: str = None):
+        """
+        Args:
+            path: Cache file (defaults to UPLOAD_CACHE_PATH from config; empty = off)
+        """
+        path = path if path is not None else Config.UPLOAD_CACHE_PATH
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(image_bytes) -> str:
+        """Content hash of an image."""
+        return hashlib.sha256(as_view(image_bytes)).hexdigest()
+    
+    def _read(self) -> dict:
+        if self.path is None or not self.path.exists():
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring corrupt upload cache: {self.path}")
+            return {}
+    
+    def get(self, key: str):
+        """Return the cached URL for a content hash, or None."""
+        entry = self._read().get(key)
+        return entry["url"] if entry else None
+    
+    def put(self, key: str, url: str, host: str):
+        """Record the URL an image was uploaded to (no-op when the cache is off)."""
+        if self.path is None:
+            return
+        lock_path = self.path.with_name(self.path.name + ".lock")
+        with self._lock, file_lock(lock_path):
+            entries = self._read()
+            entries[key] = {"url": url, "host": host, "uploaded": datetime.now().isoformat()}
+            if len(entries) > UPLOAD_CACHE_MAX_ENTRIES:
+                newest = sorted(entries.items(), key=lambda item: item[1]["uploaded"])[-UPLOAD_CACHE_MAX_ENTRIES:]
+                entries = dict(newest)
+            atomic_write_json(self.path, entries)
+
 
 class ImageHostingService:
     """Service for uploading images to a hosting service for public access."""
     
     @staticmethod
-    def upload_to_imgbb(image_bytes: bytes, api_key: str = None) -> str:
+    def upload_to_imgbb(image_bytes, api_key: str = None) -> str:
         """
         Upload image to ImgBB and return the public URL.
         
@@ -19,7 +91,7 @@ class ImageHostingService:
         Works without API key for basic usage.
         
         Args:
-            image_bytes: Image data as bytes
+            image_bytes: Image data (bytes-like or ImageBuffer)
             api_key: ImgBB API key (optional, but recommended for higher rate limits)
                     Get one at: https://api.imgbb.com/ (free, no registration issues)
             
@@ -29,25 +101,23 @@ class ImageHostingService:
         try:
             logger.info("Uploading image to ImgBB...")
             
-            # Encode image to base64
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            # Prepare data
-            data = {'image': image_b64}
-            
             # Add API key if provided (for higher rate limits)
+            fields = {}
             api_key = api_key or Config.IMGBB_API_KEY
             if api_key:
-                data['key'] = api_key
+                fields['key'] = api_key
                 logger.debug("Using ImgBB API key for higher rate limits")
             else:
                 logger.info("Using ImgBB without API key (basic mode)")
             
-            # Upload to ImgBB
-            response = requests.post(
-                'https://api.imgbb.com/1/upload',
-                data=data,
-                timeout=30
+            # Upload to ImgBB as a binary file part (no base64 copy)
+            filename, content_type = _image_type(image_bytes)
+            response = http_client.post_file(
+                IMGBB_UPLOAD_URL,
+                image_bytes,
+                filename,
+                content_type,
+                fields=fields
             )
             response.raise_for_status()
             
@@ -77,7 +147,7 @@ class ImageHostingService:
             raise
     
     @staticmethod
-    def upload_to_imgur(image_bytes: bytes, client_id: str = None) -> str:
+    def upload_to_imgur(image_bytes, client_id: str = None) -> str:
         """
         Upload image to Imgur and return the public URL.
         
@@ -85,7 +155,7 @@ class ImageHostingService:
         Get one at: https://api.imgur.com/oauth2/addclient
         
         Args:
-            image_bytes: Image data as bytes
+            image_bytes: Image data (bytes-like or ImageBuffer)
             client_id: Imgur client ID (required)
                       Get one at: https://api.imgur.com/oauth2/addclient
             
@@ -110,17 +180,18 @@ class ImageHostingService:
         try:
             logger.info("Uploading image to Imgur...")
             
-            # Encode image to base64
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            
             # Prepare headers with Client ID
             headers = {'Authorization': f'Client-ID {actual_client_id}'}
             
-            # Upload to Imgur
-            response = requests.post(
-                'https://api.imgur.com/3/image',
-                headers=headers,
-                data={'image': image_b64}
+            # Upload to Imgur as a binary file part (no base64 copy)
+            filename, content_type = _image_type(image_bytes)
+            response = http_client.post_file(
+                IMGUR_UPLOAD_URL,
+                image_bytes,
+                filename,
+                content_type,
+                fields={'type': 'file'},
+                headers=headers
             )
             response.raise_for_status()
             
@@ -148,7 +219,7 @@ class ImageHostingService:
             raise
     
     @staticmethod
-    def upload_to_imgur_anonymous(image_bytes: bytes) -> str:
+    def upload_to_imgur_anonymous(image_bytes) -> str:
         """
         Upload image to Imgur using the Client ID from config.
         
@@ -156,7 +227,7 @@ class ImageHostingService:
         Imgur's API does not support truly anonymous uploads.
         
         Args:
-            image_bytes: Image data as bytes
+            image_bytes: Image data (bytes-like or ImageBuffer)
             
         Returns:
             str: Public URL of the uploaded image
@@ -164,21 +235,46 @@ class ImageHostingService:
         return ImageHostingService.upload_to_imgur(image_bytes, client_id=None)
     
     @staticmethod
-    def upload_image(image_bytes: bytes) -> str:
+    def _race(image_bytes) -> tuple:
         """
-        Upload image using the configured hosting service.
+        Upload to ImgBB and Imgur at the same time and return the first (host, URL).
         
-        Tries ImgBB first (default, no registration issues), falls back to Imgur if configured.
+        The slower upload is left to finish in a daemon thread; its URL is discarded.
         
-        Args:
-            image_bytes: Image data as bytes
-            
-        Returns:
-            str: Public URL of the uploaded image
+        Raises:
+            Exception: If both uploads fail
         """
+        results = queue.Queue()
+        
+        def upload(host, fn):
+            try:
+                results.put((host, fn(image_bytes), None))
+            except Exception as e:
+                results.put((host, None, e))
+        
+        hosts = {'imgbb': ImageHostingService.upload_to_imgbb, 'imgur': ImageHostingService.upload_to_imgur}
+        for host, fn in hosts.items():
+            threading.Thread(target=upload, args=(host, fn), name=f"upload-{host}", daemon=True).start()
+        
+        errors = {}
+        for _ in hosts:
+            host, url, error = results.get()
+            if error is None:
+                logger.info(f"{host} won the upload race")
+                return host, url
+            logger.warning(f"{host} upload failed: {error}")
+            errors[host] = error
+        raise Exception(
+            f"Both image hosting services failed. ImgBB error: {errors['imgbb']}. "
+            f"Imgur error: {errors['imgur']}. Please check your configuration."
+        )
+    
+    @staticmethod
+    def _upload_with_fallback(image_bytes) -> tuple:
+        """Upload to ImgBB, falling back to Imgur if configured; returns (host, URL)."""
         # Try ImgBB first (works without API key, no registration issues)
         try:
-            return ImageHostingService.upload_to_imgbb(image_bytes)
+            return 'imgbb', ImageHostingService.upload_to_imgbb(image_bytes)
         except Exception as e:
             logger.warning(f"ImgBB upload failed: {e}")
             
@@ -186,7 +282,7 @@ class ImageHostingService:
             if Config.IMGUR_CLIENT_ID:
                 logger.info("Falling back to Imgur...")
                 try:
-                    return ImageHostingService.upload_to_imgur(image_bytes)
+                    return 'imgur', ImageHostingService.upload_to_imgur(image_bytes)
                 except Exception as imgur_error:
                     logger.error(f"Imgur upload also failed: {imgur_error}")
                     raise Exception(
@@ -197,4 +293,39 @@ class ImageHostingService:
                 raise Exception(
                     f"ImgBB upload failed and no Imgur Client ID configured. "
                     f"Error: {e}. Consider getting a free ImgBB API key at https://api.imgbb.com/"
-                )
\ No newline at end of file
+                )
+    
+    @staticmethod
+    def upload_image(image_bytes, cache: UploadCache = None) -> str:
+        """
+        Upload image using the configured hosting service.
+        
+        An image uploaded before (same content hash) returns its cached URL without
+        uploading. Otherwise tries ImgBB first (default, no registration issues) and
+        falls back to Imgur if configured; with IMAGE_HOST_RACE both hosts are tried
+        at once and the first URL wins, so a slow ImgBB failure does not delay Imgur.
+        
+        Args:
+            image_bytes: Image data (bytes-like or ImageBuffer)
+            cache: URL cache (defaults to one at UPLOAD_CACHE_PATH)
+            
+        Returns:
+            str: Public URL of the uploaded image
+        """
+        cache = cache or UploadCache()
+        key = cache.key(image_bytes)
+        url = cache.get(key)
+        if url:
+            logger.info(f"Image already uploaded, reusing {url}")
+            return url
+        
+        if Config.IMAGE_HOST_RACE and Config.IMGUR_CLIENT_ID:
+            host, url = ImageHostingService._race(image_bytes)
+        else:
+            host, url = ImageHostingService._upload_with_fallback(image_bytes)
+        
+        try:
+            cache.put(key, url, host)
+        except (OSError, TimeoutError) as e:
+            logger.warning(f"Could not record uploaded URL: {e}")
+        return url
@@ -1,89 +1,318 @@
 """Image processing utilities for SMS compatibility."""
 import logging
 import io
+import math
 from PIL import Image
 from config import Config
+from image_buffer import ImageBuffer, open_reader
 
 logger = logging.getLogger(__name__)
 
 
+class ImageTooLarge(ValueError):
+    """An image has more pixels than MAX_IMAGE_PIXELS allows (decompression bomb guard)."""
+
+
+class Rendition:
+    """One output variant of a meme: longest side, format and optional byte budget."""
+    
+    # Spec format name -> (Pillow format, file extension)
+    FORMATS = {
+        "jpeg": ("JPEG", "jpg"),
+        "jpg": ("JPEG", "jpg"),
+        "webp": ("WEBP", "webp"),
+        "png": ("PNG", "png"),
+    }
+    
+    def __init__(self, name: str, max_dimension: int, format: str = "jpeg", max_bytes: int = None, quality: int = 85):
+        """
+        Args:
+            name: Variant name (e.g. "email", "thumb")
+            max_dimension: Longest side in pixels; smaller images are not upscaled
+            format: "jpeg", "webp" or "png"
+            max_bytes: JPEG only: highest quality that fits this many bytes (None = fixed quality)
+            quality: Quality for JPEG without max_bytes and for WebP
+        """
+        if format.lower() not in self.FORMATS:
+            raise ValueError(f"Unknown rendition format {format!r} (expected one of {', '.join(self.FORMATS)})")
+        if max_dimension < 1:
+            raise ValueError(f"Rendition {name!r} needs a positive max dimension")
+        self.name = name
+        self.max_dimension = max_dimension
+        self.format, self.extension = self.FORMATS[format.lower()]
+        self.max_bytes = max_bytes
+        self.quality = quality
+    
+    def __repr__(self) -> str:
+        return f"Rendition({self.name!r}, {self.max_dimension}px, {self.format})"
+
+
+def parse_renditions(spec: str) -> list:
+    """
+    Parse a rendition list like "mms:640:jpeg:300,thumb:256:jpeg,web:1200:webp".
+    
+    Each entry is name:max_px[:format[:max_kb]]; format defaults to jpeg and
+    max_kb (JPEG only) turns on size targeting.
+    
+    Raises:
+        ValueError: If an entry is malformed
+    """
+    renditions = []
+    for entry in (spec or "").split(","):
+        if not entry.strip():
+            continue
+        fields = [field.strip() for field in entry.split(":")]
+        if len(fields) < 2 or len(fields) > 4:
+            raise ValueError(f"Invalid rendition {entry.strip()!r} (expected name:max_px[:format[:max_kb]])")
+        try:
+            max_dimension = int(fields[1])
+            max_bytes = int(float(fields[3]) * 1024) if len(fields) > 3 and fields[3] else None
+        except ValueError:
+            raise ValueError(f"Invalid rendition {entry.strip()!r}: size fields must be numbers")
+        renditions.append(Rendition(fields[0], max_dimension, fields[2] if len(fields) > 2 and fields[2] else "jpeg", max_bytes))
+    return renditions
+
+
 class ImageProcessor:
     """Service for processing images to meet SMS/MMS requirements."""
     
-    MAX_SIZE_MB = Config.MAX_IMAGE_SIZE_MB
-    MAX_SIZE_BYTES = int(MAX_SIZE_MB * 1024 * 1024)
-    
     # Common MMS size limits by carrier (use the most restrictive)
     MAX_DIMENSION = 1600  # Maximum width or height in pixels
     
+    # JPEG quality search range and encode budget for size targeting
+    MAX_QUALITY = 95
+    MIN_QUALITY = 50
+    MAX_ENCODES = 4
+    
+    # Progressive JPEGs are smaller for all but tiny images
+    PROGRESSIVE_MIN_PIXELS = 256 * 256
+    
+    # JPEG draft decoding stops at this multiple of the largest rendition, so the
+    # final LANCZOS resize still has enough pixels to filter from (as Image.thumbnail does)
+    DRAFT_GAP = 2
+    
+    @classmethod
+    def email_rendition(cls) -> Rendition:
+        """The email attachment: MAX_DIMENSION JPEG that fits MAX_IMAGE_SIZE_MB."""
+        # Read on every call so a Config.reload() in the daemon applies a new limit
+        return Rendition("email", cls.MAX_DIMENSION, "jpeg", int(Config.MAX_IMAGE_SIZE_MB * 1024 * 1024))
+    
+    @classmethod
+    def configured_renditions(cls) -> list:
+        """The email rendition followed by the extra variants from IMAGE_RENDITIONS."""
+        extras = parse_renditions(Config.IMAGE_RENDITIONS)
+        if any(rendition.name == "email" for rendition in extras):
+            raise ValueError("IMAGE_RENDITIONS cannot redefine the \"email\" rendition")
+        return [cls.email_rendition()] + extras
+    
     @classmethod
-    def process_for_sms(cls, image_bytes: bytes) -> bytes:
+    def process_for_sms(cls, image_bytes) -> ImageBuffer:
         """
         Process image to ensure it meets SMS/MMS requirements.
         
         Args:
-            image_bytes: Original image as bytes
-            
+            image_bytes: Original image as ImageBuffer or bytes
+        
+        Returns:
+            ImageBuffer: Processed JPEG image
+        """
+        processed_bytes, _ = cls.process_for_sms_with_stats(image_bytes)
+        return processed_bytes
+    
+    @classmethod
+    def process_for_sms_with_stats(cls, image_bytes) -> tuple:
+        """
+        Process image like process_for_sms and also report encoder statistics.
+        
+        Args:
+            image_bytes: Original image as ImageBuffer or bytes
+        
         Returns:
-            bytes: Processed image as bytes
+            tuple: (processed ImageBuffer, stats dict from encode_to_target)
+        """
+        return cls.render(image_bytes, [cls.email_rendition()])["email"]
+    
+    @classmethod
+    def render(cls, image_bytes, renditions: list = None) -> dict:
         """
+        Decode an image once and encode every rendition from a resize pyramid.
+        
+        JPEG sources are decoded in draft mode at the smallest 1/2, 1/4 or 1/8 scale
+        that still covers the largest rendition. Renditions are then produced from the
+        largest down, each resized from the previous level rather than the full image.
+        
+        Args:
+            image_bytes: Original image as ImageBuffer or bytes
+            renditions: Variants to produce (defaults to configured_renditions())
+        
+        Returns:
+            dict: {rendition name: (ImageBuffer, stats dict)}; stats include the file
+                  extension, and JPEG renditions with a byte budget carry the stats
+                  from encode_to_target
+        
+        Raises:
+            ImageTooLarge: If the decoded image would exceed MAX_IMAGE_PIXELS
+        """
+        renditions = renditions or cls.configured_renditions()
         try:
             logger.info(f"Processing image for SMS. Original size: {len(image_bytes)} bytes")
             
-            # Open image
-            image = Image.open(io.BytesIO(image_bytes))
-            original_format = image.format
+            # Open image (reads the header only)
+            image = Image.open(open_reader(image_bytes))
+            source_size = image.size
+            largest = max(rendition.max_dimension for rendition in renditions)
+            if max(source_size) > largest * cls.DRAFT_GAP:
+                # A no-op for formats other than JPEG
+                image.draft(None, (largest * cls.DRAFT_GAP, largest * cls.DRAFT_GAP))
+                if image.size != source_size:
+                    logger.info(f"Draft decoding {source_size[0]}x{source_size[1]} at {image.size[0]}x{image.size[1]}")
             
-            # Convert RGBA to RGB if necessary (for JPEG compatibility)
-            if image.mode in ('RGBA', 'LA', 'P'):
-                logger.info(f"Converting image from {image.mode} to RGB")
-                rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                if image.mode == 'P':
-                    image = image.convert('RGBA')
-                rgb_image.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                image = rgb_image
-            
-            # Resize if dimensions are too large
+            # Refuse decompression bombs before any pixels are allocated
             width, height = image.size
-            if width > cls.MAX_DIMENSION or height > cls.MAX_DIMENSION:
-                logger.info(f"Resizing image from {width}x{height} to fit {cls.MAX_DIMENSION}px limit")
-                image.thumbnail((cls.MAX_DIMENSION, cls.MAX_DIMENSION), Image.Resampling.LANCZOS)
-            
-            # Compress to meet size requirements
-            output = io.BytesIO()
-            quality = 95
-            
-            # Try to save as JPEG (more efficient for photos/memes)
-            image_format = 'JPEG'
-            if original_format == 'PNG' and image.mode == 'RGB':
-                # Convert PNG to JPEG for better compression
-                image_format = 'JPEG'
-            
-            while True:
-                output.seek(0)
-                output.truncate(0)
-                
-                image.save(output, format=image_format, quality=quality, optimize=True)
-                size = len(output.getvalue())
-                
-                if size <= cls.MAX_SIZE_BYTES or quality <= 50:
-                    break
-                
-                quality -= 5
-                logger.debug(f"Image too large ({size} bytes), reducing quality to {quality}")
-            
-            processed_bytes = output.getvalue()
-            logger.info(f"Processed image size: {len(processed_bytes)} bytes (quality: {quality})")
-            
-            if len(processed_bytes) > cls.MAX_SIZE_BYTES:
-                logger.warning(
-                    f"Image size ({len(processed_bytes)} bytes) still exceeds limit "
-                    f"({cls.MAX_SIZE_BYTES} bytes) after processing. "
-                    f"Some carriers may reject this message."
+            if width * height > Config.MAX_IMAGE_PIXELS:
+                raise ImageTooLarge(
+                    f"Image is {width}x{height} ({width * height} pixels), "
+                    f"over the MAX_IMAGE_PIXELS limit of {Config.MAX_IMAGE_PIXELS}"
                 )
             
-            return processed_bytes
-            
+            level = cls._flatten(image)
+            results = {}
+            for rendition in sorted(renditions, key=lambda r: r.max_dimension, reverse=True):
+                if max(level.size) > rendition.max_dimension:
+                    size = cls._fit(source_size, rendition.max_dimension)
+                    logger.info(f"Resizing image from {level.size[0]}x{level.size[1]} to {size[0]}x{size[1]} for {rendition.name}")
+                    level = level.resize(size, Image.Resampling.LANCZOS)
+                results[rendition.name] = cls._encode(level, rendition)
+            return results
+        
         except Exception as e:
             logger.error(f"Error processing image: {e}")
             raise
+    
+    @staticmethod
+    def _flatten(image: Image.Image) -> Image.Image:
+        """Decode and convert to RGB (or keep L), compositing transparency onto white."""
+        # Convert RGBA to RGB if necessary (for JPEG compatibility)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            logger.info(f"Converting image from {image.mode} to RGB")
+            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+            if image.mode == 'P':
+                image = image.convert('RGBA')
+            rgb_image.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
+            return rgb_image
+        if image.mode not in ('RGB', 'L'):
+            return image.convert('RGB')
+        image.load()
+        return image
+    
+    @staticmethod
+    def _fit(size: tuple, max_dimension: int) -> tuple:
+        """Size that fits max_dimension with the source aspect ratio (computed from the source, so levels don't drift)."""
+        scale = max_dimension / max(size)
+        return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    
+    @classmethod
+    def _encode(cls, image: Image.Image, rendition: Rendition) -> tuple:
+        """Encode one rendition; returns (ImageBuffer, stats)."""
+        if rendition.format == 'JPEG' and rendition.max_bytes:
+            data, stats = cls.encode_to_target(image, rendition.max_bytes)
+            logger.info(
+                f"Processed {rendition.name} image size: {len(data)} bytes "
+                f"(quality: {stats['quality']}, encodes: {stats['encodes']}, "
+                f"subsampling: {stats['subsampling']}, progressive: {stats['progressive']})"
+            )
+            stats["extension"] = rendition.extension
+            if len(data) > rendition.max_bytes:
+                logger.warning(
+                    f"Image size ({len(data)} bytes) still exceeds limit "
+                    f"({rendition.max_bytes} bytes) after processing. "
+                    f"Some carriers may reject this message."
+                )
+            return data, stats
+        
+        output = io.BytesIO()
+        if rendition.format == 'JPEG':
+            progressive = image.size[0] * image.size[1] >= cls.PROGRESSIVE_MIN_PIXELS
+            image.save(output, format='JPEG', quality=rendition.quality, optimize=True, progressive=progressive)
+        elif rendition.format == 'WEBP':
+            image.save(output, format='WEBP', quality=rendition.quality, method=4)
+        else:
+            image.save(output, format='PNG', optimize=True)
+        stats = {"quality": rendition.quality, "encodes": 1, "size": output.tell(), "extension": rendition.extension}
+        logger.info(f"Processed {rendition.name} image size: {output.tell()} bytes ({rendition.format})")
+        return ImageBuffer(output), stats
+    
+    @classmethod
+    def encode_to_target(cls, image: Image.Image, max_bytes: int) -> tuple:
+        """
+        Encode an RGB image as JPEG at the highest quality that fits max_bytes.
+        
+        The first encode is at MAX_QUALITY with full-resolution chroma (4:4:4) so
+        caption text stays crisp. If that is too large, the search switches to 4:2:0
+        subsampling, probes MIN_QUALITY and then interpolates quality on log(size)
+        between the bracketing encodes. At most MAX_ENCODES encodes are made.
+        
+        Args:
+            image: PIL image in RGB mode
+            max_bytes: Target maximum size in bytes
+        
+        Returns:
+            tuple: (JPEG ImageBuffer, stats dict with quality, encodes, subsampling,
+                   progressive and size)
+        """
+        width, height = image.size
+        progressive = width * height >= cls.PROGRESSIVE_MIN_PIXELS
+        encodes = 0
+        
+        def encode(quality, subsampling):
+            nonlocal encodes
+            encodes += 1
+            output = io.BytesIO()
+            image.save(
+                output, format='JPEG', quality=quality, optimize=True,
+                progressive=progressive, subsampling=subsampling,
+            )
+            # Sizes come from tell(); the bytes are never copied out of the BytesIO
+            logger.debug(f"Encode {encodes}: quality={quality} subsampling={subsampling} -> {output.tell()} bytes")
+            return output
+        
+        def result(data, quality, subsampling):
+            stats = {
+                "quality": quality,
+                "encodes": encodes,
+                "subsampling": "4:4:4" if subsampling == 0 else "4:2:0",
+                "progressive": progressive,
+                "size": data.tell(),
+            }
+            return ImageBuffer(data), stats
+        
+        # 1. Best case: highest quality with full chroma already fits
+        data = encode(cls.MAX_QUALITY, 0)
+        if data.tell() <= max_bytes:
+            return result(data, cls.MAX_QUALITY, 0)
+        
+        # 2. Probe the floor with 4:2:0; if even that is too large, give up there
+        subsampling = 2
+        lo_q, lo_data = cls.MIN_QUALITY, encode(cls.MIN_QUALITY, subsampling)
+        if lo_data.tell() > max_bytes:
+            return result(lo_data, lo_q, subsampling)
+        hi_q, hi_size = cls.MAX_QUALITY, data.tell()
+        data = None
+        
+        # 3. Interpolate on log(size) between the fitting floor and the oversized ceiling
+        while encodes < cls.MAX_ENCODES and hi_q - lo_q > 1:
+            lo_log, hi_log = math.log(lo_data.tell()), math.log(hi_size)
+            if hi_log > lo_log:
+                fraction = (math.log(max_bytes) - lo_log) / (hi_log - lo_log)
+            else:
+                fraction = 0.5
+            quality = lo_q + int(fraction * (hi_q - lo_q))
+            quality = max(lo_q + 1, min(hi_q - 1, quality))
+            
+            candidate = encode(quality, subsampling)
+            if candidate.tell() <= max_bytes:
+                lo_q, lo_data = quality, candidate
+            else:
+                hi_q, hi_size = quality, candidate.tell()
+        
+        return result(lo_data, lo_q, subsampling)
@@ -1,14 +1,23 @@
 """Main script for generating and sending daily coffee memes."""
+import argparse
 import logging
 import os
 import sys
-from datetime import datetime
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from pathlib import Path
 from config import Config
-from openai_service import OpenAIService
-from grok_service import GrokService
-from image_processor import ImageProcessor
-from email_service import EmailService
+from file_utils import atomic_write_bytes
+from image_buffer import as_view
+from meme_reservoir import MemeReservoir
+from meme_store import FILTERS, MemeStore, content_hash
+from archive_index import ArchiveIndex, dhash
+from hedging import HedgedService, LatencyTracker
+from rate_limit import BudgetExceeded
+import providers
+import run_metrics
 
 # Configure logging
 logging.basicConfig(
@@ -22,9 +31,759 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+MEMES_DIR = Path("coffee memes")
 
-def main():
-    """Main function to generate and send coffee meme."""
+
+def create_ai_service(provider: str = None):
+    """Create the image/text service for an AI provider (defaults to the configured one)."""
+    return providers.create_service(provider)
+
+
+def create_hedged_service(primary):
+    """
+    Back the configured provider with the other one for hedged requests.
+    
+    Returns:
+        HedgedService, or primary unchanged if the other provider has no API key
+    """
+    backup_provider = "openai" if primary.PROVIDER == "grok" else "grok"
+    try:
+        backup = create_ai_service(backup_provider)
+    except ValueError as e:
+        logger.warning(f"Hedging disabled, backup provider unavailable: {e}")
+        return primary
+    logger.info(f"Hedging {primary.PROVIDER} requests with {backup_provider}")
+    return HedgedService(primary, backup)
+
+
+def create_send_service(provider: str = None):
+    """Create the service used for a send: the provider (default: configured one), hedged if enabled."""
+    ai_service = create_ai_service(provider)
+    if Config.HEDGE_ENABLED:
+        ai_service = create_hedged_service(ai_service)
+    return ai_service
+
+
+def save_meme(image_bytes, memes_dir: Path = MEMES_DIR, renditions: dict = None, meme: dict = None) -> Path:
+    """
+    Save a processed meme in the content-addressed store and index its metadata.
+    
+    Args:
+        image_bytes: Processed image (ImageBuffer or bytes)
+        memes_dir: Store root (sharded as ab/cd/<sha256>.jpg)
+        renditions: Extra variants from ImageProcessor.render ({name: (ImageBuffer, stats)}),
+                    saved as renditions/<sha256>_<variant>.<ext>
+        meme: Metadata for the index (provider, model, style, caption, quality, stages)
+    
+    Returns:
+        Path: Path of the saved file
+    """
+    filepath = MemeStore(memes_dir).add(image_bytes, meme)
+    
+    if renditions:
+        # Kept out of the shards so the archive index only sees the memes
+        renditions_dir = memes_dir / "renditions"
+        renditions_dir.mkdir(exist_ok=True)
+        for name, (data, stats) in renditions.items():
+            atomic_write_bytes(renditions_dir / f"{filepath.stem}_{name}.{stats['extension']}", as_view(data))
+    return filepath
+
+
+def record_send(filepath: Path, recipients: list, email_seconds: float = None, memes_dir: Path = MEMES_DIR):
+    """Record a delivered meme's recipients in the store index; failures are logged, not raised."""
+    try:
+        MemeStore(memes_dir).record_send(filepath, recipients, {"email": round(email_seconds, 3)} if email_seconds else None)
+    except Exception as e:
+        logger.warning(f"Could not record recipients of {filepath.name}: {e}")
+
+
+def record_in_archive_index(archive_index, filepath: Path, image_bytes, image_hash: int = None):
+    """Add a saved meme to the archive index; index failures are logged, not raised."""
+    if archive_index is None:
+        return
+    try:
+        archive_index.add(filepath.name, image_hash if image_hash is not None else dhash(image_bytes))
+    except Exception as e:
+        logger.warning(f"Could not add {filepath.name} to archive index: {e}")
+
+
+def meme_info(provider: str, style: str = None, caption: str = None) -> dict:
+    """Metadata recorded in the meme store for a meme from this provider."""
+    return {
+        "provider": provider,
+        "model": Config.GROK_IMAGE_MODEL if provider == "grok" else Config.OPENAI_MODEL,
+        "style": style or Config.MEME_STYLE,
+        "caption": caption,
+        "stages": {},
+    }
+
+
+def generate_meme_image(ai_service, style: str = None) -> tuple:
+    """
+    Step 1: Generate a meme image (Grok: image only; OpenAI: text then image).
+    
+    Returns:
+        tuple: (image bytes, meme_info dict with the caption and stage seconds)
+    """
+    meme = meme_info(ai_service.PROVIDER, style)
+    if ai_service.PROVIDER == "grok":
+        logger.info("Step 1: Generating coffee meme image (Grok)...")
+        started = time.monotonic()
+        with run_metrics.span("image", provider=ai_service.PROVIDER) as span:
+            image_bytes = ai_service.generate_meme_image(style)
+            span["bytes"] = len(image_bytes)
+        meme["stages"]["image"] = round(time.monotonic() - started, 3)
+        return image_bytes, meme
+    logger.info("Step 1a: Generating meme text...")
+    started = time.monotonic()
+    with run_metrics.span("caption", provider=ai_service.PROVIDER):
+        meme_text = ai_service.generate_meme_text(style)
+    meme["caption"] = meme_text
+    meme["stages"]["caption"] = round(time.monotonic() - started, 3)
+    logger.info(f"Meme text: {meme_text!r}")
+    logger.info("Step 1b: Generating coffee meme image with caption...")
+    started = time.monotonic()
+    with run_metrics.span("image", provider=ai_service.PROVIDER) as span:
+        image_bytes = ai_service.generate_meme_image(meme_text)
+        span["bytes"] = len(image_bytes)
+    meme["stages"]["image"] = round(time.monotonic() - started, 3)
+    return image_bytes, meme
+
+
+def generate_processed_meme(ai_service, style: str = None):
+    """
+    Generate one meme with the provider and process it for email (steps 1-2).
+    
+    Args:
+        ai_service: OpenAIService, GrokService or HedgedService
+        style: Meme style (defaults to MEME_STYLE)
+    
+    Returns:
+        tuple: (processed JPEG ImageBuffer, extra IMAGE_RENDITIONS and meme_info for save_meme)
+    """
+    if isinstance(ai_service, HedgedService):
+        image_bytes, meme = ai_service.run(lambda service: generate_meme_image(service, style))
+    else:
+        # Unhedged runs still feed the latency history, so hedging starts with a tuned delay
+        started = time.monotonic()
+        image_bytes, meme = generate_meme_image(ai_service, style)
+        LatencyTracker().record(ai_service.PROVIDER, time.monotonic() - started)
+    logger.info(f"Image generated: {len(image_bytes)} bytes")
+    
+    # Step 2: Process image for email (optional, but helps with size)
+    from image_processor import ImageProcessor  # Pillow is only needed once there is an image
+    logger.info("Step 2: Processing image for email...")
+    started = time.monotonic()
+    with run_metrics.span("process", input_bytes=len(image_bytes)) as span:
+        # One decode for the email attachment and every extra variant
+        renditions = ImageProcessor.render(image_bytes)
+        processed_image, stats = renditions.pop("email")
+        span.update(bytes=len(processed_image), encodes=stats["encodes"], quality=stats["quality"],
+                    renditions=len(renditions))
+    meme["quality"] = stats["quality"]
+    meme["stages"]["process"] = round(time.monotonic() - started, 3)
+    run_metrics.count("jpeg_encodes", stats["encodes"])
+    logger.info(f"Image processed: {len(processed_image)} bytes")
+    return processed_image, renditions, meme
+
+
+def _in_span(stage: str, fn, *args):
+    """Run fn(*args) inside a run-metrics span (for pool workers)."""
+    with run_metrics.span(stage, provider=Config.AI_PROVIDER):
+        return fn(*args)
+
+
+def generate_batch(ai_service, count: int, concurrency: int):
+    """
+    Generate memes on a bounded worker pool, yielding raw image bytes as each finishes.
+    
+    OpenAI: all captions come from one chat request (n=count), then one image request
+    per caption runs on the pool. Grok: images are requested in chunks of up to
+    GrokService.MAX_IMAGES_PER_REQUEST using the n parameter, chunks run on the pool.
+    Generation stops at the first call refused by the daily budget.
+    
+    Args:
+        ai_service: OpenAIService or GrokService
+        count: Number of memes to generate
+        concurrency: Maximum number of provider calls in flight
+    
+    Yields:
+        tuple: (image bytes or None, error or None) for each finished image/request
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if ai_service.PROVIDER == "grok":
+            chunk = ai_service.MAX_IMAGES_PER_REQUEST
+            sizes = [min(chunk, count - start) for start in range(0, count, chunk)]
+            futures = [executor.submit(_in_span, "image", ai_service.generate_meme_images, n) for n in sizes]
+        else:
+            with run_metrics.span("caption", provider=Config.AI_PROVIDER):
+                captions = ai_service.generate_meme_texts(count)
+            futures = [executor.submit(_in_span, "image", ai_service.generate_meme_image, text) for text in captions]
+        
+        budget_error = None
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except BudgetExceeded as e:
+                if budget_error is None:
+                    # Calls still queued would be refused too; only finish the ones in flight
+                    budget_error = e
+                    for pending in futures:
+                        pending.cancel()
+                    yield None, e
+                continue
+            except Exception as e:
+                yield None, e
+                continue
+            for image_bytes in (result if isinstance(result, list) else [result]):
+                yield image_bytes, None
+
+
+def run_batch(count: int, concurrency: int, send: bool = False) -> int:
+    """
+    Generate several memes concurrently, processing and saving each as it finishes.
+    
+    Args:
+        count: Number of memes to generate
+        concurrency: Maximum number of provider calls in flight
+        send: Also email each meme as it is saved
+    
+    Returns:
+        int: Process exit code (0 if every meme was generated and saved)
+    """
+    run = run_metrics.start_run("batch")
+    try:
+        logger.info("=" * 60)
+        logger.info(f"Starting batch coffee meme generation: count={count}, concurrency={concurrency}")
+        logger.info(f"Timestamp: {datetime.now().isoformat()}")
+        logger.info("=" * 60)
+        
+        Config.validate()
+        import asyncio
+        from email_service import EmailService
+        from pipeline import MemePipeline  # asyncio is only loaded by the commands that use it
+        ai_service = create_ai_service()
+        email_service = EmailService() if send else None
+        recipient_emails = [email.strip() for email in Config.RECIPIENT_EMAIL.split(',')] if Config.RECIPIENT_EMAIL else []
+        archive_index = ArchiveIndex() if Config.ARCHIVE_INDEX_ENABLED else None
+        
+        def save(processed_image, renditions, meme):
+            filepath = save_meme(processed_image, renditions=renditions, meme=meme)
+            record_in_archive_index(archive_index, filepath, processed_image)
+            return filepath
+        
+        # Captions, images, Pillow work, archive writes and sends of different memes overlap
+        meme_pipeline = MemePipeline(
+            ai_service,
+            describe=lambda caption: meme_info(Config.AI_PROVIDER, caption=caption),
+            save=save,
+            email_service=email_service,
+            recipients=recipient_emails,
+            record_send=record_send,
+            concurrency=concurrency,
+        )
+        started = datetime.now()
+        counts = asyncio.run(meme_pipeline.run(count))
+        saved, failures = counts["saved"], counts["failed"]
+        
+        elapsed = (datetime.now() - started).total_seconds()
+        logger.info(f"Batch finished: {saved} saved, {failures} failed in {elapsed:.1f}s")
+        run_metrics.count("memes_saved", saved)
+        run_metrics.count("meme_failures", failures)
+        if run is not None and saved >= count and failures == 0:
+            run.status = "success"
+        return 0 if saved >= count and failures == 0 else 1
+    
+    except ValueError as e:
+        logger.error(f"Configuration error: {e}")
+        logger.error("Please check your .env file and ensure all required variables are set.")
+        return 1
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+    finally:
+        run_metrics.finish_run()
+
+
+def prepare_group_meme(ai_service, style: str, archive_index=None) -> tuple:
+    """
+    Generate, process, dedupe and save the meme shared by groups with one provider and style.
+    
+    Returns:
+        tuple: (processed ImageBuffer, saved Path)
+    """
+    attempts = max(1, Config.DUPLICATE_MAX_ATTEMPTS)
+    for attempt in range(1, attempts + 1):
+        processed_image, renditions, meme = generate_processed_meme(ai_service, style)
+        with run_metrics.span("dedupe"):
+            image_hash = dhash(processed_image) if archive_index is not None else None
+            duplicates = archive_index.find_duplicates(image_hash) if archive_index is not None else []
+        if not duplicates:
+            break
+        distance, name = duplicates[0]
+        logger.warning(f"{style} meme is a near-duplicate of archived {name} ({distance} bits differ)")
+        run_metrics.count("duplicate_retries")
+        if attempt < attempts:
+            ai_service.release_cached()
+    with run_metrics.span("save", bytes=len(processed_image)):
+        filepath = save_meme(processed_image, renditions=renditions, meme=meme)
+        record_in_archive_index(archive_index, filepath, processed_image, image_hash)
+    logger.info(f"{meme['provider']}/{style} meme saved to: {filepath}")
+    return processed_image, filepath
+
+
+def send_to_group(email_service, group, processed_image, filepath: Path = None) -> bool:
+    """Email a meme to one group; errors are logged and reported as False."""
+    try:
+        with run_metrics.span("email", group=group.name, bytes=len(processed_image),
+                              recipients=len(group.recipients)):
+            success = email_service.send_image(processed_image, recipients=group.recipients)
+    except Exception as e:
+        logger.error(f"Group {group.name}: send failed: {e}")
+        return False
+    logger.info(f"Group {group.name}: {'sent' if success else 'some recipients failed'}")
+    if success and filepath is not None:
+        record_send(filepath, group.recipients)
+    return success
+
+
+def send_groups(groups: list, concurrency: int, ai_services: dict = None, email_service=None) -> int:
+    """
+    Generate and send every group's meme in one run.
+    
+    Groups with the same provider and style share one meme. Distinct memes are
+    generated in parallel (at most `concurrency` at a time), and each group is
+    sent to as soon as its own meme is ready, so a slow meme or a slow SMTP send
+    for one group does not hold up the others.
+    
+    Args:
+        groups: Group objects (see groups.load_groups)
+        concurrency: Maximum memes generated, and groups sent to, at once
+        ai_services: Open provider services by provider name to reuse (missing ones are created)
+        email_service: Open EmailService to reuse (created if None)
+    
+    Returns:
+        int: Process exit code (0 if every group was sent to)
+    """
+    run = run_metrics.start_run("groups")
+    try:
+        logger.info("=" * 60)
+        logger.info(f"Starting coffee meme generation for {len(groups)} groups: "
+                    f"{', '.join(group.name for group in groups)}")
+        logger.info(f"Timestamp: {datetime.now().isoformat()}")
+        logger.info("=" * 60)
+        
+        Config.validate()
+        ai_services = {} if ai_services is None else ai_services
+        for provider in {group.provider for group in groups}:
+            if provider not in ai_services:
+                ai_services[provider] = create_send_service(provider)
+        if email_service is None:
+            from email_service import EmailService
+            email_service = EmailService(pool_size=max(Config.SMTP_POOL_SIZE, min(concurrency, len(groups))))
+        archive_index = ArchiveIndex() if Config.ARCHIVE_INDEX_ENABLED else None
+        
+        by_meme = defaultdict(list)
+        for group in groups:
+            by_meme[group.meme_key].append(group)
+        logger.info(f"{len(groups)} groups share {len(by_meme)} distinct memes")
+        
+        results = {}
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="group-meme") as generators, \
+                ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="group-send") as senders:
+            memes = {
+                generators.submit(prepare_group_meme, ai_services[provider], style, archive_index): (provider, style)
+                for provider, style in by_meme
+            }
+            sends = {}
+            for future in as_completed(memes):
+                key = memes[future]
+                try:
+                    processed_image, filepath = future.result()
+                except Exception as e:
+                    logger.error(f"{key[0]}/{key[1]} meme failed for {', '.join(g.name for g in by_meme[key])}: {e}")
+                    results.update((group.name, False) for group in by_meme[key])
+                    continue
+                for group in by_meme[key]:
+                    sends[senders.submit(send_to_group, email_service, group, processed_image, filepath)] = group
+            for future in as_completed(sends):
+                results[sends[future].name] = future.result()
+        
+        sent = [name for name, success in results.items() if success]
+        failed = [name for name, success in results.items() if not success]
+        run_metrics.count("groups_sent", len(sent))
+        run_metrics.count("group_failures", len(failed))
+        for provider, service in ai_services.items():
+            # Keep cached responses for a rerun of failed groups; drop them once all were delivered
+            if not any(group.provider == provider and group.name in failed for group in groups):
+                service.release_cached()
+        if failed:
+            logger.error(f"Sent to {len(sent)} of {len(groups)} groups; failed: {', '.join(failed)}")
+            return 1
+        if run is not None:
+            run.status = "success"
+        logger.info("=" * 60)
+        logger.info(f"SUCCESS: Coffee memes sent to all {len(groups)} groups!")
+        logger.info("=" * 60)
+        return 0
+    
+    except ValueError as e:
+        logger.error(f"Configuration error: {e}")
+        logger.error("Please check your .env file and ensure all required variables are set.")
+        return 1
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+    finally:
+        run_metrics.finish_run()
+
+
+def run_groups(names: list, concurrency: int) -> int:
+    """
+    Send to the groups in GROUPS_PATH now (all of them, or only the named ones).
+    
+    Returns:
+        int: Process exit code
+    """
+    from groups import load_groups
+    try:
+        groups = load_groups(names=names)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not load groups: {e}")
+        return 1
+    return send_groups(groups, concurrency)
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description="Generate and send coffee memes.")
+    parser.add_argument("--count", type=int, default=1,
+                        help="Number of memes to generate (default: 1, the daily send)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Maximum provider calls in flight in batch mode (default: 4)")
+    parser.add_argument("--send", action="store_true",
+                        help="In batch mode, also email each meme (default: save only)")
+    parser.add_argument("--fill-reservoir", action="store_true",
+                        help="Top up the pre-generated meme reservoir to RESERVOIR_SIZE and exit")
+    parser.add_argument("--use-reservoir", action="store_true",
+                        help="Send a pre-generated meme from the reservoir (live generation if empty)")
+    parser.add_argument("--fill-captions", type=int, metavar="N",
+                        help="Generate N captions in one request, add them to the caption queue and exit")
+    parser.add_argument("--fill-backgrounds", nargs="?", type=int, const=0, metavar="N",
+                        help="Generate N caption-free backgrounds for CAPTION_MODE=composite "
+                             "(default: up to BACKGROUND_LIBRARY_SIZE) and exit")
+    parser.add_argument("--index-archive", action="store_true",
+                        help="Hash archived memes missing from the duplicate index (process pool) and exit")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help="With --index-archive, rehash every archived meme")
+    parser.add_argument("--reprocess-archive", action="store_true",
+                        help="Re-encode archived memes into the current renditions (process pool), "
+                             "skipping files already up to date, and exit")
+    parser.add_argument("--migrate-archive", action="store_true",
+                        help="Move flat files in the memes directory into the sharded store, index them and exit")
+    parser.add_argument("--find-memes", nargs="*", metavar="FILTER",
+                        help="List stored memes matching key=value filters (provider, model, style, since, until, "
+                             "days, min_mb, max_mb, caption, recipient, limit) and exit")
+    parser.add_argument("--workers", type=int, metavar="N",
+                        help="Worker processes for --index-archive and --reprocess-archive (default: CPU count)")
+    parser.add_argument("--drain-outbox", action="store_true",
+                        help="Deliver memes queued in the outbox (retrying for up to OUTBOX_DRAIN_SECONDS) and exit")
+    parser.add_argument("--retry-dead-letters", action="store_true",
+                        help="Move dead-lettered outbox memes back into the queue, deliver them and exit")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and send on DAEMON_SCHEDULE with warm clients (combine with --use-reservoir)")
+    parser.add_argument("--schedule", metavar="CRON",
+                        help='With --daemon, cron schedule overriding DAEMON_SCHEDULE (e.g. "0 8 * * 1-5")')
+    parser.add_argument("--groups", nargs="*", metavar="NAME",
+                        help="Send to the audience groups in GROUPS_PATH (all, or the named ones), "
+                             "generating each distinct meme once; with --daemon, on each group's schedule")
+    parser.add_argument("--run-stats", nargs="?", type=int, const=0, metavar="LAST",
+                        help="Print per-stage p50/p99 from the run log (optionally only the LAST runs) and exit")
+    args = parser.parse_args(argv)
+    if args.count < 1 or args.concurrency < 1:
+        parser.error("--count and --concurrency must be at least 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.groups is not None and args.use_reservoir:
+        parser.error("--use-reservoir cannot be combined with --groups (reservoir memes have a single style)")
+    return args
+
+
+def fill_reservoir(concurrency: int) -> int:
+    """
+    Top up the meme reservoir to RESERVOIR_SIZE with processed memes.
+    
+    Args:
+        concurrency: Maximum number of provider calls in flight
+    
+    Returns:
+        int: Process exit code (0 if the reservoir ended up full)
+    """
+    try:
+        logger.info("=" * 60)
+        logger.info("Filling meme reservoir")
+        logger.info(f"Timestamp: {datetime.now().isoformat()}")
+        logger.info("=" * 60)
+        
+        Config.validate()
+        from image_processor import ImageProcessor
+        reservoir = MemeReservoir()
+        needed = reservoir.missing()
+        if needed == 0:
+            logger.info(f"Reservoir already full ({reservoir.capacity} memes ready)")
+            return 0
+        
+        logger.info(f"Generating {needed} memes for the reservoir...")
+        ai_service = create_ai_service()
+        failures = 0
+        for image_bytes, error in generate_batch(ai_service, needed, concurrency):
+            if error is not None:
+                failures += 1
+                logger.error(f"Meme generation failed: {error}")
+                continue
+            try:
+                processed_image = ImageProcessor.process_for_sms(image_bytes)
+                reservoir.add(processed_image, provider=Config.AI_PROVIDER, style=Config.MEME_STYLE)
+            except Exception as e:
+                failures += 1
+                logger.error(f"Failed to process/store meme: {e}")
+        
+        remaining = reservoir.missing()
+        logger.info(f"Reservoir fill finished: {reservoir.capacity - remaining}/{reservoir.capacity} ready, {failures} failed")
+        return 0 if remaining == 0 else 1
+    
+    except ValueError as e:
+        logger.error(f"Configuration error: {e}")
+        logger.error("Please check your .env file and ensure all required variables are set.")
+        return 1
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+
+
+def fill_captions(count: int) -> int:
+    """
+    Request a bulk batch of captions in one chat completion and queue them.
+    
+    Args:
+        count: Number of captions to request
+    
+    Returns:
+        int: Process exit code
+    """
+    try:
+        if Config.AI_PROVIDER != "openai":
+            logger.error("Caption queue is only used with AI_PROVIDER=openai (Grok renders its own captions)")
+            return 1
+        if Config.CAPTION_BATCH_SIZE <= 0:
+            logger.error("Caption queue is disabled (CAPTION_BATCH_SIZE=0)")
+            return 1
+        Config.validate()
+        added = providers.create_service("openai").fill_caption_queue(count)
+        logger.info(f"Added {added} captions to {Config.CAPTION_QUEUE_PATH}")
+        return 0 if added else 1
+    except ValueError as e:
+        logger.error(f"Configuration error: {e}")
+        logger.error("Please check your .env file and ensure all required variables are set.")
+        return 1
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+
+
+def fill_backgrounds(count: int = None) -> int:
+    """
+    Generate caption-free backgrounds for the composite caption library.
+    
+    Args:
+        count: Backgrounds to add (None tops the library up to BACKGROUND_LIBRARY_SIZE)
+    
+    Returns:
+        int: Process exit code
+    """
+    try:
+        if Config.AI_PROVIDER != "openai":
+            logger.error("Background library is only used with AI_PROVIDER=openai (Grok renders its own captions)")
+            return 1
+        Config.validate()
+        added = providers.create_service("openai").fill_background_library(count)
+        logger.info(f"Added {added} backgrounds to {Config.BACKGROUND_DIR}/")
+        return 0
+    except ValueError as e:
+        logger.error(f"Configuration error: {e}")
+        logger.error("Please check your .env file and ensure all required variables are set.")
+        return 1
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+
+
+def index_archive(rebuild: bool = False, workers: int = None) -> int:
+    """
+    Build the perceptual-hash index over the memes already in the archive.
+    
+    Args:
+        rebuild: Rehash every file instead of only files missing from the index
+        workers: Worker processes (defaults to the CPU count)
+    
+    Returns:
+        int: Process exit code
+    """
+    try:
+        logger.info(f"{'Rebuilding' if rebuild else 'Updating'} archive index for {MEMES_DIR}/...")
+        ArchiveIndex().build(MEMES_DIR, workers=workers, rebuild=rebuild)
+        return 0
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+
+
+def reprocess_archive(workers: int = None) -> int:
+    """
+    Re-encode the archive into the current renditions (email JPEG plus IMAGE_RENDITIONS).
+    
+    Args:
+        workers: Worker processes (defaults to the CPU count)
+    
+    Returns:
+        int: Process exit code (1 if any file failed)
+    """
+    try:
+        from archive_reprocess import ArchiveReprocessor
+        summary = ArchiveReprocessor(MEMES_DIR).run(workers=workers)
+        return 1 if summary["failed"] else 0
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+
+
+def migrate_archive() -> int:
+    """
+    Import the flat memes directory into the sharded store and its index.
+    
+    Files are renamed to their content hash, so the duplicate index is rebuilt
+    afterwards to match the new names.
+    
+    Returns:
+        int: Process exit code
+    """
+    try:
+        logger.info(f"Migrating {MEMES_DIR}/ into the sharded meme store...")
+        migrated = MemeStore(MEMES_DIR).migrate()
+        if migrated and Config.ARCHIVE_INDEX_ENABLED:
+            ArchiveIndex().build(MEMES_DIR, rebuild=True)
+        return 0
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}", exc_info=True)
+        return 1
+
+
+def parse_meme_filters(filters: list) -> dict:
+    """
+    Turn key=value arguments into MemeStore.query keyword arguments.
+    
+    days=N becomes since=<N days ago>; min_mb/max_mb become byte bounds.
+    
+    Raises:
+        ValueError: For malformed or unknown filters
+    """
+    query = {}
+    for item in filters:
+        key, separator, value = item.partition("=")
+        if not separator or not value:
+            raise ValueError(f"Invalid filter {item!r} (expected key=value)")
+        if key == "days":
+            query["since"] = datetime.now() - timedelta(days=float(value))
+        elif key in ("min_mb", "max_mb"):
+            query[key.replace("_mb", "_bytes")] = int(float(value) * 1024 * 1024)
+        elif key == "limit":
+            query["limit"] = int(value)
+        elif key in FILTERS:
+            query[key] = value
+        else:
+            raise ValueError(f"Unknown filter {key!r}")
+    return query
+
+
+def find_memes(filters: list) -> int:
+    """
+    Print stored memes matching filters, newest first.
+    
+    Args:
+        filters: key=value strings (see parse_meme_filters)
+    
+    Returns:
+        int: Process exit code
+    """
+    try:
+        memes = MemeStore(MEMES_DIR).query(**parse_meme_filters(filters))
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    for meme in memes:
+        size = f"{meme['width']}x{meme['height']}" if meme["width"] else "?"
+        caption = f"  {meme['caption']!r}" if meme["caption"] else ""
+        print(f"{meme['created']}  {meme['provider'] or '-':<7} {meme['style'] or '-':<12} "
+              f"{meme['bytes'] / 1024:>8.0f} KB  {size:>9}  {meme['path']}{caption}")
+    print(f"{len(memes)} memes")
+    return 0
+
+
+def record_outbox_delivery(envelope: dict):
+    """Outbox hook: record who a delivered daily meme reached in the meme store."""
+    sha256 = envelope["meme"].get("sha256")
+    if sha256:
+        record_send(MemeStore(MEMES_DIR).path_for(sha256), envelope["delivered"], envelope["email_seconds"])
+
+
+def deliver_outbox(wait_seconds: float = None, requeue_dead: bool = False) -> int:
+    """
+    Deliver queued memes, retrying failures with backoff for a bounded time.
+    
+    Args:
+        wait_seconds: Longest time to keep retrying (defaults to OUTBOX_DRAIN_SECONDS);
+                      whatever is still pending is retried by the next run or the daemon
+        requeue_dead: First move dead-lettered memes back into the queue
+    
+    Returns:
+        int: Process exit code (0 if nothing is left pending and nothing was dead-lettered)
+    """
+    from outbox import Outbox, OutboxWorker
+    try:
+        outbox = Outbox()
+        if requeue_dead:
+            outbox.requeue_dead()
+        if not outbox.counts()["pending"]:
+            return 0
+        worker = OutboxWorker(outbox, on_delivered=record_outbox_delivery)
+        wait_seconds = Config.OUTBOX_DRAIN_SECONDS if wait_seconds is None else wait_seconds
+        try:
+            totals = worker.run(deadline=time.monotonic() + wait_seconds)
+        finally:
+            worker.stop()
+        pending = outbox.counts()["pending"]
+        logger.info(f"Outbox: {totals['sent']} delivered, {totals['dead']} dead-lettered, {pending} still queued")
+        if pending:
+            logger.warning(f"{pending} meme(s) still queued in {outbox.directory}/; the next run or the daemon retries them")
+        return 0 if pending == 0 and totals["dead"] == 0 else 1
+    except Exception as e:
+        logger.error(f"Outbox delivery failed: {e}", exc_info=True)
+        return 1
+
+
+def main(use_reservoir: bool = False, ai_service=None, email_service=None):
+    """
+    Main function to generate and send coffee meme.
+    
+    Args:
+        use_reservoir: Send a pre-generated meme from the reservoir if one is ready,
+                       falling back to live generation when it is empty
+        ai_service: Already-open provider service to reuse (created on demand if None)
+        email_service: Already-open EmailService to reuse (created if None)
+    """
+    run = run_metrics.start_run("daily")
     try:
         logger.info("=" * 60)
         logger.info("Starting coffee meme generation")
@@ -36,58 +795,110 @@ def main():
         Config.validate()
         logger.info("Configuration validated successfully")
         
-        # Initialize services
-        logger.info("Initializing services...")
-        if Config.AI_PROVIDER == "grok":
-            ai_service = GrokService()
-            logger.info("Using Grok (xAI) image model only for meme generation")
-        else:
-            ai_service = OpenAIService()
-            logger.info("Using OpenAI for text and image generation")
-        email_service = EmailService()
-        logger.info("Services initialized successfully")
-        
-        # Step 1: Generate meme image (Grok: image only; OpenAI: text then image)
-        if Config.AI_PROVIDER == "grok":
-            logger.info("Step 1: Generating coffee meme image (Grok)...")
-            image_bytes = ai_service.generate_meme_image()
+        # Initialize services (with the outbox, delivery happens after main returns)
+        if email_service is None and not Config.OUTBOX_ENABLED:
+            from email_service import EmailService  # smtplib/ssl are only needed to send
+            logger.info("Initializing services...")
+            email_service = EmailService()
+            logger.info("Services initialized successfully")
+        
+        reservoir = MemeReservoir() if use_reservoir else None
+        archive_index = ArchiveIndex() if Config.ARCHIVE_INDEX_ENABLED else None
+        attempts = max(1, Config.DUPLICATE_MAX_ATTEMPTS)
+        for attempt in range(1, attempts + 1):
+            processed_image = None
+            renditions = None  # Reservoir memes are stored as the email JPEG only
+            meme = None
+            if reservoir is not None:
+                logger.info("Steps 1-2: Taking pre-generated meme from reservoir...")
+                with run_metrics.span("reservoir"):
+                    reserved = reservoir.pop()
+                if reserved is not None:
+                    processed_image, entry = reserved
+                    meme = meme_info(entry.get("provider") or Config.AI_PROVIDER, entry.get("style"), entry.get("caption"))
+                    logger.info(f"Using reservoir meme from {entry.get('created')}: {len(processed_image)} bytes")
+                else:
+                    logger.warning("Reservoir is empty, falling back to live generation")
+                    reservoir = None
+            
+            if processed_image is None:
+                if ai_service is None:
+                    ai_service = create_send_service()
+                processed_image, renditions, meme = generate_processed_meme(ai_service)
+            
+            # Skip memes that look like one already in the archive
+            with run_metrics.span("dedupe"):
+                image_hash = dhash(processed_image) if archive_index is not None else None
+                duplicates = archive_index.find_duplicates(image_hash) if archive_index is not None else []
+            if not duplicates:
+                break
+            distance, name = duplicates[0]
+            logger.warning(f"Meme is a near-duplicate of archived {name} ({distance} bits differ)")
+            run_metrics.count("duplicate_retries")
+            if attempt < attempts:
+                if ai_service is not None:
+                    # Cached responses would reproduce the same image
+                    ai_service.release_cached()
+                logger.info(f"Trying another meme (attempt {attempt + 1}/{attempts})...")
         else:
-            logger.info("Step 1a: Generating meme text...")
-            meme_text = ai_service.generate_meme_text()
-            logger.info(f"Meme text: {meme_text!r}")
-            logger.info("Step 1b: Generating coffee meme image with caption...")
-            image_bytes = ai_service.generate_meme_image(meme_text)
-        logger.info(f"Image generated: {len(image_bytes)} bytes")
-        
-        # Step 2: Process image for email (optional, but helps with size)
-        logger.info("Step 2: Processing image for email...")
-        processed_image = ImageProcessor.process_for_sms(image_bytes)  # Reuse same processor
-        logger.info(f"Image processed: {len(processed_image)} bytes")
-        
-        # Step 3: Save image to local directory
-        logger.info("Step 3: Saving image to local directory...")
-        memes_dir = Path("coffee memes")
-        memes_dir.mkdir(exist_ok=True)
-        
-        # Create timestamped filename: coffee_meme_YYYY-MM-DD_HH-MM-SS.jpg
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        filename = f"coffee_meme_{timestamp}.jpg"
-        filepath = memes_dir / filename
-        
-        # Save the processed image
-        with open(filepath, 'wb') as f:
-            f.write(processed_image)
-        logger.info(f"Image saved to: {filepath}")
-        
-        # Step 4: Send image via email
-        logger.info("Step 4: Sending image via email...")
+            logger.warning(f"No distinct meme after {attempts} attempts, sending the near-duplicate")
+        
         # Parse recipient emails (support comma-separated list)
         recipient_emails = [email.strip() for email in Config.RECIPIENT_EMAIL.split(',')] if Config.RECIPIENT_EMAIL else []
-        success = email_service.send_image(processed_image, recipients=recipient_emails)
+        
+        def save():
+            with run_metrics.span("save", bytes=len(processed_image)):
+                filepath = save_meme(processed_image, renditions=renditions, meme=meme)
+                record_in_archive_index(archive_index, filepath, processed_image, image_hash)
+            return filepath
+        
+        def send():
+            with run_metrics.span("email", bytes=len(processed_image), recipients=len(recipient_emails)):
+                return email_service.send_image(processed_image, recipients=recipient_emails)
+        
+        if Config.OUTBOX_ENABLED:
+            # Step 3: Queue for email delivery first, so the meme survives anything that fails after this
+            logger.info("Step 3: Queuing image for email delivery...")
+            from outbox import Outbox
+            with run_metrics.span("enqueue", bytes=len(processed_image), recipients=len(recipient_emails)):
+                Outbox().enqueue(processed_image, recipient_emails, meme={"sha256": content_hash(processed_image)})
+            success = True
+            
+            # Step 4: Save image to local directory
+            logger.info("Step 4: Saving image to local directory...")
+            try:
+                logger.info(f"Image saved to: {save()}")
+            except Exception as e:
+                logger.error(f"Failed to save meme to the archive: {e}")
+        else:
+            # Steps 3-4: Save image to local directory while it is sent via email
+            logger.info("Steps 3-4: Saving image to local directory and sending via email...")
+            import asyncio
+            from pipeline import save_and_send
+            filepath, success, email_seconds = asyncio.run(save_and_send(save, send))
+            if isinstance(success, Exception):
+                if not isinstance(filepath, Exception):
+                    logger.info(f"Image saved to: {filepath}")
+                raise success
+            if isinstance(filepath, Exception):
+                # Already delivered: report the archive failure without failing (and resending) the run
+                logger.error(f"Failed to save meme to the archive: {filepath}")
+            else:
+                logger.info(f"Image saved to: {filepath}")
+                if success:
+                    record_send(filepath, recipient_emails, email_seconds)
         
         if success:
+            if ai_service is not None:
+                # Delivered or queued: later runs should generate a fresh meme, not reuse cached responses
+                ai_service.release_cached()
+            if run is not None:
+                run.status = "success"
             logger.info("=" * 60)
-            logger.info("SUCCESS: Coffee meme sent successfully via email!")
+            if Config.OUTBOX_ENABLED:
+                logger.info("SUCCESS: Coffee meme queued for email delivery!")
+            else:
+                logger.info("SUCCESS: Coffee meme sent successfully via email!")
             logger.info("=" * 60)
             return 0
         else:
@@ -98,11 +909,134 @@ def main():
         logger.error(f"Configuration error: {e}")
         logger.error("Please check your .env file and ensure all required variables are set.")
         return 1
+    except BudgetExceeded as e:
+        logger.error(f"Daily budget reached, not generating: {e}")
+        return 1
     except Exception as e:
         logger.error(f"Unexpected error: {e}", exc_info=True)
         return 1
+    finally:
+        run_metrics.finish_run()
+
+
+def run_daemon(use_reservoir: bool = False, schedule: str = None, groups: list = None,
+               concurrency: int = 4) -> int:
+    """
+    Stay running and send memes on a cron schedule with warm clients.
+    
+    Args:
+        use_reservoir: Send pre-generated memes from the reservoir when available
+        schedule: Cron expression overriding DAEMON_SCHEDULE (and every group's schedule)
+        groups: Send to audience groups from GROUPS_PATH on their own schedules instead
+                of the daily send ([] for all groups, or group names)
+        concurrency: With groups, maximum memes generated at once
+    
+    Returns:
+        int: Process exit code
+    """
+    from daemon import MemeDaemon
+    outbox_worker = None
+    if Config.OUTBOX_ENABLED:
+        from outbox import OutboxWorker
+        # Daily memes are queued by main() and delivered in the background, retries included
+        outbox_worker = OutboxWorker(on_delivered=record_outbox_delivery)
+    if groups is None:
+        def schedules():
+            return {"daily": schedule or Config.DAEMON_SCHEDULE}
+        
+        def job_providers():
+            return {Config.AI_PROVIDER}
+        
+        def send(due, ai_services, email_service):
+            if outbox_worker is not None:
+                # main() only enqueues; the worker delivers over the session warm_up() logged in
+                outbox_worker.use_email_service(email_service)
+            exit_code = main(use_reservoir, ai_service=ai_services.get(Config.AI_PROVIDER), email_service=email_service)
+            if outbox_worker is not None:
+                outbox_worker.wake()
+            return exit_code
+        
+        pool_size, watch = None, []
+    else:
+        from groups import load_groups
+        names = groups or None
+        
+        def schedules():
+            return {group.name: schedule or group.schedule for group in load_groups(names=names)}
+        
+        def job_providers():
+            return {group.provider for group in load_groups(names=names)}
+        
+        def send(due, ai_services, email_service):
+            return send_groups(load_groups(names=due), concurrency, ai_services, email_service)
+        
+        pool_size, watch = max(Config.SMTP_POOL_SIZE, concurrency), [Config.GROUPS_PATH]
+    try:
+        meme_daemon = MemeDaemon(send, create_send_service, schedules, job_providers,
+                                 email_pool_size=pool_size, watch=watch)
+    except (OSError, ValueError) as e:
+        logger.error(f"Configuration error: {e}")
+        return 1
+    if outbox_worker is None:
+        return meme_daemon.run()
+    outbox_worker.start()
+    try:
+        return meme_daemon.run()
+    finally:
+        outbox_worker.stop()
+
+
+def print_run_stats(last: int = None) -> int:
+    """
+    Print per-stage p50/p99 latencies across the runs in RUN_LOG_PATH.
+    
+    Args:
+        last: Only include the most recent runs
+    
+    Returns:
+        int: Process exit code
+    """
+    try:
+        summary = run_metrics.summarize_run_log(last=last, kind="daily")
+    except FileNotFoundError:
+        logger.error(f"No run log at {Config.RUN_LOG_PATH} yet")
+        return 1
+    print(f"{'stage':<12} {'runs':>5} {'p50 s':>9} {'p99 s':>9} {'max s':>9}")
+    for stage, row in summary.items():
+        print(f"{stage:<12} {row['runs']:>5} {row['p50']:>9.3f} {row['p99']:>9.3f} {row['max']:>9.3f}")
+    return 0
 
 
 if __name__ == "__main__":
-    exit_code = main()
+    args = parse_args()
+    if args.run_stats is not None:
+        exit_code = print_run_stats(last=args.run_stats or None)
+    elif args.index_archive:
+        exit_code = index_archive(rebuild=args.rebuild_index, workers=args.workers)
+    elif args.reprocess_archive:
+        exit_code = reprocess_archive(workers=args.workers)
+    elif args.migrate_archive:
+        exit_code = migrate_archive()
+    elif args.find_memes is not None:
+        exit_code = find_memes(args.find_memes)
+    elif args.fill_captions:
+        exit_code = fill_captions(args.fill_captions)
+    elif args.fill_backgrounds is not None:
+        exit_code = fill_backgrounds(args.fill_backgrounds or None)
+    elif args.fill_reservoir:
+        exit_code = fill_reservoir(args.concurrency)
+    elif args.drain_outbox or args.retry_dead_letters:
+        exit_code = deliver_outbox(requeue_dead=args.retry_dead_letters)
+    elif args.daemon:
+        exit_code = run_daemon(use_reservoir=args.use_reservoir, schedule=args.schedule,
+                               groups=args.groups, concurrency=args.concurrency)
+    elif args.groups is not None:
+        exit_code = run_groups(args.groups, args.concurrency)
+    elif args.count > 1:
+        exit_code = run_batch(args.count, args.concurrency, send=args.send)
+    else:
+        exit_code = main(use_reservoir=args.use_reservoir)
+        if Config.OUTBOX_ENABLED:
+            # Deliver this run's meme (and any left by earlier runs) before exiting
+            exit_code = max(exit_code, deliver_outbox())
     sys.exit(exit_code)
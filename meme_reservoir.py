@@ -0,0 +1,112 @@
+"""On-disk reservoir of pre-generated, processed memes for instant daily sends."""
+import json
+import logging
+import uuid
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_bytes, atomic_write_json, file_lock
+from image_buffer import as_view
+
+logger = logging.getLogger(__name__)
+
+
+class MemeReservoir:
+    """
+    A FIFO of processed meme JPEGs kept ready on disk.
+    
+    Images live next to a small manifest.json that lists them oldest first.
+    The manifest is replaced atomically and every read-modify-write holds a lock
+    file, so a background fill and the daily send can run at the same time.
+    """
+    
+    MANIFEST_NAME = "manifest.json"
+    LOCK_NAME = "reservoir.lock"
+    LOCK_TIMEOUT_SECONDS = 30
+    STALE_LOCK_SECONDS = 300  # A lock older than this was left by a crashed process
+    
+    def __init__(self, directory: str = None, capacity: int = None):
+        """
+        Initialize the reservoir.
+        
+        Args:
+            directory: Reservoir directory (defaults to RESERVOIR_DIR from config)
+            capacity: Number of memes to keep ready (defaults to RESERVOIR_SIZE from config)
+        """
+        self.directory = Path(directory or Config.RESERVOIR_DIR)
+        self.capacity = capacity if capacity is not None else Config.RESERVOIR_SIZE
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.directory / self.MANIFEST_NAME
+        self.lock_path = self.directory / self.LOCK_NAME
+    
+    def _lock(self):
+        """Lock serializing manifest read-modify-write cycles."""
+        return file_lock(self.lock_path, self.LOCK_TIMEOUT_SECONDS, self.STALE_LOCK_SECONDS)
+    
+    def _read_manifest(self) -> list:
+        """Return manifest entries, dropping any whose image file is missing."""
+        if not self.manifest_path.exists():
+            return []
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f).get("memes", [])
+        return [entry for entry in entries if (self.directory / entry["file"]).exists()]
+    
+    def _write_manifest(self, entries: list):
+        """Atomically replace the manifest."""
+        atomic_write_json(self.manifest_path, {"memes": entries})
+    
+    def __len__(self) -> int:
+        """Number of memes currently ready."""
+        with self._lock():
+            return len(self._read_manifest())
+    
+    def missing(self) -> int:
+        """Number of memes needed to bring the reservoir up to capacity."""
+        return max(0, self.capacity - len(self))
+    
+    def add(self, image_bytes, **metadata) -> Path:
+        """
+        Add a processed meme to the back of the reservoir.
+        
+        The image file is fully written before it is listed in the manifest, so a
+        crash never leaves a manifest entry pointing at a partial file.
+        
+        Args:
+            image_bytes: Processed JPEG (ImageBuffer or bytes)
+            **metadata: Extra fields stored in the manifest (e.g. provider, caption)
+        
+        Returns:
+            Path: Path of the stored image
+        """
+        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg"
+        filepath = self.directory / filename
+        atomic_write_bytes(filepath, as_view(image_bytes))
+        
+        entry = {"file": filename, "created": datetime.now().isoformat(), "size": len(image_bytes)}
+        entry.update(metadata)
+        with self._lock():
+            entries = self._read_manifest()
+            entries.append(entry)
+            self._write_manifest(entries)
+        logger.info(f"Added meme to reservoir: {filepath} ({len(entries)} ready)")
+        return filepath
+    
+    def pop(self):
+        """
+        Remove and return the oldest meme in the reservoir.
+        
+        Returns:
+            tuple: (image bytes, manifest entry), or None if the reservoir is empty
+        """
+        with self._lock():
+            entries = self._read_manifest()
+            if not entries:
+                return None
+            entry = entries.pop(0)
+            filepath = self.directory / entry["file"]
+            with open(filepath, 'rb') as f:
+                image_bytes = f.read()
+            self._write_manifest(entries)
+        filepath.unlink()
+        logger.info(f"Took meme from reservoir: {entry['file']} ({len(entries)} left)")
+        return image_bytes, entry
@@ -0,0 +1,302 @@
+"""Content-addressed meme archive in hash-sharded directories, with a SQLite index of meme metadata."""
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_bytes
+from image_buffer import as_view, open_reader
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIXES = (".jpg", ".jpeg", ".png")
+SHARD_PATTERN = re.compile(r"^[0-9a-f]{2}$")
+# Timestamp in the names save_meme used before the store (coffee_meme_2025-01-31_08-00-00[_2].jpg)
+LEGACY_NAME_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2})_(\d{2})-(\d{2})-(\d{2})")
+MIGRATE_BATCH = 500  # Rows per transaction while importing a flat archive
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memes (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    created TEXT NOT NULL,
+    provider TEXT,
+    model TEXT,
+    style TEXT,
+    caption TEXT,
+    bytes INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    quality INTEGER,
+    stages TEXT,
+    original_name TEXT
+);
+CREATE INDEX IF NOT EXISTS memes_created ON memes (created);
+CREATE INDEX IF NOT EXISTS memes_provider_created ON memes (provider, created);
+CREATE INDEX IF NOT EXISTS memes_style_created ON memes (style, created);
+CREATE INDEX IF NOT EXISTS memes_bytes ON memes (bytes);
+CREATE TABLE IF NOT EXISTS recipients (
+    sha256 TEXT NOT NULL REFERENCES memes (sha256),
+    address TEXT NOT NULL,
+    sent TEXT NOT NULL,
+    PRIMARY KEY (sha256, address)
+);
+CREATE INDEX IF NOT EXISTS recipients_address ON recipients (address, sent);
+"""
+
+INSERT_MEME = ("INSERT INTO memes (sha256, path, created, provider, model, style, caption, bytes, width, height, "
+               "quality, stages, original_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+               "ON CONFLICT (sha256) DO NOTHING")
+
+# Filter name -> (SQL condition, value converter) for query()
+FILTERS = {
+    "provider": ("m.provider = ?", str),
+    "model": ("m.model = ?", str),
+    "style": ("m.style = ?", str),
+    "since": ("m.created >= ?", lambda value: _iso(value)),
+    "until": ("m.created < ?", lambda value: _iso(value)),
+    "min_bytes": ("m.bytes >= ?", int),
+    "max_bytes": ("m.bytes <= ?", int),
+    "caption": ("m.caption LIKE ?", lambda value: f"%{value}%"),
+    "recipient": ("m.sha256 IN (SELECT sha256 FROM recipients WHERE address = ?)", str),
+}
+
+
+def _iso(value) -> str:
+    return value.isoformat(timespec="seconds") if isinstance(value, datetime) else str(value)
+
+
+def content_hash(image_data) -> str:
+    """SHA-256 of an encoded image; also its name in the store."""
+    return hashlib.sha256(as_view(image_data)).hexdigest()
+
+
+def _extension(image_data) -> str:
+    return ".png" if bytes(as_view(image_data)[:4]) == b"\x89PNG" else ".jpg"
+
+
+def _dimensions(image_data) -> tuple:
+    """(width, height) from the image header, or (None, None) if it cannot be read."""
+    from PIL import Image, UnidentifiedImageError  # Header only; no pixels are decoded
+
+    try:
+        with Image.open(open_reader(image_data)) as image:
+            return image.size
+    except (OSError, UnidentifiedImageError):
+        return None, None
+
+
+def iter_meme_files(root: Path):
+    """
+    Stored memes under root: sharded ab/cd/<hash> files plus any flat files not yet migrated.
+
+    Streams the directories instead of listing the whole archive first.
+    """
+    root = Path(root)
+    if not root.is_dir():
+        return
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(ARCHIVE_SUFFIXES):
+                yield Path(entry.path)
+            elif entry.is_dir() and SHARD_PATTERN.match(entry.name):
+                with os.scandir(entry.path) as shards:
+                    for shard in shards:
+                        if shard.is_dir() and SHARD_PATTERN.match(shard.name):
+                            with os.scandir(shard.path) as files:
+                                for file in files:
+                                    if file.is_file() and file.name.lower().endswith(ARCHIVE_SUFFIXES):
+                                        yield Path(file.path)
+
+
+class MemeStore:
+    """
+    Archive of processed memes addressed by content hash.
+
+    Files live at <root>/ab/cd/<sha256>.jpg, so no directory grows past a few
+    hundred entries and the same image is never stored twice. A SQLite index
+    (WAL mode, one short connection per call so threads and processes can share
+    it) records each meme's caption, provider, model, style, size, quality,
+    stage timings and recipients for indexed queries.
+    """
+
+    def __init__(self, root: Path, index_path: str = None):
+        """
+        Args:
+            root: Archive directory
+            index_path: SQLite index (defaults to MEME_INDEX_PATH from config)
+        """
+        self.root = Path(root)
+        self.index_path = Path(index_path or Config.MEME_INDEX_PATH)
+        self._schema_ready = False
+
+    @contextmanager
+    def _connect(self):
+        """A connection committed on success and rolled back on error."""
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")  # Durable enough with WAL; avoids an fsync per insert
+            if not self._schema_ready:
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def path_for(self, sha256: str, extension: str = ".jpg") -> Path:
+        """Where an image with this hash is stored."""
+        return self.root / sha256[:2] / sha256[2:4] / f"{sha256}{extension}"
+
+    def _write(self, image_data) -> tuple:
+        """Store the file (unless identical content is already there); returns (hash, path)."""
+        sha256 = content_hash(image_data)
+        path = self.path_for(sha256, _extension(image_data))
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(path, as_view(image_data))
+        return sha256, path
+
+    def _row(self, sha256: str, path: Path, image_data, created: datetime, meme: dict, original_name: str = None) -> tuple:
+        width, height = _dimensions(image_data)
+        return (
+            sha256, path.relative_to(self.root).as_posix(), _iso(created),
+            meme.get("provider"), meme.get("model"), meme.get("style"), meme.get("caption"),
+            len(image_data), width, height, meme.get("quality"),
+            json.dumps(meme["stages"]) if meme.get("stages") else None,
+            original_name,
+        )
+
+    def add(self, image_data, meme: dict = None, created: datetime = None) -> Path:
+        """
+        Store a processed meme and index it.
+
+        Args:
+            image_data: Processed image (ImageBuffer or bytes)
+            meme: Metadata: provider, model, style, caption, quality and stages ({stage: seconds})
+            created: Creation time (defaults to now)
+
+        Returns:
+            Path: Path of the stored file
+        """
+        sha256, path = self._write(image_data)
+        with self._connect() as connection:
+            connection.execute(INSERT_MEME, self._row(sha256, path, image_data, created or datetime.now(), meme or {}))
+        return path
+
+    def record_send(self, path: Path, recipients: list, stages: dict = None):
+        """Record who a stored meme was sent to, and merge extra stage timings (e.g. email)."""
+        sha256 = Path(path).stem
+        sent = _iso(datetime.now())
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO recipients (sha256, address, sent) VALUES (?, ?, ?)",
+                [(sha256, address, sent) for address in recipients],
+            )
+            if stages:
+                row = connection.execute("SELECT stages FROM memes WHERE sha256 = ?", (sha256,)).fetchone()
+                if row is not None:
+                    merged = {**json.loads(row["stages"] or "{}"), **stages}
+                    connection.execute("UPDATE memes SET stages = ? WHERE sha256 = ?", (json.dumps(merged), sha256))
+
+    def query(self, limit: int = None, **filters) -> list:
+        """
+        Find memes by indexed fields, newest first.
+
+        Args:
+            limit: Maximum number of results
+            **filters: provider, model, style, since/until (datetime or ISO string; until is
+                       exclusive), min_bytes/max_bytes, caption (substring) and recipient
+
+        Returns:
+            list: One dict per meme, with the absolute path, parsed stages and recipients
+
+        Raises:
+            ValueError: For an unknown filter
+        """
+        unknown = set(filters) - set(FILTERS)
+        if unknown:
+            raise ValueError(f"Unknown meme filter(s): {', '.join(sorted(unknown))} (expected {', '.join(FILTERS)})")
+        conditions, params = [], []
+        for name, value in filters.items():
+            if value is None:
+                continue
+            condition, convert = FILTERS[name]
+            conditions.append(condition)
+            params.append(convert(value))
+        sql = "SELECT m.*, (SELECT group_concat(address, ',') FROM recipients r WHERE r.sha256 = m.sha256) AS sent_to FROM memes m"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY m.created DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        with self._connect() as connection:
+            rows = connection.execute(sql, params).fetchall()
+        results = []
+        for row in rows:
+            result = dict(row)
+            result["path"] = str(self.root / result["path"])
+            result["stages"] = json.loads(result["stages"]) if result["stages"] else {}
+            result["recipients"] = result.pop("sent_to").split(",") if result["sent_to"] else []
+            results.append(result)
+        return results
+
+    def migrate(self) -> int:
+        """
+        Move flat files from the archive root into shards and index them.
+
+        Creation times come from the timestamp in the old file name (the file's mtime
+        otherwise). A file whose content is already stored is removed as a duplicate.
+        Sharded files missing from the index (e.g. after an interrupted migration or
+        a copied-in archive) are indexed too, so rerunning is safe.
+
+        Returns:
+            int: Number of files migrated or indexed
+        """
+        with self._connect() as connection:
+            indexed = {row[0] for row in connection.execute("SELECT sha256 FROM memes")}
+        migrated = 0
+        rows = []
+        for source in iter_meme_files(self.root):
+            flat = source.parent == self.root
+            if not flat and source.stem in indexed:
+                continue
+            data = source.read_bytes()
+            sha256 = content_hash(data)
+            target = self.path_for(sha256, _extension(data))
+            match = LEGACY_NAME_PATTERN.search(source.stem) if flat else None
+            if match:
+                created = datetime.fromisoformat(f"{match.group(1)}T{match.group(2)}:{match.group(3)}:{match.group(4)}")
+            else:
+                created = datetime.fromtimestamp(source.stat().st_mtime)
+            if sha256 not in indexed:
+                rows.append(self._row(sha256, target, data, created, {}, original_name=source.name if flat else None))
+                indexed.add(sha256)
+            if flat:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                if target.exists():
+                    source.unlink()
+                else:
+                    os.replace(source, target)
+            migrated += 1
+            if len(rows) >= MIGRATE_BATCH:
+                self._insert_rows(rows)
+                rows = []
+                logger.info(f"Migrated {migrated} memes...")
+        self._insert_rows(rows)
+        logger.info(f"Migrated {migrated} memes into {self.root}/")
+        return migrated
+
+    def _insert_rows(self, rows: list):
+        if rows:
+            with self._connect() as connection:
+                connection.executemany(INSERT_MEME, rows)
@@ -1,72 +1,380 @@
 """OpenAI API integration for generating coffee memes."""
-import base64
+import binascii
 import logging
-import requests
+import re
+import threading
 from openai import OpenAI
 from config import Config
+from caption_index import CaptionIndex
+from caption_queue import CaptionQueue
+from image_buffer import ImageBuffer
+from rate_limit import get_limiter
+from response_cache import RunCache
 
 logger = logging.getLogger(__name__)
 
 # gpt-image-1 returns base64 only (url is always null); DALL-E returns url or b64
 GPT_IMAGE_MODELS = ("gpt-image-1", "gpt-image-1-mini")
 
+# Chat completions accept up to 128 choices (n) per request
+MAX_CAPTION_CHOICES = 128
+
+# Leading list markers models add despite instructions: "1.", "2)", "-", "*", "•"
+CAPTION_LIST_MARKER = re.compile(r"^\s*(?:\d+\s*[.):-]|[-*•])\s*")
+
+# Caption-free scene for CAPTION_MODE=composite; the caption is drawn over the bottom band locally
+BACKGROUND_PROMPT = (
+    "Create a funny, relatable coffee meme background photo with NO text, letters or captions anywhere. "
+    "Style: realistic, like something you would see on Facebook or Instagram. "
+    "Keep the bottom third of the image simple and uncluttered, leaving room for a caption."
+)
+
 
 class OpenAIService:
     """Service for interacting with OpenAI API to generate meme text and images."""
     
+    PROVIDER = "openai"
+    
     def __init__(self):
         """Initialize OpenAI client."""
         if not Config.OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY is not set in configuration")
-        self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
+        # The SDK keeps its own pooled client; give it the same timeout and retry budget
+        self.client = OpenAI(
+            api_key=Config.OPENAI_API_KEY,
+            timeout=Config.HTTP_READ_TIMEOUT,
+            max_retries=Config.HTTP_RETRIES,
+        )
+        self.cache = RunCache(self.PROVIDER)
+        self.caption_queue = CaptionQueue() if Config.CAPTION_BATCH_SIZE > 0 else None
+        self._caption_index = None  # Loaded on first use
+        self._caption_lock = threading.Lock()  # Groups with different styles caption concurrently
+    
+    def _chat(self, messages: list, max_tokens: int, n: int = 1):
+        """Chat completion through the shared rate limiter and spending budget."""
+        with get_limiter().text_call(self.PROVIDER, Config.TEXT_MODEL, messages, max_tokens, n) as call:
+            response = self.client.chat.completions.create(
+                model=Config.TEXT_MODEL,
+                messages=messages,
+                max_tokens=max_tokens,
+                n=n,
+            )
+            call["usage"] = response.usage
+        return response
+    
+    @staticmethod
+    def _caption_messages(style: str = None) -> list:
+        """Build the chat messages used to request a meme caption (style defaults to MEME_STYLE)."""
+        return [
+            {
+                "role": "system",
+                "content": (
+                    "You write short, funny captions for coffee memes. "
+                    "Reply with ONLY the caption text—no quotes, no explanation, no prefix. "
+                    "Keep it to one or two short lines, relatable and suitable for a meme image."
+                ),
+            },
+            {
+                "role": "user",
+                "content": f"Write a {style or Config.MEME_STYLE} coffee meme caption.",
+            },
+        ]
+    
+    @staticmethod
+    def _clean_caption(content: str) -> str:
+        """Strip whitespace and surrounding quotes from a caption."""
+        return (content or "").strip().strip('"\'')
+    
+    @staticmethod
+    def _bulk_caption_messages(count: int, style: str = None) -> list:
+        """Build the chat messages used to request many captions in one completion."""
+        return [
+            {
+                "role": "system",
+                "content": (
+                    "You write short, funny captions for coffee memes. "
+                    f"Reply with exactly {count} different captions, one per line—"
+                    "no quotes, no numbering, no explanation, no blank lines. "
+                    "Keep each to one short line, relatable and suitable for a meme image."
+                ),
+            },
+            {
+                "role": "user",
+                "content": f"Write {count} {style or Config.MEME_STYLE} coffee meme captions.",
+            },
+        ]
+    
+    @classmethod
+    def _parse_caption_list(cls, content: str) -> list:
+        """Split a bulk completion into cleaned, de-duplicated captions."""
+        captions = []
+        for line in (content or "").splitlines():
+            text = cls._clean_caption(CAPTION_LIST_MARKER.sub("", line))
+            if text and text not in captions:
+                captions.append(text)
+        return captions
+    
+    def generate_caption_batch(self, count: int, style: str = None) -> list:
+        """
+        Generate many captions in a single chat completion (one caption per line).
+        
+        Args:
+            count: Number of captions to ask for
+            style: Meme style (defaults to MEME_STYLE)
+        
+        Returns:
+            list: Cleaned captions (may be slightly fewer than count)
+        """
+        try:
+            logger.info(f"Generating {count} captions in one request...")
+            response = self._chat(self._bulk_caption_messages(count, style), max_tokens=40 * count)
+            captions = self._parse_caption_list(response.choices[0].message.content)
+            logger.info(f"Generated {len(captions)} captions")
+            return captions
+        except Exception as e:
+            logger.error(f"Error generating caption batch: {e}")
+            raise
+    
+    def fill_caption_queue(self, count: int = None, style: str = None) -> int:
+        """
+        Generate a bulk batch of captions and append them to the caption queue.
+        
+        Args:
+            count: Captions to request (defaults to CAPTION_BATCH_SIZE)
+            style: Meme style (defaults to MEME_STYLE)
+        
+        Returns:
+            int: Number of captions added to the queue
+        """
+        if self.caption_queue is None:
+            return 0
+        captions = self.generate_caption_batch(count or Config.CAPTION_BATCH_SIZE, style)
+        return self.caption_queue.push(captions, style=style)
     
-    def generate_meme_text(self) -> str:
+    def _take_queued_captions(self, count: int, style: str = None) -> list:
+        """Take up to count captions of a style from the queue, refilling it with one bulk request if empty."""
+        if self.caption_queue is None:
+            return []
+        captions = self.caption_queue.pop(count, style=style)
+        if len(captions) < count:
+            try:
+                self.fill_caption_queue(max(Config.CAPTION_BATCH_SIZE, count - len(captions)), style)
+            except Exception as e:
+                logger.warning(f"Bulk caption request failed, falling back to single captions: {e}")
+                return captions
+            captions += self.caption_queue.pop(count - len(captions), style=style)
+        return captions
+    
+    def _accept_caption(self, text: str) -> bool:
+        """
+        Check a new caption against the history of used captions and record it if fresh.
+        
+        Returns:
+            bool: False if the caption is empty or too similar to one already used
+        """
+        if not text:
+            return False
+        if Config.CAPTION_SIMILARITY_THRESHOLD <= 0:
+            return True
+        with self._caption_lock:
+            if self._caption_index is None:
+                self._caption_index = CaptionIndex()
+            if self._caption_index.is_repeat(text):
+                return False
+            self._caption_index.add(text)
+        return True
+    
+    def _request_caption_choices(self, count: int, style: str = None) -> list:
+        """Request count captions using the chat API's n parameter."""
+        texts = []
+        remaining = count
+        while remaining > 0:
+            n = min(remaining, MAX_CAPTION_CHOICES)
+            response = self._chat(self._caption_messages(style), max_tokens=100, n=n)
+            texts.extend(self._clean_caption(choice.message.content) for choice in response.choices)
+            remaining -= n
+        return texts
+    
+    def generate_meme_text(self, style: str = None) -> str:
         """
         Generate a short, funny coffee meme caption using the chat API.
         The text is designed to be overlaid on a meme image.
         
+        Captions come from the local caption queue when possible; an empty queue is
+        refilled with one bulk request of CAPTION_BATCH_SIZE captions. A caption too
+        similar to one already used is discarded and replaced, up to
+        CAPTION_MAX_ATTEMPTS times.
+        
+        Args:
+            style: Meme style (defaults to MEME_STYLE)
+        
         Returns:
             str: The meme caption (one or two lines, no quotes)
         """
         try:
             logger.info("Generating meme text...")
-            response = self.client.chat.completions.create(
-                model=Config.TEXT_MODEL,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You write short, funny captions for coffee memes. "
-                            "Reply with ONLY the caption text—no quotes, no explanation, no prefix. "
-                            "Keep it to one or two short lines, relatable and suitable for a meme image."
-                        ),
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Write a {Config.MEME_STYLE} coffee meme caption.",
-                    },
-                ],
-                max_tokens=100,
-            )
-            text = (response.choices[0].message.content or "").strip().strip('"\'')
-            logger.info(f"Meme text: {text!r}")
+            messages = self._caption_messages(style)
+            cache_key = self.cache.key(kind="caption", model=Config.TEXT_MODEL, messages=messages)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                # A rerun of an undelivered meme: already checked and recorded
+                text = cached.decode("utf-8")
+                logger.info(f"Meme text (cached): {text!r}")
+                return text
+            
+            attempts = max(1, Config.CAPTION_MAX_ATTEMPTS)
+            for attempt in range(1, attempts + 1):
+                queued = self._take_queued_captions(1, style)
+                if queued:
+                    text, source = queued[0], "queued"
+                else:
+                    response = self._chat(messages, max_tokens=100)
+                    text, source = self._clean_caption(response.choices[0].message.content), "generated"
+                if self._accept_caption(text):
+                    break
+                logger.warning(f"Caption attempt {attempt} was empty or a repeat, regenerating...")
+            else:
+                logger.warning(f"No fresh caption after {attempts} attempts, using the last one")
+            
+            logger.info(f"Meme text ({source}): {text!r}")
+            self.cache.put(cache_key, text.encode("utf-8"))
             return text
         except Exception as e:
             logger.error(f"Error generating meme text: {e}")
             raise
     
-    def generate_meme_image(self, meme_text: str) -> bytes:
+    def generate_meme_texts(self, count: int, style: str = None) -> list:
+        """
+        Generate several independent captions. Queued captions are used first; any
+        remainder comes from the chat API's n parameter so each request returns
+        many choices in a single round trip. Repeats of used captions (or of each
+        other) are dropped and topped up, up to CAPTION_MAX_ATTEMPTS rounds.
+        
+        Args:
+            count: Number of captions to generate
+            style: Meme style (defaults to MEME_STYLE)
+        
+        Returns:
+            list: Captions (may be shorter than count if too many were empty or repeats)
+        """
+        try:
+            logger.info(f"Generating {count} meme texts...")
+            texts = []
+            for _ in range(max(1, Config.CAPTION_MAX_ATTEMPTS)):
+                remaining = count - len(texts)
+                if remaining <= 0:
+                    break
+                candidates = self._take_queued_captions(remaining, style)
+                if len(candidates) < remaining:
+                    candidates += self._request_caption_choices(remaining - len(candidates), style)
+                texts.extend(text for text in candidates if self._accept_caption(text))
+            logger.info(f"Generated {len(texts)} meme texts")
+            return texts
+        except Exception as e:
+            logger.error(f"Error generating meme texts: {e}")
+            raise
+    
+    def _generate_image(self, image_prompt: str, use_cache: bool = True) -> ImageBuffer:
+        """
+        Generate one image from a prompt with the configured image model.
+        
+        Args:
+            image_prompt: Full image prompt
+            use_cache: Serve and store the image in the run cache (off for library backgrounds)
+        
+        Returns:
+            ImageBuffer: The generated image (decoded or downloaded without extra copies)
+        """
+        image_model = Config.OPENAI_MODEL
+        is_gpt_image = image_model.lower() in GPT_IMAGE_MODELS
+        
+        # Model-specific sizes and quality (gpt-image-1 uses different options)
+        if is_gpt_image:
+            size = Config.IMAGE_SIZE
+            if size not in ["1024x1024", "1536x1024", "1024x1536", "auto"]:
+                size = "1024x1024"
+            quality = Config.IMAGE_QUALITY
+            if quality not in ("high", "medium", "low", "auto"):
+                quality = "high" if quality == "hd" else "medium"
+        else:
+            size = Config.IMAGE_SIZE
+            if size not in ["1024x1024", "1792x1024", "1024x1792"]:
+                size = "1024x1024"
+                logger.warning(f"Invalid image size, using default: {size}")
+            quality = Config.IMAGE_QUALITY
+        
+        kwargs = {
+            "model": image_model,
+            "prompt": image_prompt,
+            "size": size,
+            "quality": quality,
+            "n": 1,
+        }
+        
+        cache_key = None
+        if use_cache:
+            cache_key = self.cache.key(
+                kind="image", model=image_model, prompt=image_prompt, size=size, quality=quality
+            )
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Image served from cache, size: {len(cached)} bytes")
+                return ImageBuffer(cached)
+        
+        # Generate image (queued behind the rate limits, refused past the daily budget)
+        with get_limiter().image_call(self.PROVIDER, image_model, 1, size, quality):
+            response = self.client.images.generate(**kwargs)
+        
+        # gpt-image-1 returns base64 only (url is null); DALL-E returns url
+        item = response.data[0]
+        if getattr(item, "b64_json", None):
+            # a2b_base64 reads the str directly; b64decode would first copy it to bytes
+            image_bytes = ImageBuffer(binascii.a2b_base64(item.b64_json))
+            logger.info(f"Image generated (base64), size: {len(image_bytes)} bytes")
+        elif getattr(item, "url", None):
+            image_url = item.url
+            logger.info(f"Image generated at: {image_url}")
+            import http_client  # requests is only needed for URL responses (DALL-E)
+            image_bytes = http_client.download(image_url)
+            logger.info(f"Downloaded image, size: {len(image_bytes)} bytes")
+        else:
+            raise ValueError("Image response had no b64_json or url")
+        
+        if cache_key is not None:
+            self.cache.put(cache_key, image_bytes)
+        return image_bytes
+    
+    def generate_background(self) -> ImageBuffer:
+        """
+        Generate a caption-free coffee scene for the composite background library.
+        
+        Returns:
+            ImageBuffer: The generated background
+        """
+        return self._generate_image(BACKGROUND_PROMPT, use_cache=False)
+    
+    def generate_meme_image(self, meme_text: str) -> ImageBuffer:
         """
         Generate a coffee meme image that displays the given text using DALL-E.
         The image prompt instructs the model to render the exact text clearly.
         
+        With CAPTION_MODE=composite the caption is instead drawn locally over a
+        reused background (see compositor.py), and the model is only called when
+        the background library needs a new image.
+        
         Args:
             meme_text: The caption to display on the image (from generate_meme_text).
         
         Returns:
-            bytes: The generated image as bytes
+            ImageBuffer: The generated image (decoded or downloaded without extra copies)
         """
         try:
+            if Config.CAPTION_MODE == "composite":
+                import compositor  # Pillow drawing is only needed in composite mode
+                
+                logger.info("Compositing coffee meme caption locally...")
+                return compositor.composite_meme(meme_text, self.generate_background)
+            
             logger.info("Generating coffee meme image with caption...")
             
             # Prompt tells DALL-E exactly what text to show so it renders it clearly
@@ -77,53 +385,40 @@ class OpenAIService:
                 "Style: realistic, like something you would see on Facebook or Instagram. "
                 "Make the text the main focus of the meme."
             )
-            
-            image_model = Config.OPENAI_MODEL
-            is_gpt_image = image_model.lower() in GPT_IMAGE_MODELS
-
-            # Model-specific sizes and quality (gpt-image-1 uses different options)
-            if is_gpt_image:
-                size = Config.IMAGE_SIZE
-                if size not in ["1024x1024", "1536x1024", "1024x1536", "auto"]:
-                    size = "1024x1024"
-                quality = Config.IMAGE_QUALITY
-                if quality not in ("high", "medium", "low", "auto"):
-                    quality = "high" if quality == "hd" else "medium"
-            else:
-                size = Config.IMAGE_SIZE
-                if size not in ["1024x1024", "1792x1024", "1024x1792"]:
-                    size = "1024x1024"
-                    logger.warning(f"Invalid image size, using default: {size}")
-                quality = Config.IMAGE_QUALITY
-
-            kwargs = {
-                "model": image_model,
-                "prompt": image_prompt,
-                "size": size,
-                "quality": quality,
-                "n": 1,
-            }
-
-            # Generate image
-            response = self.client.images.generate(**kwargs)
-
-            # gpt-image-1 returns base64 only (url is null); DALL-E returns url
-            item = response.data[0]
-            if getattr(item, "b64_json", None):
-                image_bytes = base64.b64decode(item.b64_json)
-                logger.info(f"Image generated (base64), size: {len(image_bytes)} bytes")
-            elif getattr(item, "url", None):
-                image_url = item.url
-                logger.info(f"Image generated at: {image_url}")
-                image_response = requests.get(image_url)
-                image_response.raise_for_status()
-                image_bytes = image_response.content
-                logger.info(f"Downloaded image, size: {len(image_bytes)} bytes")
-            else:
-                raise ValueError("Image response had no b64_json or url")
-            
-            return image_bytes
-            
+            return self._generate_image(image_prompt)
+        
         except Exception as e:
             logger.error(f"Error generating meme image: {e}")
             raise
+    
+    def fill_background_library(self, count: int = None) -> int:
+        """
+        Generate backgrounds until the composite library is full (or count more are added).
+        
+        Returns:
+            int: Number of backgrounds added
+        """
+        import compositor
+        
+        library = compositor.BackgroundLibrary()
+        if count is None:
+            count = max(0, library.size - len(library))
+        for _ in range(count):
+            library.add(self.generate_background())
+        logger.info(f"Background library now holds {len(library)} backgrounds")
+        return count
+    
+    def warm_up(self):
+        """Open the pooled API connection ahead of a run with a free models request."""
+        self.client.models.list()
+    
+    def close(self):
+        """Close the SDK's pooled HTTP connections."""
+        self.client.close()
+    
+    def release_cached(self):
+        """
+        Drop this run's cached caption/image once the meme has been delivered, so the
+        next run generates a fresh meme instead of resending the cached one.
+        """
+        self.cache.release()
@@ -0,0 +1,342 @@
+"""Durable outbox: finished memes queued on disk and emailed by a background worker with retries."""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_bytes, atomic_write_json, file_lock
+from image_buffer import as_view
+import run_metrics
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENT = "sent"
+DEAD = "dead"
+CLAIM_STALE_SECONDS = 3600  # A delivery claim older than this was left by a crashed process
+RECEIPT_DAYS = 30  # Delivery receipts are kept this long, so re-queuing a delivered meme is a no-op
+
+
+def delivery_key(image_bytes, recipients: list) -> str:
+    """Idempotency key: the same image for the same recipients is one delivery."""
+    digest = hashlib.sha256(as_view(image_bytes))
+    digest.update("\n".join(sorted(recipients)).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+class Outbox:
+    """
+    Memes waiting for email delivery, kept on disk so a slow or failing relay never
+    costs a generated meme.
+    
+    Each entry is an image plus a JSON envelope (recipients, attempts, next attempt
+    time, last error) under pending/. The envelope is written last, so an entry
+    exists only once it is complete. Delivery records each recipient as its chunk
+    is accepted, and retries only go to the recipients still missing, with
+    exponential backoff. Entries move to sent/ as a receipt when done, or to
+    dead/ after OUTBOX_MAX_ATTEMPTS. Every message of an entry carries the same
+    Message-ID, so mail clients can drop a copy resent after a crash.
+    """
+    
+    def __init__(self, directory: str = None, max_attempts: int = None, retry_seconds: float = None,
+                 max_retry_seconds: float = None):
+        """
+        Args:
+            directory: Outbox directory (defaults to OUTBOX_DIR from config)
+            max_attempts: Attempts before an entry is dead-lettered (defaults to OUTBOX_MAX_ATTEMPTS)
+            retry_seconds: First retry delay, doubled per attempt (defaults to OUTBOX_RETRY_SECONDS)
+            max_retry_seconds: Longest retry delay (defaults to OUTBOX_MAX_RETRY_SECONDS)
+        """
+        self.directory = Path(directory or Config.OUTBOX_DIR)
+        self.max_attempts = max_attempts if max_attempts is not None else Config.OUTBOX_MAX_ATTEMPTS
+        self.retry_seconds = retry_seconds if retry_seconds is not None else Config.OUTBOX_RETRY_SECONDS
+        self.max_retry_seconds = max_retry_seconds if max_retry_seconds is not None else Config.OUTBOX_MAX_RETRY_SECONDS
+        for state in (PENDING, SENT, DEAD):
+            (self.directory / state).mkdir(parents=True, exist_ok=True)
+    
+    def _path(self, state: str, key: str, suffix: str = ".json") -> Path:
+        return self.directory / state / f"{key}{suffix}"
+    
+    @staticmethod
+    def _read(path: Path):
+        """An envelope, or None if it is gone (moved by another worker) or unreadable."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring corrupt outbox envelope: {path}")
+            return None
+    
+    def enqueue(self, image_bytes, recipients: list, meme: dict = None) -> str:
+        """
+        Queue a meme for delivery; a meme already queued, sent or dead-lettered for
+        the same recipients is not queued again.
+        
+        Args:
+            image_bytes: Processed image (ImageBuffer or bytes)
+            recipients: Email addresses
+            meme: Extra fields kept in the envelope (e.g. the archive path)
+        
+        Returns:
+            str: The entry's delivery key
+        """
+        recipients = [address for address in recipients if address]
+        if not recipients:
+            raise ValueError("No valid recipient email addresses provided")
+        key = delivery_key(image_bytes, recipients)
+        for state in (PENDING, SENT, DEAD):
+            if self._path(state, key).exists():
+                logger.info(f"Meme {key} is already in the outbox ({state}), not queuing it again")
+                return key
+        domain = (Config.EMAIL_ADDRESS or "localhost").rpartition("@")[2]
+        atomic_write_bytes(self._path(PENDING, key, ".jpg"), as_view(image_bytes))
+        atomic_write_json(self._path(PENDING, key), {
+            "key": key,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "recipients": recipients,
+            "message_id": f"<{key}@{domain}>",
+            "delivered": [],
+            "refused": {},
+            "attempts": 0,
+            "next_attempt": time.time(),
+            "last_error": None,
+            "email_seconds": 0.0,
+            "meme": meme or {},
+        })
+        run_metrics.count("outbox_enqueued")
+        logger.info(f"Queued meme {key} for {len(recipients)} recipient(s)")
+        return key
+    
+    def entries(self, state: str = PENDING) -> list:
+        """Envelopes in a state, oldest first."""
+        envelopes = (self._read(path) for path in (self.directory / state).glob("*.json"))
+        return sorted((envelope for envelope in envelopes if envelope), key=lambda envelope: envelope["created"])
+    
+    def counts(self) -> dict:
+        """{"pending", "sent", "dead"} entry counts."""
+        return {state: sum(1 for _ in (self.directory / state).glob("*.json")) for state in (PENDING, SENT, DEAD)}
+    
+    def due(self, now: float = None) -> list:
+        """Pending envelopes whose next attempt time has come."""
+        now = time.time() if now is None else now
+        return [envelope for envelope in self.entries() if envelope["next_attempt"] <= now]
+    
+    def next_attempt(self):
+        """Epoch seconds of the earliest pending attempt, or None if nothing is pending."""
+        return min((envelope["next_attempt"] for envelope in self.entries()), default=None)
+    
+    def deliver(self, key: str, email_service):
+        """
+        Attempt one pending entry, unless another worker holds it.
+        
+        Returns:
+            tuple: (status, envelope) with status "sent", "retry" or "dead", or None
+                   if the entry is claimed elsewhere or no longer pending
+        """
+        with contextlib.ExitStack() as claim:
+            # Only a busy claim means "held elsewhere"; a TimeoutError from the send itself must propagate
+            try:
+                claim.enter_context(file_lock(self._path(PENDING, key, ".lock"), timeout=0,
+                                              stale_after=CLAIM_STALE_SECONDS))
+            except TimeoutError:
+                return None
+            return self._deliver(key, email_service)
+    
+    def _deliver(self, key: str, email_service):
+        envelope = self._read(self._path(PENDING, key))
+        if envelope is None:
+            return None
+        if self._path(SENT, key).exists():
+            # Finished before a crash left the pending files behind
+            self._remove_pending(key)
+            return None
+        
+        remaining = [address for address in envelope["recipients"]
+                     if address not in envelope["delivered"] and address not in envelope["refused"]]
+        envelope["attempts"] += 1
+        error = None
+        started = time.monotonic()
+        try:
+            image_bytes = self._path(PENDING, key, ".jpg").read_bytes()
+            report = email_service.send_image_with_report(image_bytes, recipients=remaining,
+                                                          message_id=envelope["message_id"])
+        except Exception as e:
+            report, error = [], f"{type(e).__name__}: {e}"
+        envelope["email_seconds"] += time.monotonic() - started
+        for chunk in report:
+            if chunk["error"] is None:
+                envelope["refused"].update(chunk["refused"])
+                envelope["delivered"] += [address for address in chunk["recipients"] if address not in chunk["refused"]]
+            else:
+                error = chunk["error"]
+        envelope["last_error"] = error
+        
+        if error is None:
+            envelope["sent"] = datetime.now().isoformat(timespec="seconds")
+            atomic_write_json(self._path(SENT, key), envelope)  # The receipt first, so a crash cannot resend
+            self._remove_pending(key)
+            run_metrics.count("outbox_sent")
+            logger.info(f"Delivered meme {key} after {envelope['attempts']} attempt(s)")
+            return "sent", envelope
+        if envelope["attempts"] >= self.max_attempts:
+            os.replace(self._path(PENDING, key, ".jpg"), self._path(DEAD, key, ".jpg"))
+            atomic_write_json(self._path(DEAD, key), envelope)
+            self._path(PENDING, key).unlink()
+            run_metrics.count("outbox_dead")
+            logger.error(f"Dead-lettered meme {key} after {envelope['attempts']} attempts: {error}")
+            return "dead", envelope
+        delay = min(self.max_retry_seconds, self.retry_seconds * 2 ** (envelope["attempts"] - 1))
+        envelope["next_attempt"] = time.time() + delay * random.uniform(0.8, 1.2)  # Jitter spreads out retries
+        atomic_write_json(self._path(PENDING, key), envelope)
+        run_metrics.count("outbox_retries")
+        logger.warning(f"Delivery of meme {key} failed (attempt {envelope['attempts']}/{self.max_attempts}), "
+                       f"retrying in {delay:.0f}s: {error}")
+        return "retry", envelope
+    
+    def _remove_pending(self, key: str):
+        for suffix in (".json", ".jpg"):
+            self._path(PENDING, key, suffix).unlink(missing_ok=True)
+    
+    def requeue_dead(self) -> int:
+        """Move dead-lettered entries back to pending with a fresh attempt count."""
+        requeued = 0
+        for envelope in self.entries(DEAD):
+            key = envelope["key"]
+            envelope.update(attempts=0, next_attempt=time.time(), last_error=None)
+            os.replace(self._path(DEAD, key, ".jpg"), self._path(PENDING, key, ".jpg"))
+            atomic_write_json(self._path(PENDING, key), envelope)
+            self._path(DEAD, key).unlink()
+            requeued += 1
+        logger.info(f"Requeued {requeued} dead-lettered meme(s)")
+        return requeued
+    
+    def prune_receipts(self, days: int = RECEIPT_DAYS) -> int:
+        """Delete delivery receipts older than days."""
+        cutoff = (datetime.now() - timedelta(days=days)).timestamp()
+        pruned = 0
+        for path in (self.directory / SENT).glob("*.json"):
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+                pruned += 1
+        return pruned
+
+
+class OutboxWorker:
+    """Delivers due outbox entries, on a background thread or until a deadline."""
+    
+    def __init__(self, outbox: Outbox = None, email_service=None, on_delivered=None, poll_seconds: float = None):
+        """
+        Args:
+            outbox: Outbox to drain (defaults to the configured one)
+            email_service: EmailService to send with (created on first use, and closed by stop(), if None)
+            on_delivered: Called as on_delivered(envelope) after an entry is fully delivered
+            poll_seconds: Longest sleep between checks for new entries (defaults to OUTBOX_POLL_SECONDS)
+        """
+        self.outbox = outbox or Outbox()
+        self.email_service = email_service
+        self._owns_email_service = email_service is None
+        self.on_delivered = on_delivered
+        self.poll_seconds = poll_seconds if poll_seconds is not None else Config.OUTBOX_POLL_SECONDS
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+    
+    def _email(self):
+        if self.email_service is None:
+            from email_service import EmailService  # smtplib/ssl are only needed to send
+            self.email_service = EmailService(pool_size=1)
+        return self.email_service
+    
+    def use_email_service(self, email_service):
+        """
+        Send with a caller's EmailService from now on (e.g. the daemon's warm one).
+        
+        The caller keeps ownership: stop() no longer closes it. An EmailService the
+        worker created itself is closed.
+        """
+        if email_service is None or email_service is self.email_service:
+            return
+        previous, owned = self.email_service, self._owns_email_service
+        self.email_service = email_service
+        self._owns_email_service = False
+        if owned and previous is not None:
+            previous.close()
+    
+    def drain(self) -> dict:
+        """
+        Attempt every due entry once.
+        
+        Returns:
+            dict: {"sent", "retry", "dead"} counts for this pass
+        """
+        counts = {"sent": 0, "retry": 0, "dead": 0}
+        for envelope in self.outbox.due():
+            if self._stop.is_set():
+                break
+            result = self.outbox.deliver(envelope["key"], self._email())
+            if result is None:
+                continue
+            status, envelope = result
+            counts[status] += 1
+            if status == "sent" and self.on_delivered is not None:
+                try:
+                    self.on_delivered(envelope)
+                except Exception as e:
+                    logger.warning(f"Delivery hook failed for meme {envelope['key']}: {e}")
+        return counts
+    
+    def run(self, deadline: float = None) -> dict:
+        """
+        Deliver entries as they come due until stopped, or until the outbox is empty
+        or the deadline (time.monotonic()) passes.
+        
+        Returns:
+            dict: {"sent", "retry", "dead"} totals
+        """
+        totals = {"sent": 0, "retry": 0, "dead": 0}
+        self.outbox.prune_receipts()
+        while not self._stop.is_set():
+            try:
+                for status, count in self.drain().items():
+                    totals[status] += count
+                next_attempt = self.outbox.next_attempt()
+            except Exception as e:
+                logger.error(f"Outbox delivery pass failed: {e}", exc_info=True)
+                next_attempt = time.time() + self.poll_seconds
+            if deadline is not None and (next_attempt is None or time.monotonic() >= deadline):
+                break
+            wait = self.poll_seconds if next_attempt is None else max(0.0, next_attempt - time.time())
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if wait > 0:
+                self._wake.wait(min(wait, self.poll_seconds))
+                self._wake.clear()
+        return totals
+    
+    def wake(self):
+        """Check for due entries now (e.g. right after enqueueing)."""
+        self._wake.set()
+    
+    def start(self) -> "OutboxWorker":
+        """Deliver on a background thread until stop()."""
+        self._thread = threading.Thread(target=self.run, name="outbox-worker", daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self, timeout: float = 30):
+        """Stop after the current delivery and close the worker's own EmailService."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._owns_email_service and self.email_service is not None:
+            self.email_service.close()
+            self.email_service = None
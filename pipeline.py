@@ -0,0 +1,261 @@
+"""Asyncio pipeline that overlaps the stages of consecutive memes."""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from rate_limit import BudgetExceeded
+import run_metrics
+
+logger = logging.getLogger(__name__)
+
+
+async def save_and_send(save, send=None) -> tuple:
+    """
+    Archive a meme while it is being emailed.
+
+    Both callables block (disk, smtplib) and run on the loop's default executor.
+    Errors are returned rather than raised, so a failed archive write cannot hide
+    a delivery that already happened (or the other way round).
+
+    Args:
+        save: Archives the meme and returns its path
+        send: Emails the meme and returns True on success (None = save only)
+
+    Returns:
+        tuple: (path or save exception, sent flag or send exception (None without send),
+                seconds spent sending)
+    """
+    email_seconds = None
+
+    def timed_send():
+        nonlocal email_seconds
+        started = time.monotonic()
+        try:
+            return send()
+        finally:
+            email_seconds = time.monotonic() - started
+
+    jobs = [asyncio.to_thread(save)]
+    if send is not None:
+        jobs.append(asyncio.to_thread(timed_send))
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    return results[0], results[1] if send is not None else None, email_seconds
+
+
+def _process(image_bytes) -> tuple:
+    """Render the email JPEG and extra renditions (CPU pool worker)."""
+    from image_processor import ImageProcessor  # Pillow is only needed once there is an image
+
+    with run_metrics.span("process", input_bytes=len(image_bytes)) as span:
+        renditions = ImageProcessor.render(image_bytes)
+        processed_image, stats = renditions.pop("email")
+        span.update(bytes=len(processed_image), encodes=stats["encodes"], quality=stats["quality"],
+                    renditions=len(renditions))
+    run_metrics.count("jpeg_encodes", stats["encodes"])
+    return processed_image, renditions, stats
+
+
+class MemePipeline:
+    """
+    Generates, processes, archives and optionally emails memes with their stages overlapped.
+
+    The services stay blocking (provider SDKs, requests, smtplib) and keep their
+    shared rate limits, budget and caches; one event loop awaits them on an I/O
+    thread pool, and Pillow work runs on a CPU-sized pool (Pillow releases the
+    GIL while decoding and encoding):
+
+    - OpenAI captions for the first round of images are requested alone, and
+      the rest while those images render
+    - at most `concurrency` image requests are in flight
+    - each finished image is processed, then archived while it is emailed,
+      without holding up the next provider call
+    """
+
+    def __init__(self, ai_service, describe, save, email_service=None, recipients: list = None,
+                 record_send=None, concurrency: int = 4):
+        """
+        Args:
+            ai_service: OpenAIService or GrokService
+            describe: Called as describe(caption) for a new meme's metadata dict (with "stages")
+            save: Called as save(processed_image, renditions, meme); archives a meme, returns its path
+            email_service: EmailService to send each meme with (None = save only)
+            recipients: Addresses for email_service
+            record_send: Called as record_send(path, recipients, email_seconds) after a delivery
+            concurrency: Maximum image requests in flight
+        """
+        self.ai_service = ai_service
+        self.describe = describe
+        self.save = save
+        self.email_service = email_service
+        self.recipients = recipients or []
+        self.record_send = record_send
+        self.concurrency = concurrency
+        self.counts = {"saved": 0, "sent": 0, "failed": 0}
+        self._budget_error = None
+        self._finishing = set()
+        self._cpu = None
+        self._save_lock = threading.Lock()  # The archive index takes one writer at a time
+
+    async def run(self, count: int) -> dict:
+        """
+        Produce count memes.
+
+        Generation stops at the first call refused by the daily budget; memes
+        already generated are still finished.
+
+        Returns:
+            dict: {"saved", "sent", "failed"} counts
+        """
+        loop = asyncio.get_running_loop()
+        # Provider calls, archive writes and SMTP sends all wait on I/O; size the pool for all of them
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency * 2 + 2,
+                                                     thread_name_prefix="pipeline-io"))
+        self._cpu = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="pipeline-cpu")
+        try:
+            if self.ai_service.PROVIDER == "grok":
+                await self._generate_grok(count)
+            else:
+                await self._generate_openai(count)
+            while self._finishing:
+                await asyncio.gather(*list(self._finishing))
+        finally:
+            self._cpu.shutdown()
+        return self.counts
+
+    async def _call(self, stage: str, fn, *args, meme: dict = None):
+        """Await a blocking provider call on the I/O pool inside a run-metrics span."""
+        def call():
+            with run_metrics.span(stage, provider=self.ai_service.PROVIDER) as span:
+                result = fn(*args)
+                if stage == "image":
+                    span["bytes"] = sum(map(len, result)) if isinstance(result, list) else len(result)
+                return result
+
+        started = time.monotonic()
+        result = await asyncio.to_thread(call)
+        if meme is not None:
+            meme["stages"][stage] = round(time.monotonic() - started, 3)
+        return result
+
+    def _fail(self, what: str, error: Exception):
+        self.counts["failed"] += 1
+        logger.error(f"{what} failed: {error}")
+
+    def _refuse(self, error: BudgetExceeded):
+        """Stop generating after the first budget refusal; calls in flight still finish."""
+        if self._budget_error is None:
+            self._budget_error = error
+            self._fail("Meme generation", error)
+
+    async def _generate_openai(self, count: int):
+        captions = asyncio.Queue(maxsize=self.concurrency)
+
+        async def request_captions():
+            # Enough captions for the first round of images, then the rest in one request (n
+            # choices or the caption queue) while those images render
+            remaining = count
+            while remaining > 0 and self._budget_error is None:
+                size = min(self.concurrency, remaining) if remaining == count else remaining
+                remaining -= size
+                started = time.monotonic()
+                try:
+                    chunk = await self._call("caption", self.ai_service.generate_meme_texts, size)
+                except BudgetExceeded as e:
+                    self._refuse(e)
+                    break
+                except Exception as e:
+                    self._fail("Caption generation", e)
+                    continue
+                seconds = round(time.monotonic() - started, 3)
+                if len(chunk) < size:
+                    self._fail("Caption generation", f"got {len(chunk)} of {size} captions")
+                for caption in chunk:
+                    await captions.put((caption, seconds))
+            for _ in range(self.concurrency):
+                await captions.put(None)
+
+        async def render_images():
+            while (item := await captions.get()) is not None:
+                if self._budget_error is not None:
+                    continue
+                caption, caption_seconds = item
+                meme = self.describe(caption)
+                meme["stages"]["caption"] = caption_seconds
+                try:
+                    image_bytes = await self._call("image", self.ai_service.generate_meme_image, caption, meme=meme)
+                except BudgetExceeded as e:
+                    self._refuse(e)
+                    continue
+                except Exception as e:
+                    self._fail("Meme generation", e)
+                    continue
+                self._finish_later(image_bytes, meme)
+
+        await asyncio.gather(request_captions(), *(render_images() for _ in range(self.concurrency)))
+
+    async def _generate_grok(self, count: int):
+        chunk = self.ai_service.MAX_IMAGES_PER_REQUEST
+        sizes = deque(min(chunk, count - start) for start in range(0, count, chunk))
+
+        async def render_images():
+            while sizes and self._budget_error is None:
+                n = sizes.popleft()
+                started = time.monotonic()
+                try:
+                    images = await self._call("image", self.ai_service.generate_meme_images, n)
+                except BudgetExceeded as e:
+                    self._refuse(e)
+                    break
+                except Exception as e:
+                    self._fail("Meme generation", e)
+                    continue
+                seconds = round(time.monotonic() - started, 3)
+                for image_bytes in images:
+                    meme = self.describe(None)
+                    meme["stages"]["image"] = seconds
+                    self._finish_later(image_bytes, meme)
+
+        await asyncio.gather(*(render_images() for _ in range(self.concurrency)))
+
+    def _finish_later(self, image_bytes, meme: dict):
+        """Process, archive and send in the background so the next provider call starts now."""
+        task = asyncio.create_task(self._finish(image_bytes, meme))
+        self._finishing.add(task)
+        task.add_done_callback(self._finishing.discard)
+
+    def _save(self, processed_image, renditions: dict, meme: dict):
+        with self._save_lock, run_metrics.span("save", bytes=len(processed_image)):
+            return self.save(processed_image, renditions, meme)
+
+    def _send(self, processed_image) -> bool:
+        with run_metrics.span("email", bytes=len(processed_image), recipients=len(self.recipients)):
+            return self.email_service.send_image(processed_image, recipients=self.recipients)
+
+    async def _finish(self, image_bytes, meme: dict):
+        started = time.monotonic()
+        try:
+            processed_image, renditions, stats = await asyncio.get_running_loop().run_in_executor(
+                self._cpu, _process, image_bytes)
+        except Exception as e:
+            self._fail("Processing", e)
+            return
+        meme["quality"] = stats["quality"]
+        meme["stages"]["process"] = round(time.monotonic() - started, 3)
+
+        send = (lambda: self._send(processed_image)) if self.email_service is not None else None
+        filepath, sent, email_seconds = await save_and_send(lambda: self._save(processed_image, renditions, meme), send)
+        if isinstance(filepath, Exception):
+            self._fail("Saving", filepath)
+            filepath = None
+        else:
+            self.counts["saved"] += 1
+            logger.info(f"[{self.counts['saved']}] Image saved to: {filepath}")
+        if isinstance(sent, Exception):
+            self._fail("Sending", sent)
+        elif sent:
+            self.counts["sent"] += 1
+            if filepath is not None and self.record_send is not None:
+                await asyncio.to_thread(self.record_send, filepath, self.recipients, email_seconds)
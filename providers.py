@@ -0,0 +1,35 @@
+"""Registry of AI providers whose service modules (and SDKs) are imported only when used."""
+import importlib
+import logging
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# provider name -> (module, service class, log message when selected)
+PROVIDERS = {
+    "openai": ("openai_service", "OpenAIService", "Using OpenAI for text and image generation"),
+    "grok": ("grok_service", "GrokService", "Using Grok (xAI) image model only for meme generation"),
+}
+
+
+def service_class(provider: str = None):
+    """
+    Import and return the service class for a provider (defaults to AI_PROVIDER).
+
+    Importing openai or xai_sdk costs hundreds of milliseconds, so each SDK is
+    only loaded the first time its provider is actually used.
+    """
+    provider = provider or Config.AI_PROVIDER
+    try:
+        module_name, class_name, _ = PROVIDERS[provider]
+    except KeyError:
+        raise ValueError(f"Unknown AI provider: {provider!r} (expected one of {', '.join(PROVIDERS)})")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_service(provider: str = None):
+    """Create the image/text service for a provider (defaults to AI_PROVIDER)."""
+    provider = provider or Config.AI_PROVIDER
+    service = service_class(provider)()
+    logger.info(PROVIDERS[provider][2])
+    return service
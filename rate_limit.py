@@ -0,0 +1,305 @@
+"""Client-side rate limits and a daily spending budget for provider API calls."""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_json, file_lock
+import run_metrics
+
+logger = logging.getLogger(__name__)
+
+# USD per image by model, quality and size (see the pricing links in the README).
+# "auto" quality is charged at the highest rate, since the provider picks it.
+IMAGE_PRICES = {
+    "gpt-image-1": {
+        "low": {"1024x1024": 0.011, "1024x1536": 0.016, "1536x1024": 0.016},
+        "medium": {"1024x1024": 0.042, "1024x1536": 0.063, "1536x1024": 0.063},
+        "high": {"1024x1024": 0.167, "1024x1536": 0.25, "1536x1024": 0.25},
+    },
+    "gpt-image-1-mini": {
+        "low": {"1024x1024": 0.005, "1024x1536": 0.006, "1536x1024": 0.006},
+        "medium": {"1024x1024": 0.011, "1024x1536": 0.015, "1536x1024": 0.015},
+        "high": {"1024x1024": 0.036, "1024x1536": 0.052, "1536x1024": 0.052},
+    },
+    "dall-e-3": {
+        "standard": {"1024x1024": 0.04, "1024x1792": 0.08, "1792x1024": 0.08},
+        "hd": {"1024x1024": 0.08, "1024x1792": 0.12, "1792x1024": 0.12},
+    },
+    "dall-e-2": {
+        "standard": {"256x256": 0.016, "512x512": 0.018, "1024x1024": 0.02},
+    },
+    "grok-imagine-image": {
+        None: {None: 0.07},
+    },
+}
+
+# USD per million (input, output) tokens
+TEXT_PRICES = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+# Charged for models missing from the tables, so an unknown model cannot bypass the budget
+UNKNOWN_IMAGE_PRICE = 0.25
+UNKNOWN_TEXT_PRICES = (2.50, 10.00)
+
+LEDGER_DAYS = 31  # Days of spending history kept
+
+
+class BudgetExceeded(RuntimeError):
+    """A provider call would take today's spending past DAILY_BUDGET_USD."""
+
+
+def image_cost(model: str, size: str = None, quality: str = None, n: int = 1) -> float:
+    """USD for n images; unknown sizes/qualities are charged at the model's highest rate."""
+    qualities = IMAGE_PRICES.get(model.lower())
+    if qualities is None:
+        return UNKNOWN_IMAGE_PRICE * n
+    sizes = qualities.get(quality) or max(qualities.values(), key=lambda prices: max(prices.values()))
+    price = sizes.get(size, max(sizes.values()))
+    return price * n
+
+
+def text_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """USD for a chat completion's token usage."""
+    input_price, output_price = TEXT_PRICES.get(model.lower(), UNKNOWN_TEXT_PRICES)
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def estimate_tokens(messages: list) -> int:
+    """Rough prompt token count (about 4 characters per token, plus per-message overhead)."""
+    return sum(len(message.get("content") or "") // 4 + 4 for message in messages) + 3
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `per_minute` tokens per minute.
+
+    take() never fails: callers reserve their tokens up front (the bucket may go
+    negative) and sleep until the debt is paid off, so waiting calls are served
+    in arrival order and a burst queues instead of hitting the provider's 429s.
+    """
+
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Take amount tokens and return the seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= min(amount, self.capacity)  # Requests larger than the bucket wait for a full one
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def refund(self, amount: float):
+        """Return unused tokens (e.g. when actual usage was below the estimate)."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def take(self, amount: float = 1) -> float:
+        """Take amount tokens, sleeping until they are available; returns seconds waited."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class SpendLedger:
+    """
+    Provider spending per day, shared by every process through a JSON file.
+
+    Calls reserve their estimated cost before they are made, so concurrent
+    calls cannot overshoot the budget together; the reservation is settled
+    with the actual cost afterwards, or cancelled if the call failed.
+    """
+
+    def __init__(self, path: str = None, daily_budget: float = None):
+        """
+        Args:
+            path: Ledger file (defaults to SPEND_LEDGER_PATH from config)
+            daily_budget: USD per day (defaults to DAILY_BUDGET_USD from config; 0 = no limit)
+        """
+        self.path = Path(path or Config.SPEND_LEDGER_PATH)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self._daily_budget = daily_budget
+        self._lock = threading.Lock()
+
+    @property
+    def daily_budget(self) -> float:
+        """USD per day, 0 for no limit (follows DAILY_BUDGET_USD across config reloads)."""
+        return self._daily_budget if self._daily_budget is not None else Config.DAILY_BUDGET_USD
+
+    def _read(self) -> dict:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring corrupt spend ledger: {self.path}")
+            return {}
+
+    def _update(self, fn):
+        """Apply fn(today's entry) under the ledger lock and write the result."""
+        with self._lock, file_lock(self.lock_path):
+            ledger = self._read()
+            today = date.today().isoformat()
+            entry = ledger.setdefault(today, {"usd": 0.0, "calls": {}})
+            result = fn(entry)
+            cutoff = (date.today() - timedelta(days=LEDGER_DAYS)).isoformat()
+            atomic_write_json(self.path, {day: value for day, value in ledger.items() if day >= cutoff})
+            return result
+
+    def spent_today(self) -> float:
+        """USD spent (or reserved by calls in flight) today."""
+        return self._read().get(date.today().isoformat(), {}).get("usd", 0.0)
+
+    def reserve(self, usd: float, label: str) -> float:
+        """
+        Reserve usd of today's budget for a call.
+
+        Raises:
+            BudgetExceeded: If the reservation would pass the daily budget
+        """
+        def apply(entry):
+            if self.daily_budget > 0 and entry["usd"] + usd > self.daily_budget:
+                raise BudgetExceeded(
+                    f"{label} (${usd:.4f}) would exceed the daily budget: "
+                    f"${entry['usd']:.4f} of ${self.daily_budget:.2f} already spent"
+                )
+            entry["usd"] += usd
+            return usd
+        return self._update(apply)
+
+    def settle(self, reserved: float, actual: float, label: str):
+        """Replace a reservation with the actual cost (0 for a failed call) and count the call."""
+        def apply(entry):
+            entry["usd"] = max(0.0, entry["usd"] - reserved + actual)
+            if actual > 0:
+                entry["calls"][label] = entry["calls"].get(label, 0) + 1
+        self._update(apply)
+
+
+class ProviderLimiter:
+    """
+    Requests-per-minute and images/tokens-per-minute buckets per provider and model,
+    plus the daily budget check, shared by every service in the process.
+    """
+
+    def __init__(self, ledger: SpendLedger = None):
+        self.ledger = ledger or SpendLedger()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _limits(provider: str, kind: str) -> tuple:
+        """(requests per minute, units per minute) from config; units are images or tokens."""
+        if provider == "grok":
+            return Config.GROK_IMAGE_RPM, Config.GROK_IMAGE_IPM
+        if kind == "text":
+            return Config.OPENAI_TEXT_RPM, Config.OPENAI_TEXT_TPM
+        return Config.OPENAI_IMAGE_RPM, Config.OPENAI_IMAGE_IPM
+
+    def _bucket(self, provider: str, model: str, unit: str, per_minute: float):
+        if per_minute <= 0:
+            return None
+        key = (provider, model, unit, per_minute)  # A changed limit (config reload) starts a new bucket
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(per_minute)
+            return self._buckets[key]
+
+    def _wait(self, provider: str, model: str, kind: str, units: float) -> list:
+        """Queue for the request and unit buckets; returns the buckets that were charged units."""
+        if not Config.RATE_LIMITS_ENABLED:
+            return []
+        requests_per_minute, units_per_minute = self._limits(provider, kind)
+        waited = 0.0
+        charged = []
+        request_bucket = self._bucket(provider, model, "requests", requests_per_minute)
+        if request_bucket is not None:
+            waited += request_bucket.take(1)
+        unit_bucket = self._bucket(provider, model, "tokens" if kind == "text" else "images", units_per_minute)
+        if unit_bucket is not None:
+            waited += unit_bucket.take(units)
+            charged.append(unit_bucket)
+        if waited > 0:
+            logger.info(f"Rate limit: waited {waited:.1f}s for {provider} {model}")
+            run_metrics.count("rate_limit_waits")
+        return charged
+
+    @contextmanager
+    def image_call(self, provider: str, model: str, n: int = 1, size: str = None, quality: str = None):
+        """
+        Wrap one image request: check the budget, then wait for the rate limits.
+
+        Raises:
+            BudgetExceeded: Before the request is made, if it would pass the daily budget
+        """
+        label = f"{provider}/{model}"
+        usd = image_cost(model, size, quality, n)
+        reserved = self.ledger.reserve(usd, label)
+        try:
+            self._wait(provider, model, "image", n)
+            yield
+        except BaseException:
+            self.ledger.settle(reserved, 0.0, label)
+            raise
+        self.ledger.settle(reserved, usd, label)
+        run_metrics.add_cost(label, usd)
+
+    @contextmanager
+    def text_call(self, provider: str, model: str, messages: list, max_tokens: int, n: int = 1):
+        """
+        Wrap one chat request. Yields a dict; set its "usage" to the response's usage so
+        the actual cost is recorded and unused tokens go back to the bucket.
+
+        Raises:
+            BudgetExceeded: Before the request is made, if it would pass the daily budget
+        """
+        call = {"usage": None}
+        label = f"{provider}/{model}"
+        prompt_tokens = estimate_tokens(messages)
+        estimate = prompt_tokens + max_tokens * n  # What the provider's own limiter counts
+        reserved = self.ledger.reserve(text_cost(model, prompt_tokens, max_tokens * n), label)
+        try:
+            charged = self._wait(provider, model, "text", estimate)
+            yield call
+        except BaseException:
+            self.ledger.settle(reserved, 0.0, label)
+            raise
+        usage = call["usage"]
+        if usage is not None:
+            actual = text_cost(model, usage.prompt_tokens, usage.completion_tokens)
+            for bucket in charged:
+                bucket.refund(max(0, estimate - usage.total_tokens))
+        else:
+            actual = reserved
+        self.ledger.settle(reserved, actual, label)
+        run_metrics.add_cost(label, actual)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> ProviderLimiter:
+    """Return the process-wide limiter, creating it on first use (thread-safe)."""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = ProviderLimiter()
+    return _limiter
@@ -0,0 +1,205 @@
+"""Content-addressed on-disk cache for provider responses (captions and images)."""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from config import Config
+from image_buffer import as_view
+
+logger = logging.getLogger(__name__)
+
+_writes = threading.local()
+
+
+@contextmanager
+def track_writes():
+    """
+    Collect the (RunCache, key) pairs stored by the calling thread inside the block,
+    e.g. so a hedged request that lost can drop what it cached.
+    """
+    previous = getattr(_writes, "written", None)
+    _writes.written = written = []
+    try:
+        yield written
+    finally:
+        _writes.written = previous
+
+
+class ResponseCache:
+    """
+    Disk cache keyed by a hash of everything that determines a provider response.
+
+    Entries are files under <dir>/<key[:2]>/<key>. An entry's mtime is when it was
+    written (used for the TTL) and its atime is set on every hit (used for LRU
+    eviction once the cache grows past max_bytes). Writes go to a temp file that
+    is renamed into place, so readers never see partial entries.
+    """
+
+    def __init__(self, directory: str = None, ttl_seconds: float = None, max_bytes: int = None):
+        """
+        Initialize the cache.
+
+        Args:
+            directory: Cache directory (defaults to CACHE_DIR from config)
+            ttl_seconds: Entry lifetime (defaults to CACHE_TTL_HOURS from config)
+            max_bytes: Total size cap (defaults to CACHE_MAX_MB from config)
+        """
+        self.directory = Path(directory or Config.CACHE_DIR)
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else Config.CACHE_TTL_HOURS * 3600
+        self.max_bytes = max_bytes if max_bytes is not None else int(Config.CACHE_MAX_MB * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**fields) -> str:
+        """
+        Hash the fields that determine a response, e.g. provider, model, prompt, size,
+        quality and resolution.
+
+        Returns:
+            str: Hex SHA-256 of the canonical JSON of the fields
+        """
+        canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str):
+        """
+        Return the cached bytes for key, or None on a miss or expired entry.
+        """
+        path = self._path(key)
+        try:
+            stat = path.stat()
+            if time.time() - stat.st_mtime > self.ttl_seconds:
+                path.unlink()
+                raise FileNotFoundError
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, (time.time(), stat.st_mtime))  # Mark as recently used, keep creation time
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            logger.debug(f"Cache miss: {key[:12]}")
+            return None
+        with self._lock:
+            self.hits += 1
+        logger.info(f"Cache hit: {key[:12]} ({len(data)} bytes)")
+        return data
+
+    def put(self, key: str, data):
+        """
+        Store data (bytes-like or ImageBuffer) under key atomically, then evict if needed.
+        """
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{key}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(as_view(data))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def invalidate(self, key: str):
+        """Remove an entry (e.g. once its meme has been delivered)."""
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Drop expired entries, then least recently used entries until under max_bytes."""
+        if not self.directory.exists():
+            return
+        now = time.time()
+        entries = []
+        total = 0
+        for path in self.directory.glob("*/*"):
+            if path.name.startswith("."):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, path = entries.pop(0)
+            path.unlink(missing_ok=True)
+            total -= size
+            logger.debug(f"Evicted cache entry {path.name[:12]} ({size} bytes)")
+
+    def stats(self) -> dict:
+        """Hit/miss counters for this process."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+class RunCache:
+    """
+    A provider's view of the response cache for one run.
+
+    Remembers every key it served or stored so that release() can drop them once
+    the meme has been delivered; only reruns after a failure reuse responses.
+    A no-op when CACHE_ENABLED is false.
+    """
+
+    def __init__(self, provider: str, cache: ResponseCache = None):
+        self.provider = provider
+        self.cache = cache if cache is not None else (ResponseCache() if Config.CACHE_ENABLED else None)
+        self.keys = []
+
+    def key(self, **fields) -> str:
+        """Cache key for a request to this provider."""
+        return ResponseCache.make_key(provider=self.provider, **fields)
+
+    def get(self, key: str):
+        """Return cached bytes for key, or None."""
+        if self.cache is None:
+            return None
+        data = self.cache.get(key)
+        if data is not None:
+            self.keys.append(key)
+        return data
+
+    def put(self, key: str, data):
+        """Store a fresh response; cache write failures are logged, not raised."""
+        if self.cache is None:
+            return
+        try:
+            self.cache.put(key, data)
+            self.keys.append(key)
+        except OSError as e:
+            logger.warning(f"Could not write response cache: {e}")
+            return
+        written = getattr(_writes, "written", None)
+        if written is not None:
+            written.append((self, key))
+
+    def discard(self, key: str):
+        """Drop one entry this run stored, e.g. a response nobody will use."""
+        if self.cache is None:
+            return
+        self.cache.invalidate(key)
+        if key in self.keys:
+            self.keys.remove(key)
+
+    def release(self):
+        """Drop the entries used by this run (call after successful delivery)."""
+        if self.cache is None:
+            return
+        for key in self.keys:
+            self.cache.invalidate(key)
+        self.keys = []
+        logger.info(f"Response cache ({self.provider}): {self.cache.stats()}")
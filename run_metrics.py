@@ -0,0 +1,249 @@
+"""Per-stage timing spans for meme runs, exported as a JSON-lines run log and a Prometheus textfile."""
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from config import Config
+from file_utils import atomic_write_bytes
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "coffee_meme"
+
+_active = None
+_active_lock = threading.Lock()
+
+
+class RunMetrics:
+    """
+    Timing spans, event counters and provider spend collected during one run.
+
+    Spans use the monotonic clock and record their start offset from the beginning
+    of the run, so overlapping stages (e.g. hedged providers, parallel SMTP
+    batches) stay visible. Safe to use from worker threads.
+    """
+
+    def __init__(self, kind: str = "daily"):
+        self.kind = kind
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started_at = datetime.now()
+        self.status = "failed"
+        self.spans = []
+        self.counters = Counter()
+        self.cost_usd = defaultdict(float)  # Dollars spent per "provider/model"; not an event count
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        """
+        Time a block as one span of a stage.
+
+        Yields a dict the block can add fields to (e.g. bytes, encodes). The span is
+        recorded with ok=False if the block raises.
+        """
+        fields = dict(attrs)
+        started = time.monotonic()
+        ok = True
+        try:
+            yield fields
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            span = {
+                "stage": stage,
+                "start": round(started - self._t0, 6),
+                "seconds": round(time.monotonic() - started, 6),
+                "ok": ok,
+                **fields,
+            }
+            with self._lock:
+                self.spans.append(span)
+
+    def count(self, event: str, amount: int = 1):
+        """Increment an event counter (e.g. http_retries, smtp_retries)."""
+        if amount:
+            with self._lock:
+                self.counters[event] += amount
+
+    def add_cost(self, label: str, usd: float):
+        """Add provider spend (e.g. a settled request cost) under a "provider/model" label."""
+        if usd:
+            with self._lock:
+                self.cost_usd[label] += usd
+
+    def stage_totals(self) -> dict:
+        """Per-stage totals: {stage: {"seconds", "calls", "bytes"}}."""
+        totals = defaultdict(lambda: {"seconds": 0.0, "calls": 0, "bytes": 0})
+        with self._lock:
+            for span in self.spans:
+                total = totals[span["stage"]]
+                total["seconds"] += span["seconds"]
+                total["calls"] += 1
+                total["bytes"] += span.get("bytes", 0)
+        return dict(totals)
+
+    def to_record(self) -> dict:
+        """The run as one JSON-serializable run log record."""
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+            cost_usd = {label: round(usd, 6) for label, usd in self.cost_usd.items()}
+        return {
+            "run_id": self.run_id,
+            "kind": self.kind,
+            "started": self.started_at.isoformat(),
+            "seconds": round(time.monotonic() - self._t0, 6),
+            "status": self.status,
+            "stages": {stage: {**total, "seconds": round(total["seconds"], 6)}
+                       for stage, total in self.stage_totals().items()},
+            "counters": counters,
+            "cost_usd": cost_usd,
+            "spans": spans,
+        }
+
+    def to_prometheus(self, record: dict) -> str:
+        """Render a run record in the Prometheus text exposition format."""
+        p = METRIC_PREFIX
+        lines = [
+            f"# HELP {p}_stage_seconds Seconds spent in each stage during the last run.",
+            f"# TYPE {p}_stage_seconds gauge",
+        ]
+        lines += [f'{p}_stage_seconds{{stage="{stage}"}} {total["seconds"]}' for stage, total in record["stages"].items()]
+        lines += [
+            f"# HELP {p}_stage_calls Spans recorded per stage during the last run.",
+            f"# TYPE {p}_stage_calls gauge",
+        ]
+        lines += [f'{p}_stage_calls{{stage="{stage}"}} {total["calls"]}' for stage, total in record["stages"].items()]
+        lines += [
+            f"# HELP {p}_stage_bytes Bytes handled per stage during the last run.",
+            f"# TYPE {p}_stage_bytes gauge",
+        ]
+        lines += [f'{p}_stage_bytes{{stage="{stage}"}} {total["bytes"]}' for stage, total in record["stages"].items()]
+        lines += [
+            f"# HELP {p}_run_events Events (retries, encode iterations) counted during the last run.",
+            f"# TYPE {p}_run_events gauge",
+        ]
+        lines += [f'{p}_run_events{{event="{event}"}} {value}' for event, value in record["counters"].items()]
+        lines += [
+            f"# HELP {p}_run_cost_usd Provider spend in US dollars per model during the last run.",
+            f"# TYPE {p}_run_cost_usd gauge",
+        ]
+        lines += [f'{p}_run_cost_usd{{model="{label}"}} {usd}' for label, usd in record["cost_usd"].items()]
+        lines += [
+            f"# HELP {p}_run_seconds Wall time of the last run.",
+            f"# TYPE {p}_run_seconds gauge",
+            f'{p}_run_seconds{{kind="{self.kind}"}} {record["seconds"]}',
+            f"# HELP {p}_run_success 1 if the last run succeeded.",
+            f"# TYPE {p}_run_success gauge",
+            f'{p}_run_success{{kind="{self.kind}"}} {int(record["status"] == "success")}',
+            f"# HELP {p}_run_timestamp_seconds Unix time the last run started.",
+            f"# TYPE {p}_run_timestamp_seconds gauge",
+            f'{p}_run_timestamp_seconds{{kind="{self.kind}"}} {self.started_at.timestamp():.3f}',
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Append the run to RUN_LOG_PATH and replace METRICS_TEXTFILE_PATH (if set)."""
+        record = self.to_record()
+        if Config.RUN_LOG_PATH:
+            path = Path(Config.RUN_LOG_PATH)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + "\n")
+        if Config.METRICS_TEXTFILE_PATH:
+            # node_exporter's textfile collector needs the file replaced atomically
+            path = Path(Config.METRICS_TEXTFILE_PATH)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write_bytes(path, self.to_prometheus(record).encode('utf-8'))
+        summary = ", ".join(f"{stage} {total['seconds']:.2f}s" for stage, total in record["stages"].items())
+        logger.info(f"Run {self.run_id} {record['status']} in {record['seconds']:.2f}s ({summary})")
+
+
+def start_run(kind: str = "daily") -> RunMetrics:
+    """Begin collecting metrics for a run; module-level span()/count() record into it."""
+    global _active
+    with _active_lock:
+        _active = RunMetrics(kind) if Config.METRICS_ENABLED else None
+    return _active
+
+
+def finish_run():
+    """Write the active run's metrics (errors are logged, not raised) and stop collecting."""
+    global _active
+    with _active_lock:
+        run, _active = _active, None
+    if run is None:
+        return
+    try:
+        run.write()
+    except OSError as e:
+        logger.warning(f"Could not write run metrics: {e}")
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """Time a block in the active run; yields a dict for extra fields (a no-op dict without a run)."""
+    run = _active
+    if run is None:
+        yield dict(attrs)
+        return
+    with run.span(stage, **attrs) as fields:
+        yield fields
+
+
+def count(event: str, amount: int = 1):
+    """Increment an event counter in the active run, if any."""
+    run = _active
+    if run is not None:
+        run.count(event, amount)
+
+
+def add_cost(label: str, usd: float):
+    """Add provider spend to the active run, if any."""
+    run = _active
+    if run is not None:
+        run.add_cost(label, usd)
+
+
+def _nearest_rank(values: list, pct: float) -> float:
+    return values[max(1, math.ceil(pct / 100 * len(values))) - 1]
+
+
+def summarize_run_log(path: str = None, last: int = None, kind: str = None) -> dict:
+    """
+    Per-stage p50/p99 of stage seconds across logged runs.
+
+    Args:
+        path: Run log (defaults to RUN_LOG_PATH from config)
+        last: Only use the most recent runs
+        kind: Only use runs of this kind (e.g. "daily"; batch runs sum many memes)
+
+    Returns:
+        dict: {stage: {"runs", "p50", "p99", "max"}}
+    """
+    samples = defaultdict(list)
+    with open(path or Config.RUN_LOG_PATH, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if kind:
+        records = [record for record in records if record.get("kind") == kind]
+    for record in records[-last:] if last else records:
+        for stage, total in record.get("stages", {}).items():
+            samples[stage].append(total["seconds"])
+    summary = {}
+    for stage, values in samples.items():
+        values.sort()
+        summary[stage] = {
+            "runs": len(values),
+            "p50": _nearest_rank(values, 50),
+            "p99": _nearest_rank(values, 99),
+            "max": values[-1],
+        }
+    return summary